@@ -0,0 +1,202 @@
+"""
+    End-to-end broadcast benchmark on localhost.
+
+    A root and N headless clients run in their own processes (so CPU and RSS are per peer); every client registers,
+    advertises and joins the tree, then one client broadcasts 'count' messages of 'size' characters at 'rate'
+    messages per second through its UserInterface buffer, which ends in send_broadcast_packet.
+
+    Every message carries its send time, so each receiver knows its end-to-end latency; dividing by the number of
+    tree hops between the sender and the receiver gives the per-hop latency. Remember that every peer forwards on
+    its 2 seconds main loop, so most of a hop is queueing.
+
+    python benchmarks/bench_broadcast.py [--clients 8] [--count 20] [--rate 5] [--size 64] [--json broadcast.json]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import common
+
+ROOT_IP = '192.168.000.001'
+CLIENT_IP = '192.168.000.002'
+PARENT_LINE = re.compile(r'parent address: \((\S+), (\d+)\)')
+
+
+class _TimedList(list):
+    def __init__(self):
+        super(_TimedList, self).__init__()
+        self.times = []
+
+    def append(self, item):
+        super(_TimedList, self).append(item)
+        self.times.append(time.time())
+
+
+class BenchUserInterface:
+    def __init__(self, server_address):
+        """
+        A UserInterface without GUI or stdin; 'printer_times' keeps the arrival time of every 'printer' line.
+        """
+        self.server_ip = server_address[0]
+        self.server_port = server_address[1]
+        self.buffer = []
+        self.printer = _TimedList()
+
+
+def _peer_process(role, address, root_address, conn):
+    from Root import Root
+    from Client import Client
+    sys.stdout = open(os.devnull, 'w')
+    ui = BenchUserInterface(address)
+    if role == 'root':
+        Root(address[0], address[1], ui, snapshot_path=None)
+    else:
+        threading.Thread(target=Client, args=(address[0], address[1], ui, False, root_address), daemon=True).start()
+    conn.send('ready')
+    while True:
+        command = conn.recv()
+        if command[0] == 'ui':
+            ui.buffer.append(command[1])
+        elif command[0] == 'parent':
+            parents = [PARENT_LINE.match(line) for line in list(ui.printer)]
+            parents = [(match.group(1), int(match.group(2))) for match in parents if match]
+            conn.send(parents[-1] if parents else None)
+        elif command[0] == 'send':
+            _, count, rate, size = command
+            for seq in range(count):
+                body = '{}.{:.6f}.'.format(seq, time.time())
+                ui.buffer.append('send ' + body + 'x' * max(0, size - len(body)))
+                time.sleep(1 / rate)
+            conn.send('sent')
+        elif command[0] == 'report':
+            received = [(line.split(': ', 1)[1], when) for line, when in zip(list(ui.printer), ui.printer.times)
+                        if not line.startswith('parent address')]
+            conn.send({'received': received, 'usage': common.usage()})
+        elif command[0] == 'stop':
+            os._exit(0)
+
+
+def _distance(parents, a, b):
+    """
+    :param parents: Address -> parent address of the tree.
+    :return: Number of tree edges between a and b.
+    """
+    def path(node):
+        result = [node]
+        while node in parents and parents[node] is not None:
+            node = parents[node]
+            result.append(node)
+        return result
+    path_a, path_b = path(a), path(b)
+    depth_b = {node: i for i, node in enumerate(path_b)}
+    for i, node in enumerate(path_a):
+        if node in depth_b:
+            return i + depth_b[node]
+    return None
+
+
+def run(clients=8, count=20, rate=5.0, size=64, join_timeout=60, settle=30):
+    base = random.randint(20000, 40000)
+    root_address = (ROOT_IP, base)
+    addresses = [root_address] + [(CLIENT_IP, base + i) for i in range(1, clients + 1)]
+    peers = []
+    for i, address in enumerate(addresses):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_peer_process, daemon=True,
+                                          args=('root' if i == 0 else 'client', address, root_address, child_conn))
+        process.start()
+        peers.append((address, process, parent_conn))
+        parent_conn.recv()
+        if i == 0:
+            time.sleep(0.5)
+    try:
+        return _measure(peers, count, rate, size, join_timeout, settle)
+    finally:
+        for _, process, conn in peers:
+            conn.send(('stop',))
+            process.join(1)
+
+
+def _measure(peers, count, rate, size, join_timeout, settle):
+    for _, _, conn in peers[1:]:
+        conn.send(('ui', 'Register'))
+    time.sleep(6)
+    for _, _, conn in peers[1:]:
+        conn.send(('ui', 'Advertise'))
+    parents = {peers[0][0]: None}
+    deadline = time.time() + join_timeout
+    while len(parents) < len(peers) and time.time() < deadline:
+        time.sleep(2)
+        for address, _, conn in peers[1:]:
+            conn.send(('parent',))
+            parent = conn.recv()
+            if parent is not None:
+                parents[address] = parent
+    join_seconds = join_timeout - max(0.0, deadline - time.time())
+    # Let the Join packets reach the parents.
+    time.sleep(4)
+
+    sender_address, _, sender_conn = peers[-1]
+    start = time.time()
+    sender_conn.send(('send', count, rate, size))
+    sender_conn.recv()
+    time.sleep(settle)
+
+    latencies, per_hop, arrivals, by_hops, usages = [], [], [], {}, []
+    for address, _, conn in peers:
+        conn.send(('report',))
+        report = conn.recv()
+        usages.append(report['usage'])
+        if address == sender_address:
+            continue
+        hops = _distance(parents, sender_address, address)
+        for body, when in report['received']:
+            sent = float(body.split('.', 1)[1].rsplit('.', 1)[0])
+            latency = when - sent
+            latencies.append(latency)
+            arrivals.append(when)
+            if hops:
+                per_hop.append(latency / hops)
+                by_hops.setdefault(str(hops), []).append(latency)
+    delivered = len(latencies)
+    elapsed = (max(arrivals) - start) if arrivals else 0
+    frame_size = 20 + max(size, len('{}.{:.6f}.'.format(count, start)))
+    return {
+        'peers': len(peers),
+        'joined': len(parents) - 1,
+        'join_seconds': join_seconds,
+        'expected_deliveries': count * (len(peers) - 1),
+        'delivered': delivered,
+        'messages_per_sec': delivered / elapsed if elapsed else 0,
+        'bytes_per_sec': delivered * frame_size / elapsed if elapsed else 0,
+        'latency_seconds': common.percentiles(latencies),
+        'per_hop_latency_seconds': common.percentiles(per_hop),
+        'latency_by_hops': {hops: common.percentiles(values) for hops, values in sorted(by_hops.items())},
+        'cpu_seconds_per_peer': common.percentiles([u['cpu_seconds'] for u in usages if u['cpu_seconds'] is not None]),
+        'max_rss_kib_per_peer': common.percentiles([u['max_rss_kib'] for u in usages if u['max_rss_kib'] is not None]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--count', type=int, default=20, help='Messages to broadcast.')
+    parser.add_argument('--rate', type=float, default=5.0, help='Messages per second.')
+    parser.add_argument('--size', type=int, default=64, help='Message body size in characters.')
+    parser.add_argument('--join-timeout', type=float, default=60)
+    parser.add_argument('--settle', type=float, default=30, help='Seconds to wait for the last deliveries.')
+    parser.add_argument('--json', help='Write the report to this file.')
+    args = parser.parse_args()
+    params = {'clients': args.clients, 'count': args.count, 'rate': args.rate, 'size': args.size,
+              'join_timeout': args.join_timeout, 'settle': args.settle}
+    results = run(args.clients, args.count, args.rate, args.size, args.join_timeout, args.settle)
+    common.write_report('broadcast', params, results, args.json)
+
+
+if __name__ == '__main__':
+    main()
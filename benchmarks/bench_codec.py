@@ -0,0 +1,53 @@
+"""
+    Codec micro-benchmarks: making packets, serializing them and parsing received frames.
+
+    python benchmarks/bench_codec.py [--sizes 16,256,4096] [--repeat 20000] [--json codec.json]
+"""
+import argparse
+
+import common
+from Packet import PacketFactory
+from Stream import Stream
+
+SOURCE = ('192.168.000.001', 44331)
+
+
+def run(sizes=(16, 256, 4096), repeat=20000, batch=100):
+    factory = PacketFactory()
+    results = {}
+    for size in sizes:
+        body = 'x' * size
+        packet = factory.new_message_packet(body, SOURCE)
+        frame = packet.get_buf()
+        frames = [frame] * batch
+        results[str(size)] = {
+            'new_message_packet': common.timed(factory.new_message_packet, repeat, body, SOURCE),
+            'get_buf': common.timed(packet.get_buf, repeat),
+            'parse_buffer_one': common.timed(factory.parse_buffer, repeat, [frame]),
+            'parse_buffer_batch_{}'.format(batch): common.timed(factory.parse_buffer, max(1, repeat // batch),
+                                                                frames),
+            'parse_batch_headers_{}'.format(batch): common.timed(lambda: factory.parse_batch(frames).types,
+                                                                 max(1, repeat // batch)),
+            'frame_length': common.timed(Stream._frame_length, repeat, frame),
+        }
+    reunion_path = [('192.168.000.002', 20000 + i) for i in range(8)]
+    results['reunion_8'] = {
+        'new_reunion_packet': common.timed(factory.new_reunion_packet, repeat, 'REQ', SOURCE, reunion_path),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='16,256,4096', help='Message body sizes in characters.')
+    parser.add_argument('--repeat', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=100, help='Frames per parse_buffer call in the batch case.')
+    parser.add_argument('--json', help='Write the report to this file.')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    params = {'sizes': sizes, 'repeat': args.repeat, 'batch': args.batch}
+    common.write_report('codec', params, run(sizes, args.repeat, args.batch), args.json)
+
+
+if __name__ == '__main__':
+    main()
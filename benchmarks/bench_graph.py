@@ -0,0 +1,129 @@
+"""
+    Graph placement benchmarks: how fast the root finds parents for advertising clients, for every NetworkGraph
+    implementation ('objects': tools.NetworkGraph, 'arrays': tools.ArrayNetworkGraph).
+
+    sequential: one find_live_node + place_node per client, like single Advertise Requests.
+    batch:      one find_live_nodes for all clients, like _handle_advertise_batch after a root restart.
+    reparent:   remove the first child of the root and place its whole orphaned sub-tree again in one batch.
+    bulk:       turn_off_subtree of the first child of the root and depth_histogram of the whole graph.
+    memory:     traced bytes per node of the built graph.
+
+    python benchmarks/bench_graph.py [--sizes 1000,5000] [--sequential-max 5000] [--graphs objects,arrays]
+                                     [--json graph.json]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+import common
+from tools.ArrayNetworkGraph import ArrayNetworkGraph
+from tools.NetworkGraph import NetworkGraph, GraphNode
+
+ROOT = ('192.168.000.001', 44331)
+GRAPHS = {
+    'objects': lambda: NetworkGraph(GraphNode(ROOT)),
+    'arrays': lambda: ArrayNetworkGraph(ROOT),
+}
+
+
+def addresses(count):
+    return [('192.168.000.002', 10000 + i) for i in range(count)]
+
+
+def build_sequential(senders, make_graph):
+    graph = make_graph()
+    for sender in senders:
+        parent = graph.find_live_node(sender)
+        graph.place_node(sender[0], sender[1], parent.address)
+    return graph
+
+
+def build_batch(senders, make_graph):
+    graph = make_graph()
+    parents = graph.find_live_nodes(senders)
+    for sender in senders:
+        graph.place_node(sender[0], sender[1], parents[sender])
+    return graph
+
+
+def reparent(graph):
+    """
+    :return: Number of the re-placed nodes.
+    """
+    removed = graph.root.children[0]
+    orphans = [node.address for node in _sub_tree(removed)][1:]
+    graph.remove_node(removed.address)
+    parents = graph.find_live_nodes(orphans)
+    for orphan in orphans:
+        if parents[orphan] is not None:
+            graph.place_node(orphan[0], orphan[1], parents[orphan])
+    return len(orphans)
+
+
+def _sub_tree(node):
+    queue = [node]
+    for v in queue:
+        queue.extend(v.children)
+    return queue
+
+
+def bytes_per_node(senders, make_graph):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    graph = build_batch(senders, make_graph)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del graph
+    return round(size / len(senders))
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run(sizes=(1000, 5000), sequential_max=5000, graphs=tuple(GRAPHS)):
+    results = {}
+    for size in sizes:
+        senders = addresses(size)
+        results[str(size)] = {}
+        for name in graphs:
+            make_graph = GRAPHS[name]
+            result = {}
+            if size <= sequential_max:
+                _, elapsed = _timed(build_sequential, senders, make_graph)
+                result['sequential'] = {'seconds': elapsed, 'placements_per_sec': size / elapsed}
+            graph, elapsed = _timed(build_batch, senders, make_graph)
+            result['batch'] = {'seconds': elapsed, 'placements_per_sec': size / elapsed}
+            graph.depth_histogram()  # the first big pass imports NumPy
+            _, histogram_seconds = _timed(graph.depth_histogram)
+            count, subtree_seconds = _timed(graph.turn_off_subtree, graph.root.children[0].address)
+            result['bulk'] = {'subtree_nodes': count, 'turn_off_subtree_seconds': subtree_seconds,
+                              'depth_histogram_seconds': histogram_seconds}
+            count, elapsed = _timed(reparent, graph)
+            result['reparent'] = {'nodes': count, 'seconds': elapsed, 'placements_per_sec': count / elapsed}
+            result['memory'] = {'bytes_per_node': bytes_per_node(senders, make_graph)}
+            results[str(size)][name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1000,5000', help='Numbers of clients to place.')
+    parser.add_argument('--sequential-max', type=int, default=5000,
+                        help='Skip sequential placement (quadratic) above this size.')
+    parser.add_argument('--graphs', default=','.join(GRAPHS), help='NetworkGraph implementations to run.')
+    parser.add_argument('--json', help='Write the report to this file.')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    graphs = args.graphs.split(',')
+    params = {'sizes': sizes, 'sequential_max': args.sequential_max, 'graphs': graphs}
+    common.write_report('graph', params, run(sizes, args.sequential_max, graphs), args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+    Memory benchmarks: bytes per instance of the objects we keep many of, and bytes per registered client on a root.
+
+    instances:  Traced bytes per Packet (parsed from a frame), GraphNode, Node (with the ReplyConnection of a
+                registered client) and SemiNode.
+    root:       A Root (start_threads=False) registers N clients and places them with Advertise batches, fed
+                straight to its handlers; the responses are dropped instead of sent. Traced bytes of the root
+                growth per client.
+
+    python benchmarks/bench_memory.py [--clients 10000,100000] [--json memory.json]
+"""
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+
+import common
+from Packet import PacketFactory
+from Root import Root
+from tools.ConnectionPool import ReplyConnection
+from tools.NetworkGraph import GraphNode
+from tools.Node import Node
+from tools.SemiNode import SemiNode
+
+ROOT = ('127.000.000.001', 46000)
+
+
+class _QuietUserInterface:
+    def __init__(self):
+        self.buffer = []
+        self.printer = []
+
+
+def _address(i):
+    return '10.{:03d}.{:03d}.{:03d}'.format(i >> 16 & 255, i >> 8 & 255, i & 255), 1 + i % 60000
+
+
+def _traced(make, count):
+    """
+    :return: Traced bytes per object made by make(i), for count objects kept alive together.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [make(i) for i in range(count)]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return round(size / count - 8)  # without the list slot
+
+
+def instance_sizes(count=10000):
+    factory = PacketFactory()
+    frames = [factory.new_message_packet('x' * 16, _address(i)).get_buf() for i in range(count)]
+    reply_queues = {}
+    return {
+        'Packet': _traced(lambda i: factory.parse_buffer([frames[i]])[0], count),
+        'GraphNode': _traced(lambda i: GraphNode(_address(i)), count),
+        'Node': _traced(lambda i: Node(_address(i), set_register=True,
+                                       connection=ReplyConnection(_address(i), reply_queues)), count),
+        'SemiNode': _traced(lambda i: SemiNode(*_address(i)), count),
+    }
+
+
+def root_per_client(clients, batch=1000, port=ROOT[1]):
+    factory = PacketFactory()
+    os.chdir(tempfile.mkdtemp())
+    root = Root(ROOT[0], port, _QuietUserInterface(), snapshot_path=None, start_threads=False)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for start in range(0, clients, batch):
+        addresses = [_address(i) for i in range(start, min(clients, start + batch))]
+        for address in addresses:
+            root.handle_packet(factory.new_register_packet('REQ', address, address))
+        root._handle_advertise_batch([factory.new_advertise_packet('REQ', address) for address in addresses])
+        for node in root.stream.nodes:  # as if send_message had flushed them
+            node.out_buff = node.control_buff = ()
+            node.out_buff_bytes = 0
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {'clients': clients, 'graph_nodes': len(root.graph.nodes), 'stream_nodes': len(root.stream.nodes),
+            'bytes_per_client': round(size / clients), 'total_mib': round(size / (1 << 20), 1)}
+
+
+def run(clients=(10000, 100000), count=10000):
+    results = {'instances': instance_sizes(count)}
+    for i, n in enumerate(clients):
+        results['root_{}'.format(n)] = root_per_client(n, port=ROOT[1] + i)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', default='10000,100000', help='Registered client counts.')
+    parser.add_argument('--count', type=int, default=10000, help='Instances per class.')
+    parser.add_argument('--json', help='Write the report to this file.')
+    args = parser.parse_args()
+    clients = [int(n) for n in args.clients.split(',')]
+    params = {'clients': clients, 'count': args.count}
+    common.write_report('memory', params, run(clients, args.count), args.json)
+    os._exit(0)  # the Roots' TCPServer threads never end
+
+
+if __name__ == '__main__':
+    main()
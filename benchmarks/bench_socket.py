@@ -0,0 +1,136 @@
+"""
+    Socket option benchmarks: small-message latency and bulk throughput through a simpletcp ServerSocket, with each
+    SocketOptions setting on and off.
+
+    rpc:        One Message frame, then wait for the ACK, like a non-duplex Connection.
+    burst:      Bursts of small frames without waiting (a duplex Connection); latency from sending a frame until
+                the server callback has it.
+    throughput: Bigger frames as fast as the sender can, frames per second at the server.
+
+    python benchmarks/bench_socket.py [--count 2000] [--json socket.json]
+"""
+import argparse
+import threading
+import time
+
+import common
+from Packet import PacketFactory
+from Stream import Stream
+from tools.simpletcp.clientsocket import ClientSocket
+from tools.simpletcp.serversocket import ServerSocket
+from tools.simpletcp.socketoptions import SocketOptions
+
+SOURCE = ('127.000.000.001', 30000)
+VARIANTS = {
+    'default': {},
+    'no_nodelay': {'nodelay': False},
+    'buffers_1m': {'send_buffer': 1 << 20, 'receive_buffer': 1 << 20},
+    'buffers_16k': {'send_buffer': 1 << 14, 'receive_buffer': 1 << 14},
+    'keepalive': {'keepalive': True, 'keepalive_idle': 30, 'keepalive_interval': 10, 'keepalive_count': 3},
+    'recv_2k': {'recv_size': 2048},
+    'recv_64k': {'recv_size': 65536},
+}
+
+
+class _Server:
+    def __init__(self, port, options):
+        self.arrivals = []
+        self.server = ServerSocket('localhost', port, self._callback, 16, options.recv_size,
+                                   frame_length=Stream._frame_length, socket_options=options)
+        threading.Thread(target=self.server.run, daemon=True).start()
+
+    def _callback(self, address, queue, data):
+        self.arrivals.append(time.perf_counter())
+        if queue is not None:
+            queue.put(b'ACK')
+
+
+def _client(port, options, expect_response):
+    # The server only listens once its thread runs.
+    for _ in range(100):
+        client = ClientSocket('localhost', port, single_use=False, connect_now=False,
+                              expect_response=expect_response, socket_options=options)
+        try:
+            client.connect()
+            return client
+        except ConnectionRefusedError:
+            client.close()
+            time.sleep(0.01)
+    raise ConnectionRefusedError(port)
+
+
+def _wait(server, count, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while len(server.arrivals) < count and time.perf_counter() < deadline:
+        time.sleep(0.001)
+
+
+def run_rpc(port, options, count, size):
+    server = _Server(port, options)
+    client = _client(port, options, True)
+    frame = PacketFactory().new_message_packet('x' * size, SOURCE).get_buf()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        client.send(frame)
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    return common.percentiles(latencies)
+
+
+def run_burst(port, options, count, size, burst=4, gap=0.002):
+    server = _Server(port, options)
+    client = _client(port, options, False)
+    frame = PacketFactory().new_message_packet('x' * size, SOURCE).get_buf()
+    sent = []
+    for _ in range(count // burst):
+        for _ in range(burst):
+            sent.append(time.perf_counter())
+            client.send(frame)
+        time.sleep(gap)
+    _wait(server, len(sent))
+    client.close()
+    return common.percentiles([arrival - start for start, arrival in zip(sent, server.arrivals)])
+
+
+def run_throughput(port, options, count, size):
+    server = _Server(port, options)
+    client = _client(port, options, False)
+    frame = PacketFactory().new_message_packet('x' * size, SOURCE).get_buf()
+    start = time.perf_counter()
+    for _ in range(count):
+        client.send(frame)
+    _wait(server, count)
+    elapsed = server.arrivals[-1] - start if server.arrivals else float('nan')
+    client.close()
+    return {'frames_per_sec': len(server.arrivals) / elapsed, 'mib_per_sec': len(server.arrivals) * len(frame) /
+            elapsed / (1 << 20)}
+
+
+def run(count=2000, size=16, bulk_size=1024, first_port=47000, variants=None):
+    results = {}
+    port = first_port
+    for name, overrides in (variants or VARIANTS).items():
+        options = SocketOptions(**overrides)
+        results[name] = {}
+        for scenario, function, args in (('rpc', run_rpc, (count, size)), ('burst', run_burst, (count, size)),
+                                         ('throughput', run_throughput, (count * 10, bulk_size))):
+            results[name][scenario] = function(port, options, *args)
+            port += 1
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000, help='Small frames per latency scenario.')
+    parser.add_argument('--size', type=int, default=16, help='Small message body size.')
+    parser.add_argument('--bulk-size', type=int, default=1024, help='Message body size in the throughput scenario.')
+    parser.add_argument('--first-port', type=int, default=47000)
+    parser.add_argument('--json', help='Write the report to this file.')
+    args = parser.parse_args()
+    params = {'count': args.count, 'size': args.size, 'bulk_size': args.bulk_size}
+    common.write_report('socket', params, run(args.count, args.size, args.bulk_size, args.first_port), args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+    Helpers shared by the benchmark scripts.
+
+    Every benchmark returns a dict of results; write_report wraps it with the parameters and the machine so two JSON
+    reports can be compared with compare.py.
+"""
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_PATH not in sys.path:
+    sys.path.insert(0, SRC_PATH)
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    """
+    Nearest-rank percentiles.
+
+    :param values: Samples.
+    :param points: Percentiles we want.
+    :return: 'p50' -> value, ... plus 'min', 'max', 'mean' and 'count'; empty if there are no samples.
+    :rtype: dict
+    """
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    result = {'count': len(ordered), 'min': ordered[0], 'max': ordered[-1], 'mean': sum(ordered) / len(ordered)}
+    for point in points:
+        rank = max(0, min(len(ordered) - 1, int(round(point / 100 * len(ordered) + 0.5)) - 1))
+        result['p{:g}'.format(point)] = ordered[rank]
+    return result
+
+
+def usage():
+    """
+    :return: CPU seconds (user + system) and max RSS in KiB of this process; None values without 'resource'.
+    :rtype: dict
+    """
+    if resource is None:
+        return {'cpu_seconds': None, 'max_rss_kib': None}
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    max_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss //= 1024  # bytes on macOS
+    return {'cpu_seconds': rusage.ru_utime + rusage.ru_stime, 'max_rss_kib': max_rss}
+
+
+def timed(function, repeat, *args):
+    """
+    :param function: Called 'repeat' times with args.
+    :param repeat:
+    :return: Operations per second and nanoseconds per operation.
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    elapsed = time.perf_counter() - start
+    return {'ops_per_sec': repeat / elapsed, 'ns_per_op': elapsed / repeat * 1e9}
+
+
+def write_report(name, params, results, path=None):
+    """
+    Print the report and write it as JSON to path, if there is one.
+
+    :param name: Benchmark name.
+    :param params: Parameters of the run.
+    :param results: What the benchmark measured.
+    :param path: JSON file path or None.
+    :return: The report.
+    :rtype: dict
+    """
+    report = {'benchmark': name, 'time': time.time(), 'python': platform.python_version(),
+              'machine': platform.machine(), 'params': params, 'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    return report
@@ -0,0 +1,44 @@
+"""
+    Compare two JSON reports of the same benchmark and show the relative change of every number.
+
+    python benchmarks/compare.py old.json new.json [--threshold 10]
+"""
+import argparse
+import json
+
+
+def flatten(value, prefix=''):
+    """
+    :return: 'a.b.c' -> number for every number in the nested dicts.
+    :rtype: dict
+    """
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            result.update(flatten(item, '{}.{}'.format(prefix, key) if prefix else str(key)))
+        return result
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='Mark changes bigger than this many percent.')
+    args = parser.parse_args()
+    with open(args.old) as f:
+        old = flatten(json.load(f)['results'])
+    with open(args.new) as f:
+        new = flatten(json.load(f)['results'])
+    for key in sorted(set(old) & set(new)):
+        if old[key] == 0:
+            continue
+        change = (new[key] - old[key]) / abs(old[key]) * 100
+        mark = ' *' if abs(change) > args.threshold else ''
+        print('{:<70} {:>14.6g} {:>14.6g} {:>+8.1f}%{}'.format(key, old[key], new[key], change, mark))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+    Run the codec, graph, socket, broadcast and memory benchmarks with their default parameters and write one JSON report.
+
+    python benchmarks/run_all.py [--quick] [--json all.json]
+"""
+import argparse
+import os
+
+import common
+import bench_broadcast
+import bench_codec
+import bench_graph
+import bench_memory
+import bench_socket
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes, for a smoke run.')
+    parser.add_argument('--json', help='Write the report to this file.')
+    args = parser.parse_args()
+    if args.quick:
+        params = {'codec': {'repeat': 2000}, 'graph': {'sizes': (1000,)}, 'socket': {'count': 200},
+                  'broadcast': {'clients': 4, 'count': 5, 'settle': 15},
+                  'memory': {'clients': (1000,), 'count': 1000}}
+    else:
+        params = {'codec': {}, 'graph': {}, 'socket': {}, 'broadcast': {}, 'memory': {}}
+    results = {
+        'codec': bench_codec.run(**params['codec']),
+        'graph': bench_graph.run(**params['graph']),
+        'socket': bench_socket.run(**params['socket']),
+        'broadcast': bench_broadcast.run(**params['broadcast']),
+        'memory': bench_memory.run(**params['memory']),
+    }
+    common.write_report('all', params, results, args.json)
+    os._exit(0)  # the memory Roots' TCPServer threads never end
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,23 @@ from Packet import Packet, PacketFactory
 from UserInterface import UserInterface
 from tools.SemiNode import SemiNode
 from tools.NetworkGraph import NetworkGraph, GraphNode
-from config import verbosity
+from tools.HashRing import HashRing
+from tools.Log import get_logger
+from tools.Profiler import profiler
+from config import root_shards, shortcut_after, shortcut_max, shortcut_idle_time
+import collections
 import time
 import threading
 import sys
 
+log = get_logger('client')
+reunion_log = get_logger('reunion')
+packet_log = get_logger('packet')
+
 
 class Client(Peer):
-    def __init__(self, server_ip, server_port, user_interface=None, is_root=False, root_address=None):
+    def __init__(self, server_ip, server_port, user_interface=None, is_root=False, root_address=None, stream=None,
+                 clock=None, start_threads=True):
         """
         The Peer object constructor.
 
@@ -29,30 +38,53 @@ class Client(Peer):
         :param server_ip: Server IP address for this Peer that should be pass to Stream.
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
-        :param root_address: Root IP/Port address if we are a client.
+        :param root_address: Root IP/Port address if we are a client; or a list of them (primary root first, then
+                             its standby roots) to fail over to when the current root stops answering.
+                             In a sharded network (config.root_shards) the hash ring chooses our roots instead.
+        :param stream: See Peer.
+        :param clock: See Peer.
+        :param start_threads: If False, somebody else (tools.Simulator) calls run_once and reunion_tick.
+                              Otherwise our threads are started and we return right away; see Peer.join.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
-        :type root_address: tuple
+        :type root_address: tuple or list
         """
-        super(Client, self).__init__(server_ip, server_port, user_interface, is_root, root_address)
+        super(Client, self).__init__(server_ip, server_port, user_interface, is_root, root_address, stream, clock)
         self.start_user_interface()
-        self.parent = None  # address of the parent node which will be a tuple
         self.last_reunion_time = 0  # last time a reunion hello packet was sent
         self._reunion_mode = None  # either 'pending' or 'acceptance' after registration
         self.__is_disconnected = False
-        self.root_address = root_address
+        if root_shards:
+            ring = HashRing([(SemiNode.parse_ip(ip), port) for ip, port in root_shards])
+            self.root_addresses = ring.preference_list((SemiNode.parse_ip(server_ip), server_port))
+        else:
+            self.root_addresses = list(root_address) if isinstance(root_address, list) else [root_address]
+        self.root_address = self.root_addresses[0]
         self.valid_time = 32
         self.adv_sent = False
-        self.t_run = threading.Thread(target=self.run, args=())
-        self.t_run.start()
-        self.t_reunion_daemon = threading.Thread(target=self.run_reunion_daemon, args=())
         self.is_registered = False
-        # self._register()
-        # self._advertise()
-        self.t_run.join()
-        self.t_reunion_daemon.join()
+        self._reunion_failures = self.metrics.counter('reunion_failures_total')
+        self._reunion_seconds = self.metrics.histogram('reunion_round_trip_seconds')
+        # Unicast Messages we have sent per destination since _unicast_counts_since, see _send_unicast.
+        self._unicast_counts = collections.Counter()
+        self._unicast_counts_since = self.clock.time()
+        self.metrics.gauge('shortcuts', function=lambda: len(self.shortcuts))
+        self._shortcuts_closed = {reason: self.metrics.counter('shortcuts_closed_total', reason=reason)
+                                  for reason in ('idle', 'peer', 'broken', 'refused')}
+        self._start_threads = start_threads
+        self.t_reunion_daemon = threading.Thread(target=self.run_reunion_daemon, args=())
+        if start_threads:
+            self.t_run = threading.Thread(target=self.run, args=())
+            self.t_run.start()
+
+    def is_disconnected(self):
+        """
+        :return: Whether we gave up on every root; the threads exit then.
+        :rtype: bool
+        """
+        return self.__is_disconnected
 
     def _register(self):
         self.stream.add_node(self.root_address, set_register_connection=True)
@@ -63,6 +95,50 @@ class Client(Peer):
         adv_pack = self.packet_factory.new_advertise_packet('REQ', self.server_address)
         self.stream.add_message_to_out_buff(self.root_address, adv_pack.get_buf(), True)
 
+    def _fail_over_root(self):
+        """
+        Move our register_connection to the next root address and register there.
+        Our place in the tree does not change; a standby root already knows it.
+
+        :return: Whether there is another root address to try.
+        :rtype: bool
+        """
+        if len(self.root_addresses) < 2:
+            return False
+        node = self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True)
+        if node is not None:
+            self.stream.remove_node(node)
+        index = (self.root_addresses.index(self.root_address) + 1) % len(self.root_addresses)
+        self.root_address = self.root_addresses[index]
+        log.warning('failing over to root %s', self.root_address)
+        self._register()
+        return True
+
+    def _advertise_now(self):
+        """
+        Send an Advertise Request to the root right now, because our main loop may be stuck waiting for Reunion.
+        If the root does not answer we fail over to the next root address.
+
+        :return: Whether the packet has been sent.
+        :rtype: bool
+        """
+        adv_packet = self.packet_factory.new_advertise_packet('REQ', self.server_address)
+        for _ in range(len(self.root_addresses)):
+            node = self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True)
+            if node is None:
+                self._register()
+                node = self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True)
+            self.stream.add_message_to_out_buff(self.root_address, adv_packet.get_buf(), True)
+            try:
+                self.stream.send_messages_to_node(node)
+                if node.connection.down_since is None or len(self.root_addresses) == 1:
+                    return True
+            except Exception:
+                pass
+            if not self._fail_over_root():
+                return False
+        return False
+
     def handle_user_interface_buffer(self):
         """
         In every interval, we should parse user command that buffered from our UserInterface.
@@ -70,6 +146,11 @@ class Client(Peer):
             1. Register:  With this command, the client send a Register Request packet to the root of the network.
             2. Advertise: Send an Advertise Request to the root of the network for finding first hope.
             3. SendMessage: The following string will be added to a new Message packet and broadcast through the network.
+            4. trace: Like SendMessage, but the message collects the times of its hops (see Packet and TraceReport).
+            5. profile: 'profile start [sample|cprofile]' and 'profile stop [path]', see Peer.start_profiler.
+            6. subscribe, unsubscribe and publish: Topics, see Peer._handle_topic_command.
+            7. sendto: 'sendto <ip> <port> <message>' sends the message to that peer only, see Peer._send_unicast.
+            8. shortcut: 'shortcut <ip> <port>' asks for a direct connection to that peer, see _request_shortcut.
 
         Warnings:
             1. Ignore irregular commands from the user.
@@ -77,18 +158,28 @@ class Client(Peer):
         :return:
         """
         buff = self.user_interface.buffer
-        for msg in buff:
+        # Commands typed while we are parsing stay for the next interval.
+        count = len(buff)
+        for msg in buff[:count]:
             msg_split = msg.split()
             if msg_split[0] == 'Register':
                 self._register()
             elif msg_split[0] == 'Advertise' and self.is_registered:
                 self._advertise()
             elif msg_split[0] == 'send':
-                brd_cast_packet = self.packet_factory.new_message_packet(msg_split[1],
-                                                                         source_server_address=self.server_address)
-                self.send_broadcast_packet(brd_cast_packet)
-
-        self.user_interface.buffer.clear()
+                self._broadcast_message(msg_split[1])
+            elif msg_split[0] == 'trace':
+                self._broadcast_message(msg_split[1], trace=True)
+            elif msg_split[0] == 'profile':
+                self._handle_profile_command(msg_split[1:])
+            elif msg_split[0] in ('subscribe', 'unsubscribe', 'publish'):
+                self._handle_topic_command(msg_split)
+            elif msg_split[0] == 'sendto':
+                self._handle_sendto_command(msg_split)
+            elif msg_split[0] == 'shortcut' and len(msg_split) == 3:
+                self._request_shortcut((SemiNode.parse_ip(msg_split[1]), int(msg_split[2])))
+
+        del buff[:count]
 
     def run(self):
         """
@@ -111,10 +202,22 @@ class Client(Peer):
         while True:
             if self.__is_disconnected:
                 sys.exit()
-            t = time.time()
+            profiler.checkpoint('run')
+            self.run_once()
+            self.clock.sleep(2)
+
+    def run_once(self):
+        """
+        One iteration of the main loop.
+
+        :return:
+        """
+        start = time.perf_counter()
+        with self.state_lock:
+            t = self.clock.time()
             self.handle_user_interface_buffer()
-            in_buff = self.stream.read_in_buf()
-            packets = self.packet_factory.parse_buffer(in_buff)
+            self._handle_delayed_messages()
+            packets = self._read_packets()
             for packet in packets:
                 type = packet.get_type()
                 if self.is_registered:
@@ -125,9 +228,10 @@ class Client(Peer):
                     if packet.get_type() == 1:
                         self.handle_packet(packet)
 
+            self._check_shortcuts(t)
             self.__send()
-            self.stream.clear_in_buff()
-            time.sleep(2)
+        self.stream.clear_in_buff()
+        self._main_loop_seconds.record(time.perf_counter() - start)
 
     def run_reunion_daemon(self):
         """
@@ -149,31 +253,45 @@ class Client(Peer):
 
         :return:
         """
-        self.last_reunion_time = time.time()
+        self.last_reunion_time = self.clock.time()
         while True:
-            time.sleep(4)
-            t = time.time()
+            self.clock.sleep(4)
+            profiler.checkpoint('reunion')
+            self.reunion_tick()
+            if self.__is_disconnected:
+                sys.exit()
+
+    def reunion_tick(self):
+        """
+        One iteration of the reunion daemon.
+
+        :return:
+        """
+        with self.state_lock:
+            t = self.clock.time()
+            self._forget_routes()
+            reunion_packet = self.packet_factory.new_reunion_packet('REQ', source_address=self.server_address,
+                                                                    nodes_array=[self.server_address],
+                                                                    topic_filter=self._subtree_topic_filter())
             if self._reunion_mode == 'pending':
                 #if not self.__is_disconneted:
                     #print('No response after {} seconds...'.format(t - self.last_reunion_time))
                 if t - self.last_reunion_time > self.valid_time:
-                    print('Elapsed time is more than {} sec. Trying to advertise again...'.format(self.valid_time))
-                    adv_packet = self.packet_factory.new_advertise_packet('REQ', self.server_address)
+                    reunion_log.warning('Elapsed time is more than %s sec. Trying to advertise again...',
+                                        self.valid_time)
+                    self._reunion_failures.inc()
+                    if not self._advertise_now():
+                        log.error('Can not advertise to root!')
+                        self.__is_disconnected = True
+                else:
+                    # Our last Hello may have been lost while the path to the root was repaired; try again, but
+                    # keep counting from the first Hello.
                     try:
-                        self.stream.add_message_to_out_buff(self.root_address, adv_packet.get_buf(), True)
-                        try:
-                            self.stream.send_messages_to_node(
-                                self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True))
-                        except Exception:
-                            print('Can not advertise to root!')
-                            self.__is_disconnected = True
-                            sys.exit()
+                        self.stream.add_message_to_out_buff(self.parent, reunion_packet.get_buf())
                     except Exception:
-                        print('Out buffer does not exist!')
+                        pass
 
             else:
-                reunion_packet = self.packet_factory.new_reunion_packet('REQ', source_address=self.server_address,
-                                                                        nodes_array=[self.server_address])
                 try:
                     self.stream.add_message_to_out_buff(self.parent, reunion_packet.get_buf())
                     self.last_reunion_time = t
@@ -195,10 +313,8 @@ class Client(Peer):
 
         """
         type = packet.get_type()
-        if verbosity == 1:
-            if type != 5:
-                print("Recvd packet body: ", packet.get_body())
-                print('Recvd packet type: ', type)
+        if type != 5:
+            packet_log.debug('Recvd packet type %s body: %s', type, packet.get_body())
         if type == 1:
             self._handle_register_packet(packet)
         elif type == 2:
@@ -209,6 +325,8 @@ class Client(Peer):
             self._handle_message_packet(packet)
         elif type == 5:
             self._handle_reunion_packet(packet)
+        elif type == 7:
+            self._handle_shortcut_packet(packet)
         else:
             raise NotImplemented
 
@@ -249,15 +367,18 @@ class Client(Peer):
             parent_port = int(body[-5:])
             join_pack = self.packet_factory.new_join_packet(self.server_address)
             parent_address = (parent_ip, parent_port)
-            print('parent address: ', parent_address)
+            log.info('parent address: %s', parent_address)
             self.user_interface.printer.append('parent address: (%s, %d)' % (parent_address[0], parent_address[1]))
             self.parent = parent_address
+            self._forget_shortcut(parent_address)
             self.stream.add_node(parent_address)
             self.stream.add_message_to_out_buff(parent_address, join_pack.get_buf())
             self._reunion_mode = 'acceptance'
             if not self.adv_sent:
                 self.adv_sent = True
-                self.t_reunion_daemon.start()
+                self.last_reunion_time = self.clock.time()
+                if self._start_threads:
+                    self.t_reunion_daemon.start()
             else:
                 prev_parent_node = self.stream.get_node_by_server(prev_parent[0], prev_parent[1], False)
                 if prev_parent_node is not None:
@@ -289,6 +410,8 @@ class Client(Peer):
             At first extract all addresses in the packet body and append them in descending order to the new packet.
             You should send the new packet to the first address in the arrived packet.
             If you are a non-root Peer append your IP/Port address to the end of the packet and send it to your parent.
+            Keep the topic filter of the child that sent it and put the filter of our subtree in its place.
+            Every address in it is reached through that child, see Peer._unicast_next_hop.
 
         Reunion Hello Back:
             Check that you are the end node or not; If not only remove your IP/Port address and send the packet to the next
@@ -310,10 +433,12 @@ class Client(Peer):
         length = len(entries)
         #print('reunion ' + type + ' ' +  entries)
         if type == 'REQ':
+            self._learn_topic_filter(packet)
             nodes_array = [(entries[i:i + 15], int(entries[i + 15:i + 20])) for i in range(0, length, 20)]
+            self._learn_routes(packet, nodes_array)
             nodes_array.append(self.server_address)
             reunion_packet = self.packet_factory. \
-                new_reunion_packet('REQ', self.server_address, nodes_array)
+                new_reunion_packet('REQ', self.server_address, nodes_array, self._subtree_topic_filter())
             try:
                 self.stream.add_message_to_out_buff(self.parent, message=reunion_packet.get_buf())
             except Exception:
@@ -321,6 +446,8 @@ class Client(Peer):
 
         elif type == 'RES':
             if length == 20:  # we are the end node!
+                if self._reunion_mode == 'pending':
+                    self._reunion_seconds.record(self.clock.time() - self.last_reunion_time)
                 self._reunion_mode = 'acceptance'
             else:  # we are not the end node! forward the packet!
                 entries = entries[20:]
@@ -329,10 +456,144 @@ class Client(Peer):
                 next_node_addr = nodes_array[0]
                 reunion_packet = self.packet_factory. \
                     new_reunion_packet('RES', self.server_address, nodes_array)
-                self.stream.add_message_to_out_buff(next_node_addr, message=reunion_packet.get_buf())
+                try:
+                    self.stream.add_message_to_out_buff(next_node_addr, message=reunion_packet.get_buf())
+                except Exception:
+                    pass  # The child has left us; it will advertise again when its Reunion fails
         else:
             raise NotImplementedError
 
+    def _send_unicast(self, destination, message):
+        """
+        Like Peer._send_unicast; after config.shortcut_after of them to one peer within config.shortcut_idle_time
+        seconds we ask for a shortcut to it.
+
+        :param destination: Server address of the peer.
+        :param message: The message.
+        :return:
+        """
+        super(Client, self)._send_unicast(destination, message)
+        if shortcut_after is None or self._is_shortcut(destination):
+            return
+        self._unicast_counts[destination] += 1
+        if self._unicast_counts[destination] >= shortcut_after:
+            del self._unicast_counts[destination]
+            self._request_shortcut(destination)
+
+    def _request_shortcut(self, address):
+        """
+        Ask the root for a shortcut to another client, if we have room for one more (config.shortcut_max).
+
+        :param address: Server address of the client.
+        :return: Whether the request was sent.
+        :rtype: bool
+        """
+        if address == self.server_address or self._is_shortcut(address) or \
+                len(self.shortcuts) + len(self.pending_shortcuts) >= shortcut_max or \
+                self.stream.get_node_by_server(address[0], address[1]) is not None or \
+                self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True) is None:
+            return False
+        packet = self.packet_factory.new_shortcut_packet('REQ', self.server_address, address)
+        self.stream.add_message_to_out_buff(self.root_address, packet.get_buf(), True)
+        return True
+
+    def _handle_shortcut_packet(self, packet):
+        """
+        RES: The root has answered our request; we connect to the other client and send it a Join.
+        JON: Another client wants a shortcut to us; we accept it if we have room for it.
+        ACK: The other client has accepted our shortcut.
+        FIN: The other client has closed our shortcut.
+
+        :param packet: Arrived shortcut packet
+        :type packet Packet
+
+        :return:
+        """
+        body = packet.get_body()
+        kind = body[:3]
+        source = (packet.get_source_server_ip(), packet.get_source_server_port())
+        now = self.clock.time()
+        if kind == 'RES':
+            address = (body[6:21], int(body[21:26]))
+            if body[3:6] != 'ACK':
+                log.info('The root has refused a shortcut to %s', address)
+                return
+            if self._is_shortcut(address) or len(self.shortcuts) + len(self.pending_shortcuts) >= shortcut_max or \
+                    self.stream.get_node_by_server(address[0], address[1]) is not None:
+                return
+            self.stream.add_node(address)
+            self.pending_shortcuts[address] = now
+            join_packet = self.packet_factory.new_shortcut_packet('JON', self.server_address)
+            self.stream.add_message_to_out_buff(address, join_packet.get_buf())
+        elif kind == 'JON':
+            if self._is_shortcut(source) or len(self.shortcuts) + len(self.pending_shortcuts) >= shortcut_max or \
+                    self.stream.get_node_by_server(source[0], source[1]) is not None:
+                return
+            self.stream.add_node(source)
+            self.shortcuts[source] = now
+            ack_packet = self.packet_factory.new_shortcut_packet('ACK', self.server_address)
+            self.stream.add_message_to_out_buff(source, ack_packet.get_buf())
+            log.info('shortcut from %s', source)
+        elif kind == 'ACK':
+            if self.pending_shortcuts.pop(source, None) is not None:
+                self.shortcuts[source] = now
+                log.info('shortcut to %s', source)
+        elif kind == 'FIN':
+            if self._is_shortcut(source):
+                self._close_shortcut(source, 'peer')
+
+    def _check_shortcuts(self, t):
+        """
+        Close the shortcuts idle for config.shortcut_idle_time seconds, the ones whose connection is broken, and
+        the ones the other client has not accepted in that time.
+
+        :param t: The current time.
+        :return:
+        """
+        for address, last_use in list(self.shortcuts.items()):
+            if self.stream.get_node_by_server(address[0], address[1]) is None:
+                self._close_shortcut(address, 'broken')
+            elif t - last_use > shortcut_idle_time:
+                self._close_shortcut(address, 'idle')
+        for address, join_time in list(self.pending_shortcuts.items()):
+            if t - join_time > shortcut_idle_time:
+                self._close_shortcut(address, 'refused')
+        if t - self._unicast_counts_since > shortcut_idle_time:
+            self._unicast_counts.clear()
+            self._unicast_counts_since = t
+
+    def _close_shortcut(self, address, reason):
+        """
+        Tell the other client (unless it has closed the shortcut itself) and drop our node of the shortcut.
+
+        :param address: Server address of the other client.
+        :param reason: 'idle', 'peer', 'broken' or 'refused'.
+        :return:
+        """
+        self._forget_shortcut(address)
+        self._shortcuts_closed[reason].inc()
+        node = self.stream.get_node_by_server(address[0], address[1])
+        if node is None:
+            return
+        if reason != 'peer':
+            fin_packet = self.packet_factory.new_shortcut_packet('FIN', self.server_address)
+            self.stream.add_message_to_out_buff(address, fin_packet.get_buf())
+            try:
+                self.stream.send_messages_to_node(node)
+            except Exception:
+                return  # the Stream has removed the node
+        self.stream.remove_node(node)
+
+    def _forget_shortcut(self, address):
+        """
+        The address is no longer a shortcut; e.g. it has become our parent or child, and keeps its node.
+
+        :param address: Server address of the other client.
+        :return:
+        """
+        self.shortcuts.pop(address, None)
+        self.pending_shortcuts.pop(address, None)
+
     def _handle_join_packet(self, packet):
         """
         When a Join packet received we should add a new node to our nodes array.
@@ -346,6 +607,7 @@ class Client(Peer):
         :return:
         """
         address = (packet.get_source_server_ip(), packet.get_source_server_port())
+        self._forget_shortcut(address)
         self.stream.add_node(address)
 
     def _handle_register_packet(self, packet):
@@ -368,14 +630,12 @@ class Client(Peer):
 
     def __send(self):
         disconnected_nodes = self.stream.send_out_buf_messages()
+        if self.root_address in disconnected_nodes and \
+                self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True) is None:
+            self._fail_over_root()
         if self.parent in disconnected_nodes:
-            adv_packet = self.packet_factory.new_advertise_packet('REQ', self.server_address)
-            self.stream.add_message_to_out_buff(self.root_address, adv_packet.get_buf(), True)
-            print('sending advertise to root...')
-            try:
-                self.stream.send_messages_to_node(
-                    self.stream.get_node_by_server(self.root_address[0], self.root_address[1], True))
-            except Exception:
-                print('Can not advertise to root!')
+            log.info('sending advertise to root...')
+            if not self._advertise_now():
+                log.error('Can not advertise to root!')
                 self.__is_disconnected = True
 
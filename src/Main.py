@@ -0,0 +1,91 @@
+from config import root_port, client_port, has_GUI, root_snapshot_path
+from tools.SemiNode import SemiNode
+import argparse
+import threading
+import time
+
+"""
+    Start one peer from the command line, e.g. a root and a headless client that joins the network by itself:
+        python Main.py root --ip 192.168.0.1 --port 44331 --ui daemon
+        python Main.py client --ip 192.168.0.2 --port 55501 --root 192.168.0.1:44331 --ui daemon --join
+
+    Main_root.py and Main_client.py are the same with the addresses in the code and the GUI of config.has_GUI.
+    Only the role we start is imported, and Tk only by the 'gui' UI.
+"""
+
+
+def parse_address(text):
+    """
+    :param text: 'ip:port'
+    :rtype: tuple
+    """
+    ip, port = text.rsplit(':', 1)
+    return SemiNode.parse_ip(ip), int(port)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Run a root or a client peer.')
+    parser.add_argument('role', choices=('root', 'client'))
+    parser.add_argument('--ip', help='Our server IP; 192.168.0.1 for a root and 192.168.0.2 for a client by default.')
+    parser.add_argument('--port', type=int, help='Our server port; config.root_port or config.client_port by default.')
+    parser.add_argument('--root', action='append', type=parse_address, metavar='IP:PORT',
+                        help='Root address of a client; repeat it for the standby roots to fail over to.')
+    parser.add_argument('--standby-of', type=parse_address, metavar='IP:PORT',
+                        help='Run the root as a standby of this primary root.')
+    parser.add_argument('--ui', choices=('gui', 'console', 'daemon'), default='gui' if has_GUI else 'console',
+                        help="'daemon' reads no commands and logs what the other UIs would print.")
+    parser.add_argument('--join', action='store_true',
+                        help='Register and Advertise right away, like pressing the buttons of the GUI.')
+    parser.add_argument('--snapshot', default=root_snapshot_path, metavar='PATH',
+                        help='Keep the root state in this snapshot and warm restart from it, see Root.')
+    parser.add_argument('--metrics-port', type=int, help='Serve our metrics on this port, see Peer.')
+    options = parser.parse_args(args)
+    if options.role == 'client' and not options.root:
+        parser.error('a client needs --root')
+    return options
+
+
+def join_network(client):
+    """
+    Register at the root and Advertise once the root has answered.
+
+    :type client: Client.Client
+    :return:
+    """
+    client.user_interface.buffer.append('Register')
+    while not client.is_registered:
+        if client.is_disconnected():
+            return
+        time.sleep(0.5)
+    client.user_interface.buffer.append('Advertise')
+
+
+def main(args=None):
+    options = parse_args(args)
+    from UserInterface import UserInterface
+    if options.role == 'root':
+        from Root import Root
+        address = (SemiNode.parse_ip(options.ip or '192.168.0.1'), options.port or root_port)
+        user_interface = UserInterface(address, mode=options.ui)
+        peer = Root(address[0], address[1], user_interface, standby_of=options.standby_of,
+                    snapshot_path=options.snapshot)
+    else:
+        from Client import Client
+        address = (SemiNode.parse_ip(options.ip or '192.168.0.2'), options.port or client_port)
+        user_interface = UserInterface(address, mode=options.ui)
+        root_address = options.root[0] if len(options.root) == 1 else options.root
+        peer = Client(address[0], address[1], user_interface, root_address=root_address)
+    if options.metrics_port is not None:
+        peer.start_metrics_server(options.metrics_port)
+    if options.join and options.role == 'client':
+        join_network(peer)
+    # The GUI must own the main thread; the console reads stdin in its own thread.
+    if options.ui == 'gui':
+        user_interface.run()
+    elif options.ui == 'console':
+        threading.Thread(target=user_interface.run, daemon=True).start()
+    peer.join()
+
+
+if __name__ == '__main__':
+    main()
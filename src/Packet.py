@@ -20,7 +20,16 @@
         3: Join
         4: Message
         5: Reunion
+        6: Replication
+        7: Shortcut
                 e.g: type = '2' => Advertise packet.
+        The high byte of the field holds flags, the low byte is the type above:
+        0x01: Trace; the Message body ends with a trace trailer (see below).
+        0x02: Origin; the Message body is followed by the origin trailer (see below).
+        0x04: Topic; the Message body is followed by the topic trailer, the Reunion Hello body by the topic filter
+              trailer (see below).
+        0x08: Destination; the Message goes to one peer only, its body is followed by the destination trailer (see
+              below).
     Length:
         This field shows the character numbers for Body of the packet.
     Server IP/Port:
@@ -85,6 +94,50 @@
                 |             Message (#Length Chars)            |
                 |________________________________________________|
             The message that want to broadcast to hole network. Right now this type only includes a plain text.
+            With the Trace flag the body is followed by the trace trailer:
+                 ________________________________________________
+                |                 IP0 (15 Chars)                 |
+                |------------------------------------------------|
+                |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |     Receive Time0 (16 Chars, microseconds)     |
+                |------------------------------------------------|
+                |     Forward Time0 (16 Chars, microseconds)     |
+                |------------------------------------------------|
+                |                     ...                        |
+                |------------------------------------------------|
+                |           Number of Entries (2 Chars)          |
+                |________________________________________________|
+            Entry 0 is the origin of the message; every relay appends its own entry before forwarding. The forward
+            time of the last entry is written again when the frame leaves our out buffer (see Stream), so it is the
+            send time of the copy to that neighbour. Times are wall clock microseconds since the epoch, so the hosts
+            should have synchronized clocks.
+            With the Origin flag the body is followed by the origin trailer, before a trace trailer if there is one:
+                 ________________________________________________
+                |                 IP (15 Chars)                  |
+                |------------------------------------------------|
+                |                 Port (5 Chars)                 |
+                |________________________________________________|
+            The server address of the peer that broadcast the message; relays keep it, while Source Server IP/Port
+            is the last hop.
+            With the Topic flag the body is followed by the topic trailer, before the other trailers:
+                 ________________________________________________
+                |              Topic (#n Chars)                  |
+                |------------------------------------------------|
+                |               n (2 Chars)                      |
+                |________________________________________________|
+            Only the peers that subscribed to the topic show the message, and relays forward it only into the
+            subtrees whose topic filter may have it.
+            With the Destination flag the body is followed by the destination trailer, after the topic trailer and
+            before the origin trailer:
+                 ________________________________________________
+                |                 IP (15 Chars)                  |
+                |------------------------------------------------|
+                |                 Port (5 Chars)                 |
+                |________________________________________________|
+            The message is not broadcast; every peer sends it one hop closer to the destination: down to the child
+            whose subtree has it (learned from the Reunion Hellos it relays), else up to its parent. The root finds
+            the child in its NetworkGraph. A unicast message that came from the parent only goes down.
         Reunion:
             Hello:
                                 ** Body Format **
@@ -110,6 +163,17 @@
                 In every interval (for now 20 seconds) peers must send this message to the root.
                 Every other peer that received this packet should append their (IP, port) to
                 the packet and update Length.
+                With the Topic flag the entries are followed by the topic filter trailer:
+                 ________________________________________________
+                |          Bits (#Size / 4 Chars, hex)           |
+                |------------------------------------------------|
+                |               Hashes (1 Char)                  |
+                |------------------------------------------------|
+                |                Size (5 Chars)                  |
+                |________________________________________________|
+                The Bloom filter (see tools/BloomFilter.py) of the topics subscribed in the subtree of the last
+                hop; every relay keeps it for that child and puts the filter of its own subtree in its place.
+                Without the flag the subtree of the last hop may want any topic.
             Hello Back:
                                     ** Body Format **
                  ________________________________________________
@@ -133,12 +197,97 @@
                 |________________________________________________|
                 Root in an answer to the Reunion Hello message will send this packet to the target node.
                 In this packet, all the nodes (IP, port) exist in order by path traversal to target.
+        Replication:
+                                ** Body Format **
+                 ________________________________________________
+                |                  Kind (3 Chars)                |
+                |------------------------------------------------|
+                |           Payload (#Length - 3 Chars)          |
+                |________________________________________________|
+                Between the primary root and its standby roots, through the standby register_connection.
+                    SUB: Standby -> primary; asks for the replication stream. No payload.
+                    SNP: Primary -> standby; the whole root state as a JSON snapshot (see RootSnapshot).
+                    LOG: Primary -> standby; one JSON change log entry (see RootSnapshot).
+                    HBT: Primary -> standby; heartbeat, the primary is alive. No payload.
+        Shortcut:
+                                ** Body Format **
+                 ________________________________________________
+                |                  Kind (3 Chars)                |
+                |------------------------------------------------|
+                |       ACK/NAK (3 Chars, only in RES)           |
+                |------------------------------------------------|
+                |         IP (15 Chars, only in REQ, RES)        |
+                |------------------------------------------------|
+                |        Port (5 Chars, only in REQ, RES)        |
+                |________________________________________________|
+                A direct connection between two clients for their unicast Messages only; Message broadcasts and
+                Reunion packets never use it.
+                    REQ: Client -> root, through the register_connection; asks for a shortcut to IP/Port.
+                    RES: Root -> client; ACK if IP/Port is a live client that is not our tree neighbour already.
+                    JON: Client -> the other client, through the new connection; makes the shortcut.
+                    ACK: The other client has accepted the shortcut; it sends nothing if it has no room for it.
+                    FIN: Either client -> the other one; the shortcut was idle and is closed.
 """
 from struct import *
 
+from tools.BloomFilter import BloomFilter
+
+TRACE_FLAG = 0x01
+ORIGIN_FLAG = 0x02
+TOPIC_FLAG = 0x04
+DESTINATION_FLAG = 0x08
+# IP (15), Port (5) of the origin and destination trailers.
+ADDRESS_LENGTH = 20
+# IP (15), Port (5), Receive Time (16), Forward Time (16)
+TRACE_ENTRY_LENGTH = 52
+HEADER_LENGTH = 20
+# Version, flags, type, length, IP (four 2-byte numbers, kept raw) and port.
+HEADER_STRUCT = Struct('>HBBI8sI')
+# Batches smaller than this are decoded with HEADER_STRUCT even if NumPy is there; NumPy only pays off for big ones.
+NUMPY_MIN_BATCH = 64
+
+_numpy = None
+# Raw 8 header bytes of a source IP -> its '192.168.001.001' form; a network has few distinct senders.
+_ip_cache = {}
+
+
+def _get_numpy():
+    """
+    NumPy is optional and slow to import, so it is imported with the first big batch.
+
+    :return: The numpy module, or False if it is not installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def _format_ip(raw):
+    """
+    :param raw: The 8 IP bytes of a header.
+    :rtype: str
+    """
+    ip = _ip_cache.get(raw)
+    if ip is None:
+        if len(_ip_cache) > 65536:
+            _ip_cache.clear()
+        ip = _ip_cache[raw] = '.'.join(str(int.from_bytes(raw[i:i + 2], byteorder='big')).zfill(3)
+                                       for i in range(0, 8, 2))
+    return ip
+
 
 class Packet:
-    def __init__(self, version, type, length, source_ip, source_port, body):
+    # A root parses a Packet per frame; slots keep them small.
+    __slots__ = ('version', 'type', 'length', 'source_ip', 'source_port', 'body', 'flags', 'trace', 'origin',
+                 'topic', 'topic_filter', 'destination', 'receive_time')
+
+    def __init__(self, version, type, length, source_ip, source_port, body, flags=0, trace=None, origin=None,
+                 topic=None, topic_filter=None, destination=None):
         '''
         :param header: bytes
         :param version: '1'
@@ -147,6 +296,15 @@ class Packet:
         :param source_ip:
         :param source_port:
         :param body:
+        :param flags: The high byte of the type field, like TRACE_FLAG.
+        :param trace: [((ip, port), receive time, forward time), ...] of a traced Message; the trailer is not part of
+                      body and length.
+        :param origin: (ip, port) of the peer that broadcast a Message; like trace, not part of body and length.
+        :param topic: Topic of a Message; like trace, not part of body and length.
+        :param topic_filter: BloomFilter of the topics in the subtree of the sender of a Reunion Hello; like trace,
+                             not part of body and length.
+        :param destination: (ip, port) of the only peer a unicast Message is for; like trace, not part of body and
+                            length.
         '''
         self.version = version
         self.type = type
@@ -155,6 +313,14 @@ class Packet:
         self.source_ip = source_ip
         self.source_port = source_port
         self.body = body
+        self.flags = flags
+        self.trace = trace
+        self.origin = origin
+        self.topic = topic
+        self.topic_filter = topic_filter
+        self.destination = destination
+        # Set by Peer to the time our Stream received the frame.
+        self.receive_time = None
 
     def get_version(self):
         """
@@ -184,24 +350,215 @@ class Packet:
         """
         return self.body
 
+    def get_flags(self):
+        """
+        :return: Packet flags
+        :rtype: int
+        """
+        return self.flags
+
+    def get_trace(self):
+        """
+        :return: Trace entries of a traced Message, or None.
+        :rtype: list
+        """
+        return self.trace
+
+    def set_trace(self, trace):
+        """
+        Make this a traced packet with these trace entries, or an untraced one with None.
+
+        :param trace: See __init__.
+        :return:
+        """
+        self.trace = trace
+        if trace is None:
+            self.flags &= ~TRACE_FLAG
+        else:
+            self.flags |= TRACE_FLAG
+
+    def get_origin(self):
+        """
+        :return: Server address of the peer that broadcast this Message, or None if it is not known.
+        :rtype: tuple
+        """
+        return self.origin
+
+    def set_origin(self, origin):
+        """
+        :param origin: See __init__; None takes the origin trailer away.
+        :return:
+        """
+        self.origin = origin
+        if origin is None:
+            self.flags &= ~ORIGIN_FLAG
+        else:
+            self.flags |= ORIGIN_FLAG
+
+    def get_topic(self):
+        """
+        :return: Topic of this Message, or None if it is for everybody.
+        :rtype: str
+        """
+        return self.topic
+
+    def set_topic(self, topic):
+        """
+        :param topic: See __init__; at most 99 Chars. None takes the topic trailer away.
+        :return:
+        """
+        self.topic = topic
+        if topic is None and self.topic_filter is None:
+            self.flags &= ~TOPIC_FLAG
+        else:
+            self.flags |= TOPIC_FLAG
+
+    def get_topic_filter(self):
+        """
+        :return: BloomFilter of the topics in the subtree of the sender of this Reunion Hello, or None if any topic.
+        :rtype: BloomFilter
+        """
+        return self.topic_filter
+
+    def set_topic_filter(self, topic_filter):
+        """
+        :param topic_filter: See __init__; None takes the topic filter trailer away.
+        :return:
+        """
+        self.topic_filter = topic_filter
+        if topic_filter is None and self.topic is None:
+            self.flags &= ~TOPIC_FLAG
+        else:
+            self.flags |= TOPIC_FLAG
+
+    def get_destination(self):
+        """
+        :return: Server address of the only peer this unicast Message is for, or None for a broadcast one.
+        :rtype: tuple
+        """
+        return self.destination
+
+    def set_destination(self, destination):
+        """
+        :param destination: See __init__; None takes the destination trailer away.
+        :return:
+        """
+        self.destination = destination
+        if destination is None:
+            self.flags &= ~DESTINATION_FLAG
+        else:
+            self.flags |= DESTINATION_FLAG
+
     def get_buf(self):
         """
         In this function, we will make our final buffer that represents the Packet with the Struct class methods.
         :return The parsed packet to the network format.
         :rtype: bytes
         """
+        body = self.body
+        length = self.length
+        if self.topic is not None:
+            body += '{}{:02d}'.format(self.topic, len(self.topic))
+            length += len(self.topic) + 2
+        elif self.topic_filter is not None:
+            trailer = self.topic_filter.to_string()
+            body += trailer
+            length += len(trailer)
+        if self.destination is not None:
+            body += '{}{}'.format(self.destination[0], str(self.destination[1]).zfill(5))
+            length += ADDRESS_LENGTH
+        if self.origin is not None:
+            body += '{}{}'.format(self.origin[0], str(self.origin[1]).zfill(5))
+            length += ADDRESS_LENGTH
+        if self.trace is not None:
+            trailer = Packet._trace_trailer(self.trace)
+            body += trailer
+            length += len(trailer)
         buff = b''
         buff += self.version.to_bytes(length=2, byteorder='big')
-        buff += self.type.to_bytes(length=2, byteorder='big')
-        buff += self.length.to_bytes(length=4, byteorder='big')
+        buff += ((self.flags << 8) | self.type).to_bytes(length=2, byteorder='big')
+        buff += length.to_bytes(length=4, byteorder='big')
         ip_tokens = [int(x) for x in self.source_ip.split(sep='.')]
         for token in ip_tokens:
             buff += token.to_bytes(length=2, byteorder='big')
         buff += self.source_port.to_bytes(length=4, byteorder='big')
-        buff += bytes(self.body, 'utf-8')
+        buff += bytes(body, 'utf-8')
 
         return buff
 
+    @staticmethod
+    def _trace_trailer(trace):
+        entries = ''.join('{}{}{}{}'.format(ip, str(port).zfill(5), str(int(receive_time * 1e6)).zfill(16),
+                                            str(int(forward_time * 1e6)).zfill(16))
+                          for (ip, port), receive_time, forward_time in trace)
+        return entries + str(len(trace)).zfill(2)
+
+    @staticmethod
+    def set_forward_time(frame, forward_time):
+        """
+        The trace trailer is the end of the frame, so the forward time of its last entry is rewritten in place
+        without decoding the packet.
+
+        :param frame: A traced Message frame, as made by get_buf.
+        :param forward_time: Seconds since the epoch.
+        :type frame: bytes
+        :type forward_time: float
+
+        :return: The frame with this forward time in its last trace entry.
+        :rtype: bytes
+        """
+        return frame[:-18] + str(int(forward_time * 1e6)).zfill(16).encode('ascii') + frame[-2:]
+
+    @staticmethod
+    def _split_trace(body):
+        """
+        :param body: Body of a traced Message with its trace trailer.
+        :return: The body without the trailer and the trace entries; the trace is None if the trailer is broken.
+        :rtype: tuple
+        """
+        try:
+            count = int(body[-2:])
+            start = len(body) - 2 - count * TRACE_ENTRY_LENGTH
+            if start < 0:
+                return body, None
+            trace = []
+            for i in range(start, len(body) - 2, TRACE_ENTRY_LENGTH):
+                entry = body[i:i + TRACE_ENTRY_LENGTH]
+                trace.append(((entry[:15], int(entry[15:20])), int(entry[20:36]) / 1e6, int(entry[36:52]) / 1e6))
+            return body[:start], trace
+        except ValueError:
+            return body, None
+
+    @staticmethod
+    def _split_address(body):
+        """
+        :param body: Body of a Message with an origin or destination trailer last.
+        :return: The body without the trailer and its address; the address is None if the trailer is broken.
+        :rtype: tuple
+        """
+        if len(body) < ADDRESS_LENGTH:
+            return body, None
+        trailer = body[-ADDRESS_LENGTH:]
+        try:
+            return body[:-ADDRESS_LENGTH], (trailer[:15], int(trailer[15:]))
+        except ValueError:
+            return body, None
+
+    @staticmethod
+    def _split_topic(body):
+        """
+        :param body: Body of a Message with its topic trailer (and without the other trailers).
+        :return: The body without the trailer and the topic; the topic is None if the trailer is broken.
+        :rtype: tuple
+        """
+        try:
+            start = len(body) - 2 - int(body[-2:])
+        except ValueError:
+            return body, None
+        if start < 0:
+            return body, None
+        return body[:start], body[start:-2]
+
     def get_source_server_ip(self):
         """
         :return: Server IP address for the sender of the packet.
@@ -230,6 +587,78 @@ class Packet:
             return True
 
 
+class PacketBatch:
+    def __init__(self, frames, versions, flags, types, lengths, raw_ips, ports):
+        """
+        The headers of many frames decoded together, one list per header field (see PacketFactory.parse_batch).
+        Handlers can look at the columns, e.g. count the types, without making Packet objects; iterating the
+        batch makes the Packets, decoding each body only then.
+
+        :param frames: The frames, in order.
+        :param raw_ips: The 8 raw IP bytes of every header; source_ips formats them.
+        """
+        self.frames = frames
+        self.versions = versions
+        self.flags = flags
+        self.types = types
+        self.lengths = lengths
+        self.raw_ips = raw_ips
+        self.ports = ports
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def source_ips(self):
+        """
+        :rtype: list
+        """
+        return [_format_ip(raw) for raw in self.raw_ips]
+
+    def packet(self, i):
+        """
+        :param i: Index of a frame.
+        :return: Its Packet.
+        :rtype: Packet
+        """
+        length = self.lengths[i]
+        flags = self.flags[i]
+        body = self.frames[i][HEADER_LENGTH:HEADER_LENGTH + length].decode('utf-8')
+        trace = None
+        origin = None
+        if flags & TRACE_FLAG:
+            body, trace = Packet._split_trace(body)
+            length = len(body)
+            if trace is None:
+                flags &= ~TRACE_FLAG
+        if flags & ORIGIN_FLAG:
+            body, origin = Packet._split_address(body)
+            length = len(body)
+            if origin is None:
+                flags &= ~ORIGIN_FLAG
+        destination = None
+        if flags & DESTINATION_FLAG:
+            body, destination = Packet._split_address(body)
+            length = len(body)
+            if destination is None:
+                flags &= ~DESTINATION_FLAG
+        topic = topic_filter = None
+        if flags & TOPIC_FLAG:
+            if self.types[i] == 5:
+                body, topic_filter = BloomFilter.split_string(body)
+            else:
+                body, topic = Packet._split_topic(body)
+            length = len(body)
+            if topic is None and topic_filter is None:
+                flags &= ~TOPIC_FLAG
+        return Packet(self.versions[i], self.types[i], length, _format_ip(self.raw_ips[i]), self.ports[i], body,
+                      flags, trace, origin, topic, topic_filter, destination)
+
+    def __iter__(self):
+        for i in range(len(self.frames)):
+            yield self.packet(i)
+
+
 class PacketFactory:
     """
     This class is only for making Packet objects.
@@ -301,30 +730,49 @@ class PacketFactory:
 
 
     @staticmethod
-    def new_message_packet(message, source_server_address):
+    def new_message_packet(message, source_server_address, trace=None, origin=None, topic=None, destination=None):
         """
         Packet for sending a broadcast message to the whole network.
         :param message: Our message
         :param source_server_address: Server address of the packet sender.
+        :param trace: Trace entries for a traced message, see Packet.
+        :param origin: Server address of the peer that broadcast the message, see Packet.
+        :param topic: Topic of the message, see Packet; None for everybody.
+        :param destination: Server address of the only peer a unicast message is for, see Packet.
         :type message: str
         :type source_server_address: tuple
+        :type trace: list
+        :type origin: tuple
+        :type topic: str
+        :type destination: tuple
         :return: New Message packet.
         :rtype: Packet
         """
         source_ip , source_port = source_server_address
-        return Packet(type=4, version=1, length=len(message), source_ip=source_ip, source_port=source_port,
-                      body=message)
+        packet = Packet(type=4, version=1, length=len(message), source_ip=source_ip, source_port=source_port,
+                        body=message)
+        if trace is not None:
+            packet.set_trace(trace)
+        if origin is not None:
+            packet.set_origin(origin)
+        if topic is not None:
+            packet.set_topic(topic)
+        if destination is not None:
+            packet.set_destination(destination)
+        return packet
 
 
     @staticmethod
-    def new_reunion_packet(type, source_address, nodes_array):
+    def new_reunion_packet(type, source_address, nodes_array, topic_filter=None):
         """
         :param type: Reunion Hello (REQ) or Reunion Hello Back (RES)
         :param source_address: IP/Port address of the packet sender.
         :param nodes_array: [(ip0, port0), (ip1, port1), ...] It is the path to the 'destination'.
+        :param topic_filter: For a Reunion Hello, the topic filter of the subtree of the sender, see Packet.
         :type type: str
         :type source_address: tuple
         :type nodes_array: list
+        :type topic_filter: BloomFilter
         :return New reunion packet.
         :rtype Packet
         """
@@ -333,7 +781,50 @@ class PacketFactory:
         source_ip, source_port = source_address
         for (ip, port) in nodes_array:
             body = body + ip + str(port).zfill(5)
-        return Packet(type=5, version=1, length=len(body), source_ip=source_ip, source_port=source_port,
+        packet = Packet(type=5, version=1, length=len(body), source_ip=source_ip, source_port=source_port,
+                        body=body)
+        if topic_filter is not None:
+            packet.set_topic_filter(topic_filter)
+        return packet
+
+    @staticmethod
+    def new_shortcut_packet(kind, source_server_address, address=None, accepted=True):
+        """
+        :param kind: 'REQ', 'RES', 'JON', 'ACK' or 'FIN'
+        :param source_server_address: Server address of the packet sender.
+        :param address: The other client of the shortcut, for REQ and RES.
+        :param accepted: Whether the root allows the shortcut, for RES.
+        :type kind: str
+        :type source_server_address: tuple
+        :type address: tuple
+        :type accepted: bool
+        :return New shortcut packet.
+        :rtype Packet
+        """
+        source_ip, source_port = source_server_address
+        body = kind
+        if kind == 'RES':
+            body += 'ACK' if accepted else 'NAK'
+        if address is not None:
+            body += address[0] + str(address[1]).zfill(5)
+        return Packet(type=7, version=1, length=len(body), source_ip=source_ip, source_port=source_port,
+                      body=body)
+
+    @staticmethod
+    def new_replication_packet(kind, source_server_address, payload=''):
+        """
+        :param kind: 'SUB', 'SNP', 'LOG' or 'HBT'
+        :param source_server_address: Server address of the packet sender.
+        :param payload: JSON payload of SNP and LOG packets.
+        :type kind: str
+        :type source_server_address: tuple
+        :type payload: str
+        :return New replication packet.
+        :rtype Packet
+        """
+        source_ip, source_port = source_server_address
+        body = kind + payload
+        return Packet(type=6, version=1, length=len(body), source_ip=source_ip, source_port=source_port,
                       body=body)
 
     @staticmethod
@@ -344,18 +835,29 @@ class PacketFactory:
         :return new packet
         :rtype: list of Packet
         """
-        packets = []
-        for data in buffer:
-            header = data[:20]
-            version = int.from_bytes(header[:2], byteorder='big')
-            type = int.from_bytes(header[2:4], byteorder='big')
-            length = int.from_bytes(header[4:8], byteorder='big')
-            ip_token = header[8:16]
-            source_ip = '.'.join(
-                [str(int.from_bytes(ip_token[i:i+2], byteorder='big')).zfill(3) for i in range(0, 8, 2)]
-            )
-            source_port = int.from_bytes(header[16:20], byteorder='big')
-            body = data[20:20+length].decode('utf-8')
-            packets.append(Packet(version, type, length, source_ip, source_port, body))
-
-        return packets
+        return list(PacketFactory.parse_batch(buffer))
+
+    @staticmethod
+    def parse_batch(buffer):
+        """
+        Decode the headers of all frames at once: they are laid out one after another and read as one array of
+        records, with a NumPy structured dtype for big batches if NumPy is installed and with
+        HEADER_STRUCT.iter_unpack otherwise.
+
+        :param buffer: Frames, like our Stream in_buf.
+        :rtype: PacketBatch
+        """
+        frames = list(buffer)
+        if not frames:
+            return PacketBatch(frames, [], [], [], [], [], [])
+        headers = b''.join([frame[:HEADER_LENGTH] for frame in frames])
+        numpy = _get_numpy() if len(frames) >= NUMPY_MIN_BATCH else False
+        if numpy:
+            records = numpy.frombuffer(headers, dtype=numpy.dtype([
+                ('version', '>u2'), ('flags', 'u1'), ('type', 'u1'), ('length', '>u4'), ('ip', 'V8'),
+                ('port', '>u4')]))
+            return PacketBatch(frames, records['version'].tolist(), records['flags'].tolist(),
+                               records['type'].tolist(), records['length'].tolist(),
+                               [bytes(raw) for raw in records['ip'].tolist()], records['port'].tolist())
+        columns = [list(column) for column in zip(*HEADER_STRUCT.iter_unpack(headers))]
+        return PacketBatch(frames, *columns)
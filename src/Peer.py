@@ -3,9 +3,23 @@ from Packet import Packet, PacketFactory
 from UserInterface import UserInterface
 from tools.SemiNode import SemiNode
 from tools.NetworkGraph import NetworkGraph, GraphNode
+from tools.Metrics import MetricsServer
+from tools.Log import get_logger, setup_logging
+from tools.Profiler import profiler
+from tools.RateLimiter import RateLimiter
+from tools.BloomFilter import BloomFilter
+from tools.simpletcp.socketoptions import SocketOptions
+import collections
+import json
+import logging
 import time
 import threading
-from config import has_GUI
+from config import has_GUI, metrics_port, socket_profiles, rate_limit_origin, rate_limit_link, rate_limit_action, \
+    rate_limit_max_delayed, topic_filter_bits, topic_filter_hashes, unicast_route_ttl
+
+packet_log = get_logger('packet')
+message_log = get_logger('message')
+trace_log = get_logger('trace')
 
 """
     Peer is our main object in this project.
@@ -16,7 +30,8 @@ from config import has_GUI
 
 
 class Peer:
-    def __init__(self, server_ip, server_port, user_interface=None, is_root=False, root_address=None):
+    def __init__(self, server_ip, server_port, user_interface=None, is_root=False, root_address=None, stream=None,
+                 clock=None):
         """
         The Peer object constructor.
 
@@ -37,16 +52,202 @@ class Peer:
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
         :param root_address: Root IP/Port address if we are a client.
+        :param stream: Use this instead of a new Stream (e.g. the virtual transport of tools.Simulator).
+        :param clock: Anything with time() and sleep() like the time module, which is the default.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
         :type root_address: tuple
         """
+        setup_logging()
         self.server_address = (server_ip, server_port)
-        self.stream = Stream(server_ip, server_port)
+        self.parent = None  # address of the parent node which will be a tuple; None at the root
+        self.clock = clock if clock is not None else time
+        if stream is None:
+            socket_options = SocketOptions.from_dict(socket_profiles['root' if is_root else 'client'])
+            stream = Stream(server_ip, server_port, socket_options=socket_options)
+        self.stream = stream
         self.packet_factory = PacketFactory()
         self.user_interface = user_interface
+        # The metrics of our Stream and ours live in the same registry.
+        self.metrics = self.stream.metrics
+        self._packets_in = {}
+        self._main_loop_seconds = self.metrics.histogram('main_loop_seconds')
+        # Traces of the latest traced messages we received, see _record_trace.
+        self.traces = collections.deque(maxlen=100)
+        self._trace_queue_seconds = self.metrics.histogram('trace_hop_queue_seconds')
+        self._trace_network_seconds = self.metrics.histogram('trace_hop_network_seconds')
+        # Token buckets per origin and per link for the Messages we relay, see _handle_message_packet.
+        self.message_limiter = RateLimiter(rate_limit_origin, rate_limit_link, rate_limit_action,
+                                           rate_limit_max_delayed, metrics=self.metrics)
+        # Our topics, and the topic filters of our children learned from their Reunion Hellos; see _forwards_topic.
+        self.subscriptions = set()
+        self.topic_filters = {}
+        self._topic_filtered = self.metrics.counter('topic_messages_filtered_total')
+        # Destination -> (our child whose subtree has it, time), learned from Reunion Hellos; see _unicast_next_hop.
+        self.unicast_routes = {}
+        self._unicast = {result: self.metrics.counter('unicast_messages_total', result=result)
+                         for result in ('delivered', 'forwarded', 'dropped')}
+        # Direct connections to other clients for unicast Messages only (see Client._request_shortcut): address ->
+        # last use time of the accepted ones, and address -> Join time of the ones not accepted yet.
+        self.shortcuts = {}
+        self.pending_shortcuts = {}
+        # Held by the main loop while it handles packets and commands and by the reunion daemon while it works, so
+        # neither sees our state (the graph at the root; topic filters, routes and shortcuts everywhere) half changed
+        # by the other.
+        self.state_lock = threading.Lock()
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.start_metrics_server(metrics_port)
+        # SIGUSR1 toggles the profiler, see tools/Profiler.py.
+        profiler.install_signal_handler()
+
+    def join(self):
+        """
+        Wait until our main loop and reunion daemon threads end; the constructors start them and return.
+
+        :return:
+        """
+        t_run = getattr(self, 't_run', None)
+        if t_run is None:
+            return
+        t_run.join()
+        # The reunion daemon of a client only starts with its first Advertise Response, if ever.
+        t_reunion = getattr(self, 't_run_reunion_daemon', None) or getattr(self, 't_reunion_daemon', None)
+        if t_reunion is not None and t_reunion.ident is not None:
+            t_reunion.join()
+
+    def start_metrics_server(self, port):
+        """
+        Serve our metrics in plain text on http://127.0.0.1:port/.
+
+        :param port:
+        :return:
+        """
+        if self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics, port)
+
+    def start_profiler(self, mode=None, interval=None):
+        """
+        Start profiling our main loop, reunion daemon and Stream server threads (and those of the other peers in
+        this process).
+
+        :param mode: 'sample' or 'cprofile', see tools/Profiler.py.
+        :param interval: Seconds between stack samples in 'sample' mode.
+        :return: Whether the profiler was started; it may already be running.
+        """
+        return profiler.start(mode, interval)
+
+    def stop_profiler(self, path=None):
+        """
+        :param path: File for the per-thread stats; config.profile_path by default.
+        :return: The path written, or None if the profiler was not running.
+        """
+        return profiler.stop(path)
+
+    def _handle_profile_command(self, args):
+        """
+        'profile start [sample|cprofile]' or 'profile stop [path]' from our UserInterface.
+
+        :param args: The command words after 'profile'.
+        :type args: list
+        :return:
+        """
+        if args[:1] == ['start'] and (len(args) == 1 or args[1] in ('sample', 'cprofile')):
+            if not self.start_profiler(args[1] if len(args) > 1 else None):
+                self.user_interface.printer.append('The profiler is already running.')
+        elif args[:1] == ['stop']:
+            path = self.stop_profiler(args[1] if len(args) > 1 else None)
+            self.user_interface.printer.append('Profile written to {}'.format(path) if path is not None
+                                               else 'The profiler is not running.')
+
+    def _handle_topic_command(self, args):
+        """
+        'subscribe <topic>', 'unsubscribe <topic>' and 'publish <topic> <message>'.
+
+        :param args: The split command.
+        :return:
+        """
+        if args[0] == 'subscribe' and len(args) == 2:
+            self.subscriptions.add(args[1])
+        elif args[0] == 'unsubscribe' and len(args) == 2:
+            self.subscriptions.discard(args[1])
+        elif args[0] == 'publish' and len(args) == 3 and len(args[1]) < 100:
+            self._broadcast_message(args[2], topic=args[1])
+
+    def _handle_sendto_command(self, args):
+        """
+        'sendto <ip> <port> <message>'.
+
+        :param args: The split command.
+        :return:
+        """
+        if len(args) != 4:
+            return
+        try:
+            destination = (SemiNode.parse_ip(args[1]), int(args[2]))
+        except ValueError:
+            return
+        self._send_unicast(destination, args[3])
+
+    def _send_unicast(self, destination, message):
+        """
+        Send a new Message packet made by us to one peer only, over the tree.
+
+        :param destination: Server address of the peer.
+        :param message: The message.
+        :return:
+        """
+        packet = self.packet_factory.new_message_packet(message, self.server_address, origin=self.server_address,
+                                                        destination=destination)
+        self._route_unicast(packet, None)
+
+    def _read_packets(self):
+        """
+        Parse our Stream in_buf; every packet knows when its frame was received.
+
+        Warnings:
+            1. Don't forget to clear the Stream in_buf when the packets are handled.
+
+        :return: The packets.
+        :rtype: list
+        """
+        in_buff = self.stream.read_in_buf()
+        batch = self.packet_factory.parse_batch(in_buff)
+        self._count_packets_in(batch.types)
+        packets = list(batch)
+        for packet, receive_time in zip(packets, self.stream.read_in_times()):
+            packet.receive_time = receive_time
+        return packets
+
+    def _broadcast_message(self, message, trace=False, topic=None):
+        """
+        Broadcast a new Message packet made by us.
+
+        :param message: The message.
+        :param trace: Whether the message should collect a trace of its hops.
+        :param topic: Only for the subscribers of this topic, or None for everybody.
+        :return:
+        """
+        now = self.clock.time()
+        trace_entries = [(self.server_address, now, now)] if trace else None
+        packet = self.packet_factory.new_message_packet(message, source_server_address=self.server_address,
+                                                        trace=trace_entries, origin=self.server_address,
+                                                        topic=topic)
+        self.send_broadcast_packet(packet)
+
+    def _count_packets_in(self, types):
+        """
+        :param types: The types column of the PacketBatch parsed from our Stream in_buf.
+        :type types: list
+        :return:
+        """
+        for packet_type, count in collections.Counter(types).items():
+            counter = self._packets_in.get(packet_type)
+            if counter is None:
+                counter = self._packets_in[packet_type] = self.metrics.counter('packets_in_total', type=packet_type)
+            counter.inc(count)
 
     def start_user_interface(self):
         """
@@ -54,7 +255,7 @@ class Peer:
 
         :return:
         """
-        if not has_GUI:
+        if not has_GUI and self.user_interface is None:
             self.user_interface = UserInterface(self.server_address)
             t_run_ui = threading.Thread(target=self.user_interface.run, args=())
             t_run_ui.start()
@@ -67,6 +268,10 @@ class Peer:
             1. Register:  With this command, the client send a Register Request packet to the root of the network.
             2. Advertise: Send an Advertise Request to the root of the network for finding first hope.
             3. SendMessage: The following string will be added to a new Message packet and broadcast through the network.
+            4. trace: Like SendMessage, but the message collects the times of its hops (see Packet and TraceReport).
+            5. profile: 'profile start [sample|cprofile]' and 'profile stop [path]', see start_profiler.
+            6. subscribe, unsubscribe and publish: Topics, see _handle_topic_command.
+            7. sendto: 'sendto <ip> <port> <message>' sends the message to that peer only, see _send_unicast.
 
         Warnings:
             1. Ignore irregular commands from the user.
@@ -135,8 +340,10 @@ class Peer:
 
         :return:
         """
+        topic = broadcast_packet.get_topic()
         for node in self.stream.nodes:
-            if not node.is_register:
+            if not node.is_register and not self._is_shortcut(node.get_server_address()) and \
+                    self._forwards_topic(node.get_server_address(), topic):
                 self.stream.add_message_to_out_buff(node.get_server_address(), message=broadcast_packet.get_buf())
 
     def handle_packet(self, packet):
@@ -154,8 +361,7 @@ class Peer:
         """
         type = packet.get_type()
         if type != 5:
-            print("Recvd packet body: ", packet.get_body())
-            print('Recvd packet type: ', type)
+            packet_log.debug('Recvd packet type %s body: %s', type, packet.get_body())
         if type == 1:
             self._handle_register_packet(packet)
         elif type == 2:
@@ -166,6 +372,8 @@ class Peer:
             self._handle_message_packet(packet)
         elif type == 5:
             self._handle_reunion_packet(packet)
+        elif type == 7:
+            self._handle_shortcut_packet(packet)
         else:
             raise NotImplemented
 
@@ -198,7 +406,7 @@ class Peer:
 
         :return:
         """
-        print('handle advertise of Peer')
+        packet_log.debug('handle advertise of Peer')
         pass
 
     def _handle_register_packet(self, packet):
@@ -216,7 +424,7 @@ class Peer:
         :type packet Packet
         :return:
         """
-        print('handle register of Peer...')
+        packet_log.debug('handle register of Peer...')
         pass
 
     def _check_neighbour(self, address):
@@ -238,6 +446,25 @@ class Peer:
     def _handle_join_packet(self, packet):
         pass
 
+    def _handle_shortcut_packet(self, packet):
+        """
+        The root allows shortcuts (REQ), clients make and close them (RES, JON, ACK, FIN); see Packet.
+
+        :param packet: Arrived shortcut packet
+        :type packet Packet
+
+        :return:
+        """
+        pass
+
+    def _is_shortcut(self, address):
+        """
+        :param address: Server address of one of our nodes.
+        :return: Whether the node is a shortcut (accepted or not yet) rather than a tree neighbour.
+        :rtype: bool
+        """
+        return address in self.shortcuts or address in self.pending_shortcuts
+
     def _handle_message_packet(self, packet):
         """
                 Only broadcast message to the other nodes.
@@ -246,6 +473,9 @@ class Peer:
                     1. Do not forget to ignore messages from unknown sources.
                     2. Make sure that you are not sending a message to a register_connection.
 
+                Over our rate limits (config.rate_limit_*) the message is dropped, or held for
+                _handle_delayed_messages.
+
                 :param packet: Arrived message packet
 
                 :type packet Packet
@@ -253,15 +483,205 @@ class Peer:
                 :return:
                 """
         source_address = (packet.get_source_server_ip(), int(packet.get_source_server_port()))
-        print('Recvd Msg packet {} from {}: '.format(packet.get_body(), source_address))
-        self.user_interface.printer.append('{}: {}'.format(source_address, packet.get_body()))
-        brdcast_packet = self.packet_factory.new_message_packet(packet.get_body(), self.server_address)
-        if source_address in [node.get_server_address() for node in self.stream.nodes]:
+        origin = packet.get_origin() or source_address
+        if self.message_limiter.admit(origin, source_address, packet, self.clock.time()):
+            self._relay_message(packet)
+
+    def _relay_message(self, packet):
+        """
+        Show a Message packet that has passed our rate limits and forward it to our other neighbours.
+
+        :param packet: Arrived message packet
+        :type packet Packet
+
+        :return:
+        """
+        source_address = (packet.get_source_server_ip(), int(packet.get_source_server_port()))
+        if packet.get_destination() is not None:
+            if self.stream.get_node_by_server(source_address[0], source_address[1]) is not None:
+                self._route_unicast(packet, source_address)
+            return
+        message_log.debug('Recvd Msg packet %s from %s', packet.get_body(), source_address)
+        topic = packet.get_topic()
+        if topic is None or topic in self.subscriptions:
+            self.user_interface.printer.append('{}: {}'.format(source_address, packet.get_body()))
+        brdcast_packet = self.packet_factory.new_message_packet(packet.get_body(), self.server_address,
+                                                                origin=packet.get_origin(), topic=topic)
+        if self.stream.get_node_by_server(source_address[0], source_address[1]) is not None:
+            if packet.get_trace() is not None:
+                now = self.clock.time()
+                receive_time = packet.receive_time if packet.receive_time is not None else now
+                # Our forward time; Stream writes the send time over it as every copy leaves its out buffer.
+                trace = packet.get_trace() + [(self.server_address, receive_time, now)]
+                brdcast_packet.set_trace(trace)
+                self._record_trace(packet.get_body(), trace)
             for node in self.stream.nodes:
                 node_address = node.get_server_address()
-                if node_address != source_address and not node.is_register:
+                if node_address != source_address and not node.is_register and \
+                        not self._is_shortcut(node_address) and self._forwards_topic(node_address, topic):
                     self.stream.add_message_to_out_buff(address=node_address, message=brdcast_packet.get_buf())
 
+    def _handle_delayed_messages(self):
+        """
+        Relay the Message packets our rate limiter held back and that have got their tokens by now.
+
+        :return:
+        """
+        for packet in self.message_limiter.release(self.clock.time()):
+            self._relay_message(packet)
+
+    def _route_unicast(self, packet, source_address):
+        """
+        Show a unicast Message packet if it is for us, otherwise send it one hop closer to its destination.
+
+        :param packet: The unicast Message packet.
+        :param source_address: The neighbour it came from, or None if it is ours.
+        :return:
+        """
+        destination = packet.get_destination()
+        if source_address in self.shortcuts:
+            self.shortcuts[source_address] = self.clock.time()
+        if destination == self.server_address:
+            self.user_interface.printer.append('{}: {}'.format(packet.get_origin() or source_address,
+                                                               packet.get_body()))
+            self._unicast['delivered'].inc()
+            return
+        next_hop = self._unicast_next_hop(destination, source_address)
+        if next_hop is None:
+            message_log.debug('No route to %s for a unicast Msg from %s', destination, source_address)
+            self._unicast['dropped'].inc()
+            return
+        unicast_packet = self.packet_factory.new_message_packet(packet.get_body(), self.server_address,
+                                                                origin=packet.get_origin(), destination=destination)
+        self.stream.add_message_to_out_buff(next_hop, message=unicast_packet.get_buf())
+        self._unicast['forwarded'].inc()
+        if next_hop in self.shortcuts:
+            self.shortcuts[next_hop] = self.clock.time()
+
+    def _unicast_next_hop(self, destination, source_address):
+        """
+        The next hop of a unicast Message: the destination if it is our neighbour (or shortcut), else the child whose
+        subtree has it, else our parent. A Message never goes back to where it came from, and one that came down from our parent
+        only goes on down, so a stale route can not make a loop.
+
+        :param destination: Server address of the destination.
+        :param source_address: The neighbour the Message came from, or None if it is ours.
+        :return: Server address of the next hop, or None if we have no route.
+        :rtype: tuple
+        """
+        if self.stream.get_node_by_server(destination[0], destination[1]) is not None and \
+                destination not in self.pending_shortcuts:
+            return destination
+        route = self.unicast_routes.get(destination)
+        if route is not None:
+            child, learned = route
+            if self.clock.time() - learned <= unicast_route_ttl and child != source_address and \
+                    self.stream.get_node_by_server(child[0], child[1]) is not None:
+                return child
+        if source_address is not None and source_address == self.parent:
+            return None
+        return self.parent
+
+    def _learn_routes(self, packet, nodes_array):
+        """
+        Every peer on the path of a Reunion Hello is in the subtree of the child that has sent it to us.
+
+        :param packet: Arrived Reunion Hello.
+        :param nodes_array: The addresses in its body.
+        :return:
+        """
+        child = (packet.get_source_server_ip(), int(packet.get_source_server_port()))
+        now = self.clock.time()
+        for address in nodes_array:
+            self.unicast_routes[address] = (child, now)
+
+    def _forget_routes(self):
+        """
+        Forget the unicast routes older than config.unicast_route_ttl.
+
+        :return:
+        """
+        oldest = self.clock.time() - unicast_route_ttl
+        for address in [address for address, (_, learned) in self.unicast_routes.items() if learned < oldest]:
+            del self.unicast_routes[address]
+
+    def _forwards_topic(self, address, topic):
+        """
+        A Message with a topic always goes up to our parent (it has to reach every subtree), but only goes down to a
+        child whose topic filter may have the topic. A child that has sent us no filter yet may want any topic.
+
+        :param address: Server address of our neighbour.
+        :param topic: Topic of the Message, or None.
+        :return: Whether the Message should be sent to the neighbour.
+        :rtype: bool
+        """
+        if topic is None or address == self.parent:
+            return True
+        topic_filter = self.topic_filters.get(address)
+        if topic_filter is None or topic in topic_filter:
+            return True
+        self._topic_filtered.inc()
+        return False
+
+    def _learn_topic_filter(self, packet):
+        """
+        Keep the topic filter of the child that has sent (or relayed) us this Reunion Hello.
+
+        :param packet: Arrived Reunion Hello.
+        :return:
+        """
+        address = (packet.get_source_server_ip(), int(packet.get_source_server_port()))
+        topic_filter = packet.get_topic_filter()
+        if topic_filter is None:
+            self.topic_filters.pop(address, None)
+        else:
+            self.topic_filters[address] = topic_filter
+
+    def _subtree_topic_filter(self):
+        """
+        The filter of our subscriptions and those of the subtrees of our children, for our Reunion Hellos.
+        Filters of the nodes that are no longer our children are forgotten here.
+
+        :return: The filter, or None if some child may want any topic (or config.topic_filter_bits is 0).
+        :rtype: BloomFilter
+        """
+        if not topic_filter_bits:
+            return None
+        children = {node.get_server_address() for node in self.stream.nodes
+                    if not node.is_register and node.get_server_address() != self.parent and
+                    not self._is_shortcut(node.get_server_address())}
+        for address in [address for address in self.topic_filters if address not in children]:
+            del self.topic_filters[address]
+        subtree_filter = BloomFilter(topic_filter_bits, topic_filter_hashes)
+        for topic in self.subscriptions:
+            subtree_filter.add(topic)
+        for address in children:
+            topic_filter = self.topic_filters.get(address)
+            if topic_filter is None or not subtree_filter.update(topic_filter):
+                return None
+        return subtree_filter
+
+    def _record_trace(self, message, trace):
+        """
+        Keep the trace of a traced message that has reached us and log it for tools/TraceReport.py.
+
+        For hop i, queueing time is its forward time minus its receive time, and network time is its receive time
+        minus the forward time of hop i - 1. Our own entry, the last one, has the time we queued the copies; the next
+        hops get the time their copy was sent.
+
+        :param message: The message.
+        :param trace: Trace entries from the origin to us, see Packet.
+        :return:
+        """
+        self.traces.append((message, trace))
+        for (_, _, previous_forward), (_, receive_time, forward_time) in zip(trace, trace[1:]):
+            self._trace_queue_seconds.record(max(0.0, forward_time - receive_time))
+            self._trace_network_seconds.record(max(0.0, receive_time - previous_forward))
+        if trace_log.isEnabledFor(logging.INFO):
+            hops = [[address[0], address[1], receive_time, forward_time]
+                    for address, receive_time, forward_time in trace]
+            trace_log.info('trace %s', json.dumps({'message': message, 'hops': hops}, separators=(',', ':')))
+
     def _handle_reunion_packet(self, packet):
         """
         In this function we should handle Reunion packet was just arrived.
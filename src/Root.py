@@ -4,13 +4,25 @@ from Packet import Packet
 from UserInterface import UserInterface
 from tools.SemiNode import SemiNode
 from tools.NetworkGraph import NetworkGraph, GraphNode
+from tools.ArrayNetworkGraph import ArrayNetworkGraph
+from tools.RootSnapshot import RootSnapshot
+from tools.HashRing import HashRing
+from tools.Log import get_logger
+from tools.Profiler import profiler
+import json
 import time
 import threading
-from config import verbosity
+from config import duplex_register_connection, root_snapshot_path, root_snapshot_interval, \
+    root_snapshot_max_age, root_failover_time, root_shards, network_graph
+
+log = get_logger('root')
+reunion_log = get_logger('reunion')
+packet_log = get_logger('packet')
 
 
 class Root(Peer):
-    def __init__(self, server_ip, server_port, user_interface=None, is_root=False, root_address=None):
+    def __init__(self, server_ip, server_port, user_interface=None, is_root=False, root_address=None, standby_of=None,
+                 stream=None, clock=None, start_threads=True, snapshot_path=root_snapshot_path):
         """
         The Peer object constructor.
 
@@ -28,20 +40,60 @@ class Root(Peer):
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
         :param root_address: Root IP/Port address if we are a client.
+        :param standby_of: Primary root IP/Port address if we are a hot-standby root.
+        :param stream: See Peer.
+        :param clock: See Peer.
+        :param start_threads: If False, somebody else (tools.Simulator) calls run_once and reunion_tick.
+        :param snapshot_path: Where to keep our RootSnapshot; None disables it.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
         :type root_address: tuple
+        :type standby_of: tuple
         """
-        super(Root, self).__init__(server_ip=server_ip, server_port=server_port, user_interface=user_interface)
+        super(Root, self).__init__(server_ip=server_ip, server_port=server_port, user_interface=user_interface,
+                                   is_root=True, stream=stream, clock=clock)
         self.start_user_interface()
         self.last_reunion_times = {}
-        self.graph = NetworkGraph(GraphNode(self.server_address))
-        self.t_run = threading.Thread(target=self.run, args=())
-        self.t_run.start()
-        self.t_run_reunion_daemon = threading.Thread(target=self.run_reunion_daemon, args=())
-        self.t_run_reunion_daemon.start()
+        if network_graph == 'arrays':
+            self.graph = ArrayNetworkGraph(self.server_address)
+        else:
+            self.graph = NetworkGraph(GraphNode(self.server_address))
+        self.registered = set()
+        self.metrics.gauge('graph_nodes', function=lambda: len(self.graph))
+        self.metrics.gauge('registered_clients', function=lambda: len(self.registered))
+        self._nodes_turned_off = self.metrics.counter('reunion_nodes_turned_off_total')
+        self._nodes_removed = self.metrics.counter('reunion_nodes_removed_total')
+        self._shortcut_requests = {accepted: self.metrics.counter('shortcut_requests_total',
+                                                                  result='accepted' if accepted else 'refused')
+                                   for accepted in (True, False)}
+        self.snapshot = RootSnapshot(snapshot_path) if snapshot_path is not None else None
+        self.last_snapshot_time = self.clock.time()
+        # Standby roots we replicate to, if we are the primary.
+        self.standbys = set()
+        # The primary root state, if we are a standby: latest SNP and the LOG entries after it.
+        self.primary_address = standby_of
+        self.is_standby = standby_of is not None
+        self.replica_state = None
+        self.replica_log = []
+        self.last_replication_time = self.clock.time()
+        # Other roots of a sharded network we are linked to; see _link_shard_roots.
+        self.shard_ring = HashRing([(SemiNode.parse_ip(ip), port) for ip, port in root_shards])
+        # Our address as the shard ring and the packets write it, which is not always our server_address.
+        self._shard_address = (SemiNode.parse_ip(self.server_address[0]), self.server_address[1])
+        self.shard_links = self._get_shard_links()
+        if self.is_standby:
+            self.stream.add_node(standby_of, set_register_connection=True)
+            sub_packet = self.packet_factory.new_replication_packet('SUB', self.server_address)
+            self.stream.add_message_to_out_buff(standby_of, sub_packet.get_buf(), True)
+        else:
+            self._warm_restart()
+        if start_threads:
+            self.t_run = threading.Thread(target=self.run, args=())
+            self.t_run.start()
+            self.t_run_reunion_daemon = threading.Thread(target=self.run_reunion_daemon, args=())
+            self.t_run_reunion_daemon.start()
 
     def handle_user_interface_buffer(self):
         """
@@ -50,16 +102,28 @@ class Root(Peer):
             1. Register:  With this command, the client send a Register Request packet to the root of the network.
             2. Advertise: Send an Advertise Request to the root of the network for finding first hope.
             3. SendMessage: The following string will be added to a new Message packet and broadcast through the network.
+            4. trace: Like SendMessage, but the message collects the times of its hops (see Packet and TraceReport).
+            5. profile: 'profile start [sample|cprofile]' and 'profile stop [path]', see Peer.start_profiler.
+            6. subscribe, unsubscribe and publish: Topics, see Peer._handle_topic_command.
+            7. sendto: 'sendto <ip> <port> <message>' sends the message to that peer only, see Peer._send_unicast.
         :return:
         """
         buff = self.user_interface.buffer
-        for msg in buff:
+        # Commands typed while we are parsing stay for the next interval.
+        count = len(buff)
+        for msg in buff[:count]:
             msg_split = msg.split()
             if msg_split[0] == 'send':
-                brd_cast_packet = self.packet_factory.new_message_packet(msg_split[1],
-                                                                         source_server_address=self.server_address)
-                self.send_broadcast_packet(brd_cast_packet)
-        self.user_interface.buffer.clear()
+                self._broadcast_message(msg_split[1])
+            elif msg_split[0] == 'trace':
+                self._broadcast_message(msg_split[1], trace=True)
+            elif msg_split[0] == 'profile':
+                self._handle_profile_command(msg_split[1:])
+            elif msg_split[0] in ('subscribe', 'unsubscribe', 'publish'):
+                self._handle_topic_command(msg_split)
+            elif msg_split[0] == 'sendto':
+                self._handle_sendto_command(msg_split)
+        del buff[:count]
 
     def run(self):
         """
@@ -80,14 +144,33 @@ class Root(Peer):
         :return:
         """
         while True:
-            in_buff = self.stream.read_in_buf()
+            profiler.checkpoint('run')
+            self.run_once()
+            self.clock.sleep(2)
+
+    def run_once(self):
+        """
+        One iteration of the main loop.
+
+        :return:
+        """
+        start = time.perf_counter()
+        with self.state_lock:
             self.handle_user_interface_buffer()
-            packets = self.packet_factory.parse_buffer(in_buff)
+            self._handle_delayed_messages()
+            packets = self._read_packets()
+            advertise_packets = []
             for packet in packets:
-                self.handle_packet(packet)
-            self.stream.send_out_buf_messages()
-            self.stream.clear_in_buff()
-            time.sleep(2)
+                if packet.get_type() == 2 and not self.is_standby:
+                    # Placed together after the loop, see _handle_advertise_batch.
+                    advertise_packets.append(packet)
+                else:
+                    self.handle_packet(packet)
+            if advertise_packets:
+                self._handle_advertise_batch(advertise_packets)
+        self.stream.send_out_buf_messages()
+        self.stream.clear_in_buff()
+        self._main_loop_seconds.record(time.perf_counter() - start)
 
     def run_reunion_daemon(self):
         """
@@ -105,24 +188,63 @@ class Root(Peer):
 
         :return:
         """
+        while True:
+            profiler.checkpoint('reunion')
+            self.reunion_tick()
+            self.clock.sleep(2)
+
+    def reunion_tick(self):
+        """
+        One iteration of the reunion daemon. The snapshot files are written here, outside state_lock.
+
+        :return:
+        """
+        with self.state_lock:
+            state = self._reunion_tick()
+        if self.snapshot is not None:
+            if state is not None:
+                self.snapshot.save(state)
+            self.snapshot.flush()
+
+    def _reunion_tick(self):
+        """
+        :return: A snapshot to save, if it is time for one.
+        :rtype: dict
+        """
         turn_off_time = 16
         remove_time = 60
-        while True:
-            t = time.time()
-            for node_address, last_reunion_time in self.last_reunion_times.copy().items():
-                if t - last_reunion_time > remove_time:
-                    print('removing node {}'.format(node_address))
-                    self.graph.remove_node(node_address)
-                    del self.last_reunion_times[node_address]
-                    node = self.stream.get_node_by_server(node_address[0], node_address[1], True)
+        t = self.clock.time()
+        state = None
+        if self.is_standby:
+            if t - self.last_replication_time > root_failover_time:
+                state = self._promote()
+            return state
+        self._link_shard_roots()
+        if t - self.last_snapshot_time > root_snapshot_interval:
+            if self.snapshot is not None:
+                state = self.snapshot.take(self.graph, self.registered)
+            self._send_snapshot_to_standbys(state)
+            self.last_snapshot_time = t
+        self._send_to_standbys(self.packet_factory.new_replication_packet('HBT', self.server_address))
+        for node_address, last_reunion_time in self.last_reunion_times.copy().items():
+            if t - last_reunion_time > remove_time:
+                reunion_log.info('removing node %s', node_address)
+                self._nodes_removed.inc()
+                self.graph.remove_node(node_address)
+                del self.last_reunion_times[node_address]
+                self.registered.discard(node_address)
+                self._log_change('remove', node_address[0], node_address[1])
+                node = self.stream.get_node_by_server(node_address[0], node_address[1], True)
+                if node is not None:
                     self.stream.remove_node(node)
-                    # TODO: remove node ??
-                elif turn_off_time < t - last_reunion_time < remove_time:
-                    graph_node = self.graph.find_node(node_address[0], node_address[1])
-                    if graph_node.alive:
-                        print('turning off node {}'.format(node_address))
-                    graph_node.alive = False
-            time.sleep(2)
+                # TODO: remove node ??
+            elif turn_off_time < t - last_reunion_time < remove_time:
+                graph_node = self.graph.find_node(node_address[0], node_address[1])
+                if graph_node.alive:
+                    reunion_log.info('turning off node %s', node_address)
+                    self._nodes_turned_off.inc()
+                graph_node.alive = False
+        return state
 
     def handle_packet(self, packet):
         """
@@ -138,10 +260,11 @@ class Root(Peer):
 
         """
         type = packet.get_type()
-        if verbosity == 1:
-            if type != 5:
-                print("Recvd packet body: ", packet.get_body())
-                print('Recvd packet type: ', type)
+        if type != 5:
+            packet_log.debug('Recvd packet type %s body: %s', type, packet.get_body())
+        if self.is_standby and type != 6:
+            # The primary root is still in charge of the network.
+            return
         if type == 1:
             self._handle_register_packet(packet)
         elif type == 2:
@@ -152,6 +275,10 @@ class Root(Peer):
             self._handle_message_packet(packet)
         elif type == 5:
             self._handle_reunion_packet(packet)
+        elif type == 6:
+            self._handle_replication_packet(packet)
+        elif type == 7:
+            self._handle_shortcut_packet(packet)
         else:
             raise NotImplemented
 
@@ -164,10 +291,7 @@ class Root(Peer):
 
         :return:
         """
-        for node in self.stream.nodes:
-            if source_address == node.get_server_address() and node.is_register:
-                return True
-        return False
+        return source_address in self.registered
 
     def _handle_advertise_packet(self, packet):
         """
@@ -188,33 +312,50 @@ class Root(Peer):
 
         :return:
         """
-        t = time.time()
-        if packet.is_request():
-            source_ip, source_port = packet.get_source_server_ip(), packet.get_source_server_port()
-            print('\t Recvd Adv Packet from ', source_ip, source_port)
-            if self.__check_registered((source_ip, source_port)):
-                parent_ip, parent_port = self._get_neighbour(sender=(source_ip, source_port))
-                # print('parent ip and port: ', parent_ip, parent_port)
-                adv_res_pack = self.packet_factory.new_advertise_packet('RES', self.server_address,
-                                                                        neighbour=(parent_ip, parent_port))
-                try:
-                    self.stream.add_message_to_out_buff((source_ip, source_port), adv_res_pack.get_buf(), True)
-                except Exception:
-                    print('Oops! Seems that you are adding a message to nonexistent buffer!')
-                graph_node = self.graph.find_node(source_ip, source_port)
-                if graph_node is None:
-                    self.graph.add_node(source_ip, source_port, (parent_ip, parent_port))
-                else:
-                    prev_parent = graph_node.parent
-                    prev_parent_ip, prev_parent_port = prev_parent.address
-                    print('prev_parent of ', source_ip, source_port, ' was: ', prev_parent_ip, prev_parent_port)
-                    prev_parent.children.remove(graph_node)
-                    print('new parent for ', source_ip, source_port, ': ', parent_ip, parent_port)
-                    new_parent = self.graph.find_node(parent_ip, parent_port)
-                    graph_node.parent = new_parent
-                    new_parent.children.append(graph_node)
-                    graph_node.alive = True
-                self.last_reunion_times[(source_ip, source_port)] = t
+        self._handle_advertise_batch([packet])
+
+    def _handle_advertise_batch(self, packets):
+        """
+        Answer all the Advertise Requests drained in one main loop iteration together (after a root restart or a
+        mass disconnect hundreds of them arrive at once): one BFS over the free slots of our NetworkGraph places
+        every sender without conflicts, and every sender gets one response even if it asked more than once.
+
+        :param packets: Arrived advertise packets
+        :type packets: list
+
+        :return:
+        """
+        t = self.clock.time()
+        senders = []
+        seen = set()
+        for packet in packets:
+            if packet.is_request():
+                source_ip, source_port = packet.get_source_server_ip(), packet.get_source_server_port()
+                log.debug('Recvd Adv Packet from %s %s', source_ip, source_port)
+                if self.__check_registered((source_ip, source_port)) and (source_ip, source_port) not in seen:
+                    seen.add((source_ip, source_port))
+                    senders.append((source_ip, source_port))
+        parents = self.graph.find_live_nodes(senders)
+        for source_ip, source_port in senders:
+            if parents[(source_ip, source_port)] is None:
+                log.warning('No place in the network for %s %s', source_ip, source_port)
+                continue
+            parent_ip, parent_port = parents[(source_ip, source_port)]
+            self._add_register_node((source_ip, source_port))
+            adv_res_pack = self.packet_factory.new_advertise_packet('RES', self.server_address,
+                                                                    neighbour=(parent_ip, parent_port))
+            try:
+                self.stream.add_message_to_out_buff((source_ip, source_port), adv_res_pack.get_buf(), True)
+            except Exception:
+                log.warning('Oops! Seems that you are adding a message to nonexistent buffer!')
+            graph_node = self.graph.find_node(source_ip, source_port)
+            if graph_node is not None:
+                prev_parent_ip, prev_parent_port = graph_node.parent.address
+                log.info('new parent for %s %s: %s %s (was %s %s)', source_ip, source_port, parent_ip, parent_port,
+                         prev_parent_ip, prev_parent_port)
+            self.graph.place_node(source_ip, source_port, (parent_ip, parent_port))
+            self._log_change('place', source_ip, source_port, parent_ip, parent_port)
+            self.last_reunion_times[(source_ip, source_port)] = t
 
     def _handle_register_packet(self, packet):
         """
@@ -232,10 +373,161 @@ class Root(Peer):
         if packet.is_request():
             address = (packet.get_source_server_ip(), packet.get_source_server_port())
             if not self.__check_registered(address):
-                self.stream.add_node(address, set_register_connection=True)
+                owner = self.shard_ring.get(address) if self.shard_links else None
+                if owner is not None and owner != self._shard_address:
+                    # Only possible when the owner root is gone, see Client.root_addresses.
+                    log.info('registering %s for its failed shard root %s', address, owner)
+                self._add_register_node(address)
+                self.registered.add(address)
+                self._log_change('register', address[0], address[1])
                 reg_res_pack = self.packet_factory.new_register_packet('RES', self.server_address)
                 self.stream.add_message_to_out_buff(address, reg_res_pack.get_buf(), True)
 
+    def _get_shard_links(self):
+        """
+        The roots of a sharded network are linked in a chain (ordered by address), so the roots with their
+        sub-trees still make one tree and broadcasts cross partitions without loops.
+
+        :return: Addresses of the roots next to us in the chain.
+        :rtype: list
+        """
+        shards = sorted(self.shard_ring.nodes)
+        if self._shard_address not in shards:
+            return []
+        index = shards.index(self._shard_address)
+        return [shards[i] for i in (index - 1, index + 1) if 0 <= i < len(shards)]
+
+    def _link_shard_roots(self):
+        """
+        Connect to our neighbours in the chain of roots; a link that was dropped (e.g. the other root was not up
+        yet) is made again.
+
+        :return:
+        """
+        for address in self.shard_links:
+            if self.stream.get_node_by_server(address[0], address[1]) is None:
+                self.stream.add_node(address)
+
+    def _add_register_node(self, address):
+        """
+        Make the register_connection node of a registered client if we don't have it; after a warm restart we only
+        know the client address until it talks to us again.
+
+        :param address: Client IP/Port address.
+        :type address: tuple
+
+        :return:
+        """
+        if self.stream.get_node_by_server(address[0], address[1], True) is not None:
+            return
+        if duplex_register_connection:
+            self.stream.add_reply_node(address)
+        else:
+            self.stream.add_node(address, set_register_connection=True)
+
+    def _log_change(self, *entry):
+        if self.snapshot is not None:
+            self.snapshot.log(*entry)
+        if self.standbys:
+            log_packet = self.packet_factory.new_replication_packet('LOG', self.server_address,
+                                                                    json.dumps(entry, separators=(',', ':')))
+            self._send_to_standbys(log_packet)
+
+    def _send_to_standbys(self, packet):
+        for address in self.standbys.copy():
+            try:
+                self.stream.add_message_to_out_buff(address, packet.get_buf(), True)
+            except Exception:
+                log.warning('standby root %s is gone', address)
+                self.standbys.discard(address)
+
+    def _send_snapshot_to_standbys(self, state=None):
+        if self.standbys:
+            if state is None:
+                state = RootSnapshot.make_state(self.graph, self.registered)
+            snp_packet = self.packet_factory.new_replication_packet('SNP', self.server_address,
+                                                                    json.dumps(state, separators=(',', ':')))
+            self._send_to_standbys(snp_packet)
+
+    def _handle_replication_packet(self, packet):
+        """
+        Primary root: a standby asks for our changes (SUB); it gets a snapshot now, then every LOG entry, heartbeats
+        and periodic snapshots.
+        Standby root: keep the primary state up to date and remember that the primary is alive.
+
+        :param packet: Arrived replication packet
+        :type packet Packet
+        :return:
+        """
+        body = packet.get_body()
+        kind, payload = body[:3], body[3:]
+        if kind == 'SUB' and not self.is_standby:
+            address = (packet.get_source_server_ip(), packet.get_source_server_port())
+            log.info('standby root %s subscribed', address)
+            self._add_register_node(address)
+            self.standbys.add(address)
+            self._send_snapshot_to_standbys()
+        elif self.is_standby:
+            self.last_replication_time = self.clock.time()
+            if kind == 'SNP':
+                self.replica_state = json.loads(payload)
+                self.replica_log = []
+            elif kind == 'LOG':
+                self.replica_log.append(json.loads(payload))
+
+    def _promote(self):
+        """
+        The primary root stopped answering; take over with its latest state. Clients keep their place in the tree,
+        only the old root children have to advertise again (to us, as clients fail over their register_connection).
+
+        :return: Our new snapshot to save, if we keep one.
+        :rtype: dict
+        """
+        log.warning('primary root %s is gone, taking over', self.primary_address)
+        self.is_standby = False
+        node = self.stream.get_node_by_server(self.primary_address[0], self.primary_address[1], True)
+        if node is not None:
+            self.stream.remove_node(node)
+        if self.replica_state is not None:
+            edges, registered = RootSnapshot.replay(self.replica_state, self.replica_log, self.server_address)
+            self._install_state(edges, registered)
+        if self.snapshot is not None:
+            return self.snapshot.take(self.graph, self.registered)
+        return None
+
+    def _warm_restart(self):
+        """
+        Load the latest snapshot, if any. Known clients are registered and tentatively alive, so they keep their
+        place in the tree unless they miss their Reunion Hellos; our own children are connected again.
+
+        :return:
+        """
+        if self.snapshot is None:
+            return
+        state = self.snapshot.load(self.server_address, root_snapshot_max_age)
+        if state is None:
+            return
+        edges, registered = state
+        self._install_state(edges, registered)
+        log.info('warm restart with %d nodes and %d registered clients', len(edges), len(registered))
+        self.snapshot.save(self.snapshot.take(self.graph, self.registered))
+
+    def _install_state(self, edges, registered):
+        """
+        :param edges: [(address, parent_address), ...] with parents first.
+        :param registered: Addresses of the registered clients.
+
+        :return:
+        """
+        t = self.clock.time()
+        for (ip, port), parent_address in edges:
+            self.graph.add_node(ip, port, parent_address)
+            self.last_reunion_times[(ip, port)] = t
+        self.registered.update(registered)
+        for child in self.graph.root.children:
+            if self.stream.get_node_by_server(child.address[0], child.address[1]) is None:
+                self.stream.add_node(child.address)
+
     def _handle_message_packet(self, packet):
         """
         Only broadcast message to the other nodes.
@@ -260,6 +552,7 @@ class Root(Peer):
             If you are root Peer you should answer with a new Reunion Hello Back packet.
             At first extract all addresses in the packet body and append them in descending order to the new packet.
             You should send the new packet to the first address in the arrived packet.
+            Keep the topic filter of the child that sent it, see Peer._forwards_topic.
         Warnings:
             1. Every time adding or removing an address from packet don't forget to update Entity Number field.
             2. If you are the root, update last Reunion Hello arrival packet from the sender node and turn it on.
@@ -268,13 +561,14 @@ class Root(Peer):
         :return:
         """
         # print('reunion packet recvd...')
-        t = time.time()
+        t = self.clock.time()
         body = packet.get_body()
         type = body[:3]
         n_entries = int(body[3:5])
         entries = body[5:]
         length = len(entries)
         if type == 'REQ':
+            self._learn_topic_filter(packet)
             nodes_array = [(entries[i:i + 15], int(entries[i + 15:i + 20])) for i in range(0, length, 20)]
             last_node = nodes_array[-1]
             sender = nodes_array[0]
@@ -286,7 +580,63 @@ class Root(Peer):
 
     def _handle_join_packet(self, packet):
         address = (packet.get_source_server_ip(), packet.get_source_server_port())
-        self.stream.add_node(address)
+        if self.stream.get_node_by_server(address[0], address[1]) is None:
+            self.stream.add_node(address)
+
+    def _handle_shortcut_packet(self, packet):
+        """
+        A client asks for a shortcut to another client (REQ); we allow it if both are registered, the other one is
+        alive in our NetworkGraph, and they are not parent and child already. The clients make the shortcut
+        themselves, see Client._handle_shortcut_packet.
+
+        :param packet: Arrived shortcut packet
+        :type packet Packet
+
+        :return:
+        """
+        body = packet.get_body()
+        if body[:3] != 'REQ':
+            return
+        requester = (packet.get_source_server_ip(), packet.get_source_server_port())
+        if not self.__check_registered(requester):
+            return
+        address = (body[3:18], int(body[18:23]))
+        node = self.graph.find_node(address[0], address[1])
+        requester_node = self.graph.find_node(requester[0], requester[1])
+        accepted = address != requester and self.__check_registered(address) and node is not None and \
+            node.alive and not (node.parent is not None and node.parent.address == requester) and \
+            not (requester_node is not None and requester_node.parent is not None and
+                 requester_node.parent.address == address)
+        self._shortcut_requests[accepted].inc()
+        self._add_register_node(requester)
+        res_packet = self.packet_factory.new_shortcut_packet('RES', self.server_address, address, accepted)
+        self.stream.add_message_to_out_buff(requester, res_packet.get_buf(), True)
+
+    def _unicast_next_hop(self, destination, source_address):
+        """
+        We keep no unicast routes: our NetworkGraph has the path to every client of ours. A destination in another
+        shard is sent along the chain of roots towards the root that owns it.
+
+        :param destination: Server address of the destination.
+        :param source_address: The neighbour the Message came from, or None if it is ours.
+        :return: Server address of the next hop, or None if we have no route.
+        :rtype: tuple
+        """
+        if self.stream.get_node_by_server(destination[0], destination[1]) is not None:
+            return destination
+        node = self.graph.find_node(destination[0], destination[1])
+        while node is not None and node.parent is not None and node.parent.address != self.server_address:
+            node = node.parent
+        if node is not None and node.parent is not None and node.address != source_address and \
+                self.stream.get_node_by_server(node.address[0], node.address[1]) is not None:
+            return node.address
+        owner = self.shard_ring.get(destination) if self.shard_links else None
+        if owner is None or owner == self._shard_address:
+            return None
+        for address in self.shard_links:
+            if (address < self._shard_address) == (owner < self._shard_address) and address != source_address:
+                return address
+        return None
 
     def _get_neighbour(self, sender):
         """
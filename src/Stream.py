@@ -1,12 +1,52 @@
 from tools.simpletcp.tcpserver import TCPServer
+from Packet import Packet, TRACE_FLAG
 
 from tools.Node import Node
+from tools.ConnectionPool import ConnectionPool, ReplyConnection
+from tools.Metrics import MetricsRegistry
+from concurrent.futures import ThreadPoolExecutor
+from tools.Log import get_logger
+from tools.Profiler import profiler
+from tools.simpletcp.socketoptions import SocketOptions
+from config import flush_workers, duplex_register_connection, socket_profiles, in_buf_max_data_frames
+import collections
+import struct
 import threading
+import time
+
+log = get_logger('stream')
+
+# Body length field of a packet header.
+_FRAME_LENGTH = struct.Struct('>I')
+# Packet type of the data plane; every other type (Register, Advertise, Join, Reunion, Replication) is control.
+_MESSAGE_TYPE = 4
+# Packet types (Register, Advertise and Replication) that come through the register_connection of their sender; we
+# answer them on it, see ReplyConnection.
+_REGISTER_CONNECTION_TYPES = (1, 2, 6)
+
+
+def is_control_frame(data):
+    """
+    :param data: A packet frame.
+    :return: Whether the frame is a control packet, which goes before Messages in and out of a Stream.
+    :rtype: bool
+    """
+    return data[3] != _MESSAGE_TYPE
+
+
+class _InLane:
+    def __init__(self):
+        """
+        Received frames of one priority, with their receive times, and how many of them the last read_in_buf returned.
+        """
+        self.frames = []
+        self.times = []
+        self.read = 0
 
 
 class Stream:
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, metrics=None, socket_options=None):
         """
         The Stream object constructor.
 
@@ -16,27 +56,125 @@ class Stream:
 
         :param ip: 15 characters
         :param port: 5 characters
+        :param metrics: Registry for our metrics; a new one by default.
+        :param socket_options: Options of our server and outgoing sockets; config.socket_profiles['client'] by
+                               default.
+        :type metrics: MetricsRegistry
+        :type socket_options: SocketOptions
         """
         def callback(address, queue, data):
             """
             The callback function will run when a new data received from server_buffer.
 
             :param address: Source address.
-            :param queue: Response queue.
-            :param data: The data received from the socket.
+            :param queue: Response queue; None when data came back through one of our duplex connections.
+            :param data: One frame received from the socket; a memoryview that is only valid during the call.
             :return:
             """
-            queue.put(bytes('ACK', 'utf8'))
-            self._server_in_buf.append(data)
+            if data == b'ACK':
+                # The response to one of our own frames on a duplex connection.
+                return
+            # The only copy of the frame on our receive path; the ServerSocket reuses the memory behind data.
+            data = bytes(data)
+            if queue is not None:
+                queue.put(bytes('ACK', 'utf8'))
+                if data[3] in _REGISTER_CONNECTION_TYPES:
+                    self._reply_queues[Stream._frame_source(data)] = queue
+            self._append_in_buf(data)
 
-        self.tcp_server = TCPServer(mode='localhost', port=port, read_callback=callback)
+        self.nodes = []
+        # (server_address, is_register) -> Node, so get_node_by_server does not scan the nodes list.
+        self._nodes_index = {}
+        self._init_in_buf()
+        # Sender server address -> ConnectionQueue of its register_connection socket, for answering on it.
+        self._reply_queues = {}
+        self._init_metrics(metrics)
+        if socket_options is None:
+            socket_options = SocketOptions.from_dict(socket_profiles['client'])
+        self.socket_options = socket_options
+        self.tcp_server = TCPServer(mode='localhost', port=port, read_callback=callback,
+                                    frame_length=Stream._frame_length,
+                                    loop_hook=lambda: profiler.checkpoint('server'),
+                                    socket_options=self.socket_options)
+        self.connection_pool = ConnectionPool(on_connect=self.tcp_server.adopt, socket_options=self.socket_options)
         self.t_tcp_server = threading.Thread(target=self.tcp_server.run, args=())
         self.t_tcp_server.start()
         #print('Inside stream after thread start')
         self.ip = Node.parse_ip(ip)
         self.port = Node.parse_port(port)
-        self.nodes = []
-        self._server_in_buf = []
+        # out_buff counters of the nodes that have already left the stream.
+        self._removed_nodes_counters = collections.Counter()
+        self._flush_pool = ThreadPoolExecutor(max_workers=flush_workers, thread_name_prefix='stream-flush')
+        for name in ('connects', 'reconnects', 'failures'):
+            self.metrics.counter('connection_{}_total'.format(name),
+                                 function=lambda name=name: self.connection_pool.get_counters().get(name, 0))
+
+    def _init_in_buf(self):
+        """
+        Our input buffer has a control and a data lane, so a flood of Messages never delays the Reunion, Advertise,
+        Register and Join packets behind it.
+
+        :return:
+        """
+        self._control_in = _InLane()
+        self._data_in = _InLane()
+
+    def _init_metrics(self, metrics):
+        """
+        Make our metrics registry and the metrics that are updated on the hot path.
+
+        :param metrics: See __init__.
+        :return:
+        """
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self._frames_in = self.metrics.counter('stream_frames_in_total')
+        self._bytes_in = self.metrics.counter('stream_bytes_in_total')
+        self._bytes_out = self.metrics.counter('stream_bytes_out_total')
+        self._packets_out = {}
+        self._flush_seconds = self.metrics.histogram('stream_flush_seconds')
+        self.metrics.gauge('stream_in_buf_frames', function=lambda: len(self._control_in.frames) +
+                           len(self._data_in.frames))
+        self.metrics.gauge('stream_in_buf_control_frames', function=lambda: len(self._control_in.frames))
+        self.metrics.gauge('stream_nodes', function=lambda: len(self.nodes))
+        self.metrics.gauge('stream_out_buf_messages', function=lambda: sum(len(node.out_buff)
+                                                                           for node in self.nodes.copy()))
+        self.metrics.gauge('stream_out_buf_bytes', function=lambda: sum(node.out_buff_bytes
+                                                                        for node in self.nodes.copy()))
+        self.metrics.gauge('stream_out_buf_control_messages', function=lambda: sum(len(node.control_buff)
+                                                                                   for node in self.nodes.copy()))
+        for name in ('blocked', 'block_timeouts', 'dropped_oldest', 'dropped_newest', 'disconnected',
+                     'dropped_control'):
+            self.metrics.counter('out_buf_{}_total'.format(name),
+                                 function=lambda name=name: self.get_out_buff_counters().get(name, 0))
+
+    @staticmethod
+    def _frame_length(buffer):
+        """
+        Frames are ACK responses or packets; the packet header tells the body length.
+
+        :param buffer: Received bytes that are not delivered yet.
+        :type buffer: memoryview
+
+        :return: Length of the first frame in buffer or 0 if we need more bytes.
+        :rtype: int
+        """
+        # Index and unpack_from instead of slices: no new objects per frame. Packet headers start with the
+        # version (0x00 0x01), so a leading 'A' is an ACK.
+        if len(buffer) < 20:
+            return 3 if buffer[:3] == b'ACK' else 0
+        if buffer[0] == 0x41:
+            return 3
+        return 20 + _FRAME_LENGTH.unpack_from(buffer, 4)[0]
+
+    @staticmethod
+    def _frame_source(data):
+        """
+        :param data: A packet frame.
+        :return: Source server address written in the frame header.
+        :rtype: tuple
+        """
+        ip = '.'.join(str(int.from_bytes(data[i:i + 2], byteorder='big')).zfill(3) for i in range(8, 16, 2))
+        return ip, int.from_bytes(data[16:20], byteorder='big')
 
     def get_server_address(self):
         """
@@ -48,11 +186,46 @@ class Stream:
 
     def clear_in_buff(self):
         """
-        Discard any data in TCPServer input buffer.
+        Discard the data of TCPServer input buffer that was returned by the last read_in_buf.
+        Data that arrived after that, or that read_in_buf left for later, stays for the next read.
 
         :return:
         """
-        self._server_in_buf.clear()
+        for lane in (self._control_in, self._data_in):
+            del lane.frames[:lane.read]
+            del lane.times[:lane.read]
+            lane.read = 0
+
+    def _append_in_buf(self, data):
+        """
+        Add a received frame to our input buffer.
+
+        Warnings:
+            1. The receive time goes first, so the times of a lane are never fewer than its frames for a reader.
+
+        :param data: One frame.
+        :return:
+        """
+        self._frames_in.inc()
+        self._bytes_in.inc(len(data))
+        lane = self._control_in if is_control_frame(data) else self._data_in
+        lane.times.append(self._now())
+        lane.frames.append(data)
+
+    def _now(self):
+        return time.time()
+
+    def _stamp_frame(self, data):
+        """
+        The before_send of our Nodes: a traced Message gets its send time as the forward time of its last hop, so
+        the wait in the out buffer counts as queueing time, not network time.
+
+        :param data: A frame that is being sent.
+        :return: The frame to send.
+        """
+        if data[3] == _MESSAGE_TYPE and data[2] & TRACE_FLAG:
+            return Packet.set_forward_time(data, self._now())
+        return data
 
     def add_node(self, server_address, set_register_connection=False):
         """
@@ -66,10 +239,65 @@ class Stream:
 
         :return:
         """
-        print("node ", server_address, set_register_connection, " added to stream nodes")
+        log.debug('node %s %s added to stream nodes', server_address, set_register_connection)
+        server_ip, server_port = server_address
+        server_ip = Node.parse_ip(server_ip)
+        duplex = set_register_connection and duplex_register_connection
+        self._append_node(Node(server_address=(server_ip, server_port), set_register=set_register_connection,
+                               connection_pool=self.connection_pool, duplex=duplex))
+
+    def add_reply_node(self, server_address, set_register_connection=True):
+        """
+        Will add a node that answers through the socket the node has connected to our TCPServer, instead of
+        dialing its TCPServer. The node should have a duplex register_connection to us.
+
+        :param server_address: New node TCPServer address.
+        :param set_register_connection: Shows that is this connection a register_connection or not.
+
+        :type server_address: tuple
+        :type set_register_connection: bool
+
+        :return:
+        """
         server_ip, server_port = server_address
         server_ip = Node.parse_ip(server_ip)
-        self.nodes.append(Node(server_address=(server_ip, server_port), set_register=set_register_connection))
+        connection = ReplyConnection((server_ip, server_port), self._reply_queues)
+        self._append_node(Node(server_address=(server_ip, server_port), set_register=set_register_connection,
+                               connection=connection))
+
+    def _append_node(self, node):
+        """
+        Add the node to the nodes list and its index; it stamps its traced frames with _stamp_frame.
+
+        :param node:
+        :type node: Node
+
+        :return:
+        """
+        node.before_send = self._stamp_frame
+        self.nodes.append(node)
+        self._nodes_index.setdefault((node.get_server_address(), node.is_register), node)
+
+    def _forget_node(self, node):
+        """
+        Take the node out of the nodes list and its index, keep its counters and close it.
+
+        :param node:
+        :type node: Node
+
+        :return:
+        """
+        self.nodes.remove(node)
+        key = (node.get_server_address(), node.is_register)
+        if self._nodes_index.get(key) is node:
+            del self._nodes_index[key]
+            # An older node with the same address may still be in the list.
+            for other in self.nodes:
+                if (other.get_server_address(), other.is_register) == key:
+                    self._nodes_index[key] = other
+                    break
+        self._removed_nodes_counters.update(node.counters)
+        node.close()
 
     def remove_node(self, node):
         """
@@ -83,8 +311,7 @@ class Stream:
 
         :return:
         """
-        self.nodes.remove(node)
-        node.close()
+        self._forget_node(node)
 
     def get_node_by_server(self, ip, port, is_register=False):
         """
@@ -103,11 +330,7 @@ class Stream:
         # print('List of nodes in stream ', self.get_server_address())
         # for node in self.nodes:
         #     print(node.get_server_address(), node.is_register)
-        node_address = (Node.parse_ip(ip), port)
-        for node in self.nodes:
-            if node.get_server_address() == node_address and node.is_register == is_register:
-                return node
-        return None
+        return self._nodes_index.get(((Node.parse_ip(ip), port), is_register))
 
     def add_message_to_out_buff(self, address, message, is_register=False):
         """
@@ -120,23 +343,46 @@ class Stream:
         Warnings:
             1. Check whether the node address is in our nodes or not.
 
-        :return:
+        :return: Whether the message was buffered or dropped by the node out_buff policy.
+        :rtype: bool
         """
         ip, port = address
         node = self.get_node_by_server(ip, port, is_register)
         if node is not None:
-            node.add_message_to_out_buff(message)
+            packet_type = message[3]
+            counter = self._packets_out.get(packet_type)
+            if counter is None:
+                counter = self._packets_out[packet_type] = self.metrics.counter('packets_out_total',
+                                                                                type=packet_type)
+            counter.inc()
+            self._bytes_out.inc(len(message))
+            return node.add_message_to_out_buff(message, control=is_control_frame(message))
         else:
             raise Exception
 
     def read_in_buf(self):
         """
-        Only returns the input buffer of our TCPServer.
+        Returns the input buffer of our TCPServer: every control frame, then the Messages.
+
+        Warnings:
+            1. With config.in_buf_max_data_frames only that many Messages are returned; the others wait for the next
+               read, so one main loop iteration stays short during a flood.
 
         :return: TCPServer input buffer.
         :rtype: list
         """
-        return self._server_in_buf
+        self._control_in.read = len(self._control_in.frames)
+        self._data_in.read = len(self._data_in.frames)
+        if in_buf_max_data_frames is not None:
+            self._data_in.read = min(self._data_in.read, in_buf_max_data_frames)
+        return self._control_in.frames[:self._control_in.read] + self._data_in.frames[:self._data_in.read]
+
+    def read_in_times(self):
+        """
+        :return: Receive times of the frames returned by the last read_in_buf.
+        :rtype: list
+        """
+        return self._control_in.times[:self._control_in.read] + self._data_in.times[:self._data_in.read]
 
     def send_messages_to_node(self, node):
         """
@@ -152,24 +398,82 @@ class Stream:
         :return:
         """
         try:
+            if node.is_slow:
+                raise Exception
             node.send_message()
         except Exception:
-            print('Can not send to {} {}... Removing the node from stream'.
-                  format(node.get_server_address(), node.is_register))
-            self.nodes.remove(node)
+            log.warning('Can not send to %s %s... Removing the node from stream', node.get_server_address(),
+                        node.is_register)
+            self._forget_node(node)
             raise Exception
 
     def send_out_buf_messages(self, only_register=False):
         """
         In this function, we will send hole out buffers to their own clients.
+        Slow consumers marked by the 'disconnect' out_buff policy are removed here like any broken node.
 
-        :return:
+        Code design suggestion:
+            1. Every node is flushed on its own worker of _flush_pool, so a node that hits its socket timeout only
+               delays itself; the whole flush takes as long as the slowest single node.
+
+        :return: Addresses of the nodes that were removed.
         """
+        start = time.perf_counter()
+        nodes = [node for node in self.nodes.copy() if node.control_buff or node.out_buff or node.is_slow]
         disconnected_nodes = []
-        for node in self.nodes.copy():
-            try:
-                self.send_messages_to_node(node)
-            except Exception:
+        results = self._flush_all(nodes)
+        self._flush_seconds.record(time.perf_counter() - start)
+        for node, sent in results:
+            if not sent:
+                log.warning('Can not send to %s %s... Removing the node from stream', node.get_server_address(),
+                            node.is_register)
+                if node in self.nodes:
+                    self._forget_node(node)
                 disconnected_nodes.append(node.get_server_address())
         return disconnected_nodes
 
+    def _flush_all(self, nodes):
+        """
+        Flush the nodes, each on its own _flush_pool worker.
+
+        :param nodes: Nodes that have something to send.
+        :type nodes: list
+
+        :return: (node, whether its out_buff was sent completely) pairs.
+        :rtype: list
+        """
+        if len(nodes) == 1:
+            return [(nodes[0], self._flush_node(nodes[0]))]
+        futures = [(node, self._flush_pool.submit(self._flush_node, node)) for node in nodes]
+        return [(node, future.result()) for node, future in futures]
+
+    @staticmethod
+    def _flush_node(node):
+        """
+        Runs on a _flush_pool worker; it must not touch the stream nodes list.
+
+        :param node:
+        :type node: Node
+
+        :return: Whether the node out_buff was sent completely.
+        :rtype: bool
+        """
+        if node.is_slow:
+            return False
+        try:
+            node.send_message()
+        except Exception:
+            return False
+        return True
+
+    def get_out_buff_counters(self):
+        """
+        Sum of the out_buff policy counters of all nodes, including the removed ones.
+
+        :return: Counter name -> count
+        :rtype: dict
+        """
+        counters = collections.Counter(self._removed_nodes_counters)
+        for node in self.nodes.copy():
+            counters.update(node.counters)
+        return dict(counters)
@@ -1,18 +1,44 @@
 import threading
 import time
-from tkinter import *
 from config import has_GUI
+from tools.Log import get_logger
+
+log = get_logger('message')
+
+
+class LogPrinter:
+    """
+    The printer of a daemon UserInterface: lines are logged instead of kept for a window nobody looks at.
+    """
+
+    def append(self, line):
+        log.info('%s', line)
+
+    def clear(self):
+        pass
+
+    def __iter__(self):
+        return iter(())
 
 
 class UserInterface():
 
-    def __init__(self, server_address):
+    def __init__(self, server_address, mode=None):
+        """
+        :param server_address:
+        :param mode: 'gui' (a Tk window), 'console' (commands from stdin) or 'daemon' (no input; printed lines go
+                     to the 'message' log). By default 'gui' if config.has_GUI, else 'console'.
+        """
         self.server_ip = server_address[0]
         self.server_port = server_address[1]
+        self.mode = mode if mode is not None else ('gui' if has_GUI else 'console')
         self.buffer = []
-        self.printer = []
+        self.printer = LogPrinter() if self.mode == 'daemon' else []
 
     def GUI(self, buffer):
+        # Tk is only imported by peers that show a window.
+        from tkinter import Tk, Label, Button, Frame, StringVar, Scrollbar, Listbox, Entry, END, RIGHT, LEFT, Y
+
         def register():
             buffer.append("Register")
 
@@ -72,9 +98,9 @@ class UserInterface():
         Which the user or client sees and works with.
         This method runs every time to see whether there are new messages or not.
         """
-        if has_GUI:
+        if self.mode == 'gui':
             self.GUI(self.buffer)
-        else:
+        elif self.mode == 'console':
             while True:
                 message = input("Write your command:\n")
                 # print(message)
@@ -6,4 +6,88 @@ import random
 has_GUI = True
 root_port = 44331
 client_port = random.randint(55500, 55750)
-verbosity = 0
\ No newline at end of file
+verbosity = 0
+
+# Bounds for every Node out_buff; a slow neighbour can not make us buffer more than this.
+out_buff_max_messages = 1000
+out_buff_max_bytes = 1 << 20
+# What to do when a Node out_buff is full: 'block', 'drop_oldest', 'drop_newest' or 'disconnect'.
+out_buff_policy = 'drop_oldest'
+# Seconds a producer spends sending the buffered messages itself under the 'block' policy, before the message is
+# dropped.
+out_buff_block_timeout = 1
+# Stream reads control packets (all but Messages) before Messages, and every Node sends them first, outside the
+# out_buff bounds above. At most in_buf_max_data_frames Messages are handled per main loop iteration, the rest wait
+# for the next one, so a flood can not hold up the loop; None handles them all.
+in_buf_max_data_frames = None
+# Worker threads used by Stream to flush neighbour out buffers in parallel.
+flush_workers = 16
+# Reconnect backoff of persistent outgoing connections (seconds); delays double per failure, with jitter.
+reconnect_base_delay = 0.1
+reconnect_max_delay = 5
+# A Node keeps its out_buff through connection outages shorter than this, instead of leaving the stream.
+reconnect_grace_time = 10
+# Clients keep one duplex register_connection to the root; the root answers through it instead of dialing back.
+duplex_register_connection = True
+# The root keeps its NetworkGraph and registered clients in this snapshot (plus an append-only '.log' of changes,
+# written every reunion interval) and reloads it on restart; None disables it. Older snapshots than
+# root_snapshot_max_age seconds are ignored. It is opt-in (Main.py --snapshot PATH) because every root started
+# from one working directory (a primary and its standbys, the roots of a sharded network) would share one path and
+# overwrite each other's snapshot.
+root_snapshot_path = None
+root_snapshot_interval = 30
+root_snapshot_max_age = 120
+# A standby root takes over when it has heard nothing from the primary root for this many seconds.
+root_failover_time = 8
+# How the root keeps its NetworkGraph: 'objects' (a GraphNode per client) or 'arrays' (tools/ArrayNetworkGraph.py,
+# parallel arrays with vectorized bulk operations, for very large overlays).
+network_graph = 'objects'
+# Sharded registration: the roots sharing the network, e.g. [('192.168.000.001', 44331), ('192.168.000.001', 44332)].
+# Clients register at the root that owns their address on a consistent hash ring (the next roots on the ring are
+# their fail over roots), and the roots are linked in a chain so broadcasts cross partitions.
+root_shards = []
+# Token buckets at every relay for the Messages it forwards (tools/RateLimiter.py): (messages per second, burst) per
+# origin of a Message and per link (the neighbour it came from); None turns that limit off. Over a limit a Message is
+# dropped ('drop'), or held until its buckets have tokens again ('delay', at most rate_limit_max_delayed of them).
+rate_limit_origin = None
+rate_limit_link = None
+rate_limit_action = 'drop'
+rate_limit_max_delayed = 1000
+# Topics ('subscribe <topic>', 'publish <topic> <message>'): every Reunion Hello carries a Bloom filter of the topics
+# subscribed in the subtree of its sender, with topic_filter_bits bits and topic_filter_hashes bits per topic, and
+# relays forward a topic Message only into the subtrees whose filter may have it. 0 bits sends no filters, so every
+# topic Message reaches every peer (and is shown only to its subscribers).
+topic_filter_bits = 512
+topic_filter_hashes = 3
+# Unicast ('sendto <ip> <port> <message>'): a relay sends a unicast Message down to the child whose subtree had the
+# destination in a Reunion Hello at most unicast_route_ttl seconds ago, else up to its parent.
+unicast_route_ttl = 20
+# Shortcuts: a client asks the root for a direct connection to a peer it has sent shortcut_after unicast Messages
+# to within shortcut_idle_time seconds (None: only on 'shortcut <ip> <port>'). A client has at most shortcut_max
+# shortcuts, and closes the ones idle for shortcut_idle_time seconds.
+shortcut_after = 20
+shortcut_max = 4
+shortcut_idle_time = 60
+# Serve the metrics of every peer in plain text on http://127.0.0.1:<metrics_port>/; None disables the endpoint.
+metrics_port = None
+# Logging levels per category (see tools/Log.py); '' sets every category. verbosity = 1 turns on the packet and
+# socket DEBUG records.
+log_levels = {'': 'INFO'}
+# At most log_rate_limit records with the same message format per log_rate_interval seconds; 0 disables the limit.
+log_rate_limit = 20
+log_rate_interval = 10
+# Socket options per role (see tools/simpletcp/socketoptions.py), set on the listening, accepted and outgoing sockets
+# of the peer. nodelay sends our small frames without waiting for the ACK of the previous one, a 64 KiB recv_size
+# reads many queued frames at once, and keepalive finds dead connections that sent no FIN. A fixed SO_RCVBUF turns
+# the kernel buffer autotuning off, so only the root, which fans out to the most peers, sets its buffers.
+socket_profiles = {
+    'root': {'nodelay': True, 'send_buffer': 1 << 20, 'receive_buffer': 1 << 20, 'keepalive': True,
+             'keepalive_idle': 30, 'keepalive_interval': 10, 'keepalive_count': 3, 'recv_size': 65536},
+    'client': {'nodelay': True, 'keepalive': True, 'keepalive_idle': 30, 'keepalive_interval': 10,
+               'keepalive_count': 3, 'recv_size': 65536},
+}
+# Runtime profiler (tools/Profiler.py): the mode SIGUSR1 starts, the seconds between stack samples in 'sample' mode,
+# and where the stats are written ({pid} and {time} are filled in).
+profile_mode = 'sample'
+profile_interval = 0.005
+profile_path = 'profile-{pid}-{time}.txt'
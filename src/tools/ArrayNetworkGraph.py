@@ -0,0 +1,489 @@
+from array import array
+import collections
+
+"""
+    A NetworkGraph kept in parallel arrays, for the roots of very large overlays and for simulations.
+
+    Node i is entry i of every array: parent index, depth, alive flag, child count and sub-tree size, plus a first
+    child / next sibling list for the walks down from the root. An address -> index dict finds the nodes. The API is
+    the one of NetworkGraph; find_node, iter_nodes and friends return ArrayGraphNode views with the attributes of a
+    GraphNode. Root uses it when config.network_graph is 'arrays'.
+
+    The bulk operations (turn_off_subtree, depth_histogram and the sub-tree of a removed node) are single passes over
+    the arrays, vectorized with NumPy when it is installed and the work is big enough to pay for it.
+
+    A removed node keeps its entry, without an address in the index, until its orphaned children have been placed
+    again; then the entry is reused by the next new node.
+"""
+
+# Finding the sub-tree of a node with NumPy costs about (entries x log(depth)), walking it about (sub-tree size); so
+# NumPy is used only for sub-trees with NUMPY_MIN_SUBTREE nodes and at least 1/NUMPY_SUBTREE_SHARE of the entries.
+NUMPY_MIN_SUBTREE = 1024
+NUMPY_SUBTREE_SHARE = 10
+# depth_histogram counts with NumPy from this many entries on.
+NUMPY_MIN_NODES = 2048
+
+_numpy = None
+
+
+def _get_numpy():
+    """
+    NumPy is optional and slow to import, so it is imported with the first big pass.
+
+    :return: The numpy module, or False if it is not installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+class ArrayGraphNode:
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index):
+        """
+        A view of one node of an ArrayNetworkGraph, with the attributes of a GraphNode.
+
+        Warnings:
+            1. Once the node is removed its entry may be reused, so do not keep views across changes of the graph.
+
+        :type graph: ArrayNetworkGraph
+        :type index: int
+        """
+        self.graph = graph
+        self.index = index
+
+    @property
+    def address(self):
+        return self.graph._addresses[self.index]
+
+    @property
+    def parent(self):
+        return self.graph._view(self.graph._parent[self.index])
+
+    @property
+    def alive(self):
+        return bool(self.graph._alive[self.index])
+
+    @alive.setter
+    def alive(self, alive):
+        self.graph._alive[self.index] = 1 if alive else 0
+
+    @property
+    def children(self):
+        return [self.graph._view(child) for child in self.graph._children(self.index)]
+
+    @property
+    def depth(self):
+        """
+        :return: Hops from the root; -1 while the node is in an orphaned sub-tree.
+        """
+        return self.graph._depth[self.index]
+
+    @property
+    def subtree_size(self):
+        return self.graph._subtree_size[self.index]
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayGraphNode) and other.graph is self.graph and other.index == self.index
+
+    def __hash__(self):
+        return hash(self.index)
+
+
+class ArrayNetworkGraph:
+    def __init__(self, root_address):
+        """
+
+        :param root_address: (ip, port) of the root.
+        :type root_address: tuple
+
+        """
+        self._parent = array('i')
+        self._depth = array('i')
+        self._alive = array('b')
+        self._child_count = array('i')
+        self._subtree_size = array('i')
+        self._first_child = array('i')
+        self._next_sibling = array('i')
+        self._addresses = []
+        # Address -> index of the node.
+        self._index = {}
+        # Reusable entries, and removed nodes whose entry still holds orphaned children.
+        self._free = []
+        self._removed = set()
+        self._index[root_address] = self._new_entry(root_address)
+        self._depth[0] = 0
+        self.root = ArrayGraphNode(self, 0)
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def nodes(self):
+        """
+        :return: Views of all our nodes, orphans included, like NetworkGraph.nodes; len(graph) is cheaper.
+        :rtype: list
+        """
+        return [self._view(index) for index in self._index.values()]
+
+    def _view(self, index):
+        if index == 0:
+            return self.root
+        return ArrayGraphNode(self, index) if index >= 0 else None
+
+    def _new_entry(self, address):
+        if self._free:
+            index = self._free.pop()
+            self._addresses[index] = address
+            self._alive[index] = 1
+            self._subtree_size[index] = 1
+            return index
+        self._addresses.append(address)
+        self._parent.append(-1)
+        self._depth.append(-1)
+        self._alive.append(1)
+        self._child_count.append(0)
+        self._subtree_size.append(1)
+        self._first_child.append(-1)
+        self._next_sibling.append(-1)
+        return len(self._addresses) - 1
+
+    def _release(self, index):
+        self._addresses[index] = None
+        self._parent[index] = -1
+        self._depth[index] = -1
+        self._alive[index] = 0
+        self._child_count[index] = 0
+        self._first_child[index] = -1
+        self._next_sibling[index] = -1
+        self._free.append(index)
+
+    def _children(self, index):
+        children = []
+        child = self._first_child[index]
+        while child != -1:
+            children.append(child)
+            child = self._next_sibling[child]
+        return children
+
+    def _attach(self, index, parent):
+        """
+        Make index, with its sub-tree, the last child of parent.
+        """
+        self._parent[index] = parent
+        self._next_sibling[index] = -1
+        child = self._first_child[parent]
+        if child == -1:
+            self._first_child[parent] = index
+        else:
+            while self._next_sibling[child] != -1:
+                child = self._next_sibling[child]
+            self._next_sibling[child] = index
+        self._child_count[parent] += 1
+        size, ancestor = self._subtree_size[index], parent
+        while ancestor != -1:
+            self._subtree_size[ancestor] += size
+            ancestor = self._parent[ancestor]
+        self._set_depths(index, self._depth[parent] + 1 if self._depth[parent] >= 0 else -1)
+
+    def _detach(self, index):
+        """
+        Take index, with its sub-tree, away from its parent.
+        """
+        parent = self._parent[index]
+        if parent == -1:
+            return
+        child = self._first_child[parent]
+        if child == index:
+            self._first_child[parent] = self._next_sibling[index]
+        else:
+            while self._next_sibling[child] != index:
+                child = self._next_sibling[child]
+            self._next_sibling[child] = self._next_sibling[index]
+        self._parent[index] = -1
+        self._next_sibling[index] = -1
+        self._child_count[parent] -= 1
+        size, ancestor = self._subtree_size[index], parent
+        while ancestor != -1:
+            self._subtree_size[ancestor] -= size
+            ancestor = self._parent[ancestor]
+        if parent in self._removed and self._child_count[parent] == 0:
+            self._removed.discard(parent)
+            self._release(parent)
+
+    def _set_depths(self, index, depth):
+        self._depth[index] = depth
+        queue = [index]
+        for v in queue:
+            child = self._first_child[v]
+            while child != -1:
+                self._depth[child] = self._depth[v] + 1 if depth >= 0 else -1
+                queue.append(child)
+                child = self._next_sibling[child]
+
+    def _subtree(self, index):
+        """
+        :return: Indexes of index and its sub-tree; a NumPy array for big sub-trees, else a list.
+        """
+        size = self._subtree_size[index]
+        # Only attached nodes have depths; orphaned sub-trees are walked.
+        big = size >= NUMPY_MIN_SUBTREE and size * NUMPY_SUBTREE_SHARE >= len(self._parent) and self._depth[index] >= 0
+        numpy = _get_numpy() if big else False
+        if not numpy:
+            queue = [index]
+            for v in queue:
+                queue.extend(self._children(v))
+            return queue
+        # Lift every deeper node to its ancestor at the depth of index, a power of two of levels per pass.
+        parent = numpy.frombuffer(self._parent, dtype=numpy.dtype(self._parent.typecode))
+        depths = numpy.frombuffer(self._depth, dtype=numpy.dtype(self._depth.typecode))
+        candidates = numpy.flatnonzero(depths > depths[index])
+        steps = depths[candidates] - depths[index]
+        ancestors, up, bit = candidates, parent, 1
+        while bit <= steps.max(initial=0):
+            jump = (steps & bit) != 0
+            ancestors = numpy.where(jump, up[ancestors], ancestors)
+            up, bit = up[up], bit << 1
+        return numpy.append(candidates[ancestors == index], index)
+
+    def _fill(self, column, indexes, value):
+        numpy = _get_numpy()
+        if numpy and isinstance(indexes, numpy.ndarray):
+            numpy.frombuffer(column, dtype=numpy.dtype(column.typecode))[indexes] = value
+        else:
+            for index in indexes:
+                column[index] = value
+
+    def _in_moved_subtree(self, address, top, moved):
+        """
+        :param moved: Address -> new parent address of the nodes that will move.
+        :return: Whether address is in the sub-tree of top, once the nodes in moved have moved.
+        """
+        index = self._index.get(address)
+        while True:
+            if address == top:
+                return True
+            if address in moved:
+                address = moved[address]
+                index = self._index.get(address)
+            elif index is None or self._parent[index] == -1:
+                return False
+            else:
+                index = self._parent[index]
+                address = self._addresses[index]
+
+    def find_live_node(self, sender):
+        """
+        NetworkGraph.find_live_node: the live node nearest the root with less than two children, out of the sender
+        sub-tree and other than its current parent.
+
+        :param sender: The node address we want to find best neighbour for it.
+        :type sender: tuple
+
+        :return: Best neighbour for sender.
+        :rtype: ArrayGraphNode
+        """
+        sender_index = self._index.get(sender)
+        if len([child for child in self._children(0) if child != sender_index]) < 2:
+            return self.root
+
+        queue = collections.deque([0])
+        while queue:
+            v = queue.popleft()
+            child = self._first_child[v]
+            while child != -1:
+                if self._alive[child] and self._addresses[child] != sender:
+                    if self._child_count[child] < 2:
+                        if sender_index is None or (child != sender_index and self._parent[sender_index] != child):
+                            return self._view(child)
+                    queue.append(child)
+                child = self._next_sibling[child]
+        return None
+
+    def find_live_nodes(self, senders):
+        """
+        NetworkGraph.find_live_nodes: find_live_node for a batch of senders with a single BFS over the free slots.
+
+        :param senders: Addresses of the senders, without duplicates.
+        :type senders: list
+
+        :return: Sender address -> parent address; None if there is no place for the sender.
+        :rtype: dict
+        """
+        slots = []
+        slot_of = {}
+        queue = collections.deque([0])
+        while queue:
+            v = queue.popleft()
+            slot = [self._addresses[v], 2 - self._child_count[v]]
+            slot_of[slot[0]] = slot
+            if slot[1] > 0:
+                slots.append(slot)
+            child = self._first_child[v]
+            while child != -1:
+                if self._alive[child]:
+                    queue.append(child)
+                child = self._next_sibling[child]
+
+        parents = {}
+        # Senders moved by this batch -> their new parent, so the sub-trees are the ones after the earlier moves.
+        moved = {}
+        start = 0
+        for sender in senders:
+            sender_index = self._index.get(sender)
+            old_parent = self._parent[sender_index] if sender_index is not None else -1
+            # A removed entry keeps its address until its orphans are placed again; if the address has registered
+            # again, the orphan's parent is not that new node.
+            if old_parent != -1 and self._index.get(self._addresses[old_parent]) != old_parent:
+                old_parent = -1
+            stays = old_parent == 0
+            parent = self.root.address if stays else None
+            if not stays:
+                while start < len(slots) and slots[start][1] <= 0:
+                    start += 1
+                for i in range(start, len(slots)):
+                    slot = slots[i]
+                    if slot[1] <= 0:
+                        continue
+                    if sender_index is not None:
+                        if self._in_moved_subtree(slot[0], sender, moved):
+                            continue
+                        if old_parent != -1 and slot[0] == self._addresses[old_parent]:
+                            continue
+                    parent = slot[0]
+                    slot[1] -= 1
+                    break
+            parents[sender] = parent
+            if parent is None or stays:
+                continue
+            moved[sender] = parent
+            if sender not in slot_of:
+                # A new (or turned off) sender becomes a live node with free slots of its own.
+                slot = [sender, 2 - self._child_count[sender_index] if sender_index is not None else 2]
+                slot_of[sender] = slot
+                if slot[1] > 0:
+                    slots.append(slot)
+            if old_parent != -1 and self._addresses[old_parent] in slot_of:
+                # The old parent of a moving sender has one more free slot.
+                old_slot = slot_of[self._addresses[old_parent]]
+                old_slot[1] += 1
+                if old_slot[1] == 1:
+                    slots.append(old_slot)
+        return parents
+
+    def iter_nodes(self):
+        """
+        Walk the graph from the root with BFS, so every parent comes before its children.
+
+        :return: Generator of ArrayGraphNodes.
+        """
+        queue = collections.deque([0])
+        while queue:
+            v = queue.popleft()
+            yield self._view(v)
+            queue.extend(self._children(v))
+
+    def find_node(self, ip, port):
+        index = self._index.get((ip, port))
+        return self._view(index) if index is not None else None
+
+    def place_node(self, ip, port, father_address):
+        """
+        Add the node under father_address, or move it there with its sub-tree if it already exists.
+
+        :param ip: IP address of the node.
+        :param port: Port of the node.
+        :param father_address: Father address of the node
+
+        :return:
+        """
+        index = self._index.get((ip, port))
+        if index is None:
+            self.add_node(ip, port, father_address)
+            return
+        parent = self._index.get(tuple(father_address))
+        if parent is not None:
+            self._detach(index)
+            self._attach(index, parent)
+            self._alive[index] = 1
+
+    def turn_on_node(self, node_address):
+        self._alive[self._index[tuple(node_address)]] = 1
+
+    def turn_off_node(self, node_address):
+        self._alive[self._index[tuple(node_address)]] = 0
+
+    def turn_off_subtree(self, node_address):
+        """
+        Turn off the node and every node of its sub-tree in one pass.
+
+        :param node_address: (ip, port)
+        :return: Number of nodes in the sub-tree.
+        :rtype: int
+        """
+        indexes = self._subtree(self._index[tuple(node_address)])
+        self._fill(self._alive, indexes, 0)
+        return len(indexes)
+
+    def remove_node(self, node_address):
+        """
+        Remove the node; its sub-tree is turned off and stays, orphaned, until its nodes are placed again.
+
+        :param node_address: (ip, port)
+        :return:
+        """
+        index = self._index.pop(tuple(node_address))
+        indexes = self._subtree(index)
+        self._fill(self._alive, indexes, 0)
+        self._fill(self._depth, indexes, -1)
+        self._detach(index)
+        if self._child_count[index] == 0:
+            self._release(index)
+        else:
+            self._removed.add(index)
+
+    def add_node(self, ip, port, father_address):
+        """
+        Add a new node under father_address, if there is a node with that address.
+
+        :param ip: IP address of the new node.
+        :param port: Port of the new node.
+        :param father_address: Father address of the new node
+
+        :type ip: str
+        :type port: int
+        :type father_address: tuple
+
+        :return:
+        """
+        parent = self._index.get(tuple(father_address))
+        if parent is not None:
+            index = self._new_entry((ip, port))
+            self._index[(ip, port)] = index
+            self._attach(index, parent)
+
+    def depth_histogram(self, live_only=False):
+        """
+        :param live_only: Count only the nodes that are not turned off.
+        :return: Number of nodes at every depth of the tree (orphaned sub-trees are not in it); [1] for a lone root.
+        :rtype: list
+        """
+        numpy = _get_numpy() if len(self._depth) >= NUMPY_MIN_NODES else False
+        if numpy:
+            depths = numpy.frombuffer(self._depth, dtype=numpy.dtype(self._depth.typecode))
+            counted = depths >= 0
+            levels = int(depths[counted].max()) + 1
+            if live_only:
+                counted &= numpy.frombuffer(self._alive, dtype=numpy.dtype(self._alive.typecode)) != 0
+            return numpy.bincount(depths[counted], minlength=levels).tolist()
+        counts = [0] * (max(self._depth) + 1)
+        for depth, alive in zip(self._depth, self._alive):
+            if depth >= 0 and (alive or not live_only):
+                counts[depth] += 1
+        return counts
@@ -0,0 +1,85 @@
+import hashlib
+
+"""
+    Bloom filters of topics, for the topic subscriptions of a subtree (see Peer and the Topic flag in Packet).
+
+    A filter is 'size' bits; every topic sets 'hashes' of them, chosen by double hashing a BLAKE2b digest so every
+    peer finds the same bits. Filters of the same shape merge with update(); a topic that was added is always found,
+    others are found with a small probability (a relay then forwards a message nobody in the subtree wants).
+
+    On the wire a filter is its bits as hex, then Hashes (1 Char) and Size (5 Chars), see to_string.
+"""
+
+
+class BloomFilter:
+    __slots__ = ('size', 'hashes', 'bits')
+
+    def __init__(self, size=512, hashes=3, bits=0):
+        """
+        :param size: Number of bits; a multiple of 4.
+        :param hashes: Bits set per topic.
+        :param bits: The bits, as an int.
+
+        :type size: int
+        :type hashes: int
+        :type bits: int
+        """
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits
+
+    def _positions(self, topic):
+        digest = hashlib.blake2b(topic.encode('utf-8'), digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], 'big')
+        h2 = int.from_bytes(digest[4:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, topic):
+        for position in self._positions(topic):
+            self.bits |= 1 << position
+
+    def __contains__(self, topic):
+        bits = self.bits
+        return all(bits >> position & 1 for position in self._positions(topic))
+
+    def __eq__(self, other):
+        return isinstance(other, BloomFilter) and \
+            (self.size, self.hashes, self.bits) == (other.size, other.hashes, other.bits)
+
+    def update(self, other):
+        """
+        Add the topics of other to us.
+
+        :type other: BloomFilter
+        :return: False, and we are not changed, if other has another shape.
+        :rtype: bool
+        """
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            return False
+        self.bits |= other.bits
+        return True
+
+    def to_string(self):
+        """
+        :return: Bits (size / 4 hex Chars), Hashes (1 Char), Size (5 Chars).
+        :rtype: str
+        """
+        return '{:0{}x}{}{:05d}'.format(self.bits, self.size // 4, self.hashes, self.size)
+
+    @staticmethod
+    def split_string(text):
+        """
+        :param text: Anything that ends with a filter made by to_string.
+        :return: The text before the filter and the filter; the filter is None if it is broken.
+        :rtype: tuple
+        """
+        try:
+            size = int(text[-5:])
+            hashes = int(text[-6])
+            start = len(text) - 6 - size // 4
+            if size <= 0 or size % 4 or hashes <= 0 or start < 0:
+                return text, None
+            bits = int(text[start:-6], 16)
+        except (ValueError, IndexError):
+            return text, None
+        return text[:start], BloomFilter(size, hashes, bits)
@@ -0,0 +1,218 @@
+from tools.simpletcp.clientsocket import ClientSocket
+from config import reconnect_base_delay, reconnect_max_delay, reconnect_grace_time
+import collections
+import random
+import threading
+import time
+
+
+class Connection:
+    def __init__(self, address, duplex=False, on_connect=None, socket_options=None):
+        """
+        One persistent connection to a peer TCPServer.
+
+        The ClientSocket is opened lazily on the first send and reopened after a failure; failed attempts are spaced
+        with exponential backoff plus jitter so a dead peer costs us almost nothing.
+
+        In duplex mode we don't wait for a response after each send; the peer answers on the same socket whenever
+        it wants and on_connect(socket) must hand every new socket to someone who reads it (our TCPServer).
+
+        :param address: (ip, port) of the peer TCPServer.
+        :param duplex: Whether the peer sends its packets back through this connection.
+        :param on_connect: Called with every newly connected socket.socket.
+        :param socket_options: Set on every new socket.
+        :type address: tuple
+        :type duplex: bool
+        :type socket_options: SocketOptions
+        """
+        self.address = address
+        self.duplex = duplex
+        self.on_connect = on_connect
+        self.socket_options = socket_options
+        self.client_socket = None
+        self.users = 0
+        self.failures = 0
+        self.next_attempt = 0
+        # Time of the first failure of the current outage; None while the connection is healthy.
+        self.down_since = None
+        self.counters = {'connects': 0, 'reconnects': 0, 'failures': 0}
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        """
+        Send data and wait for the peer response.
+
+        Warnings:
+            1. Raise ConnectionError without touching the network while we are waiting for the next attempt.
+
+        :param data: The message we want to send.
+        :type data: bytes
+
+        :return: The peer response.
+        :rtype: bytes
+        """
+        with self._lock:
+            if self.client_socket is None:
+                self._connect()
+            try:
+                response = self.client_socket.send(data)
+            except Exception:
+                self._disconnected()
+                raise ConnectionError
+            if not response and not self.duplex:
+                # An empty response means that the peer has closed the connection.
+                self._disconnected()
+                raise ConnectionError
+            self.failures = 0
+            self.down_since = None
+            return response
+
+    def in_grace_time(self):
+        """
+        :return: Whether the connection is down for less than reconnect_grace_time seconds.
+        :rtype: bool
+        """
+        return self.down_since is not None and time.time() - self.down_since < reconnect_grace_time
+
+    def close(self):
+        with self._lock:
+            if self.client_socket is not None:
+                self.client_socket.close()
+                self.client_socket = None
+
+    def _connect(self):
+        if time.time() < self.next_attempt:
+            raise ConnectionError
+        client_socket = ClientSocket(mode='localhost', port=self.address[1], single_use=False, connect_now=False,
+                                     expect_response=not self.duplex, socket_options=self.socket_options)
+        try:
+            client_socket.connect()
+        except OSError:
+            client_socket.close()
+            self._disconnected()
+            raise ConnectionError
+        if self.on_connect is not None:
+            self.on_connect(client_socket.get_socket())
+        if self.counters['connects'] > 0:
+            self.counters['reconnects'] += 1
+        self.counters['connects'] += 1
+        self.client_socket = client_socket
+
+    def _disconnected(self):
+        if self.client_socket is not None:
+            self.client_socket.close()
+            self.client_socket = None
+        t = time.time()
+        if self.down_since is None:
+            self.down_since = t
+        self.failures += 1
+        self.counters['failures'] += 1
+        delay = min(reconnect_max_delay, reconnect_base_delay * 2 ** (self.failures - 1))
+        self.next_attempt = t + delay / 2 + random.uniform(0, delay / 2)
+
+
+class ReplyConnection:
+    # A root has one per registered client.
+    __slots__ = ('address', 'reply_queues', 'down_since', 'counters')
+
+    def __init__(self, address, reply_queues):
+        """
+        The way back to a peer through the socket that peer has connected to our TCPServer (a duplex connection).
+        Nothing is dialed; data is put on the ConnectionQueue of the accepted socket and our TCPServer writes it.
+
+        :param address: (ip, port) of the peer TCPServer.
+        :param reply_queues: Peer address -> ConnectionQueue of its latest accepted socket; kept up to date by Stream,
+                             so after the peer reconnects we use its new socket. close forgets the entry.
+        :type address: tuple
+        :type reply_queues: dict
+        """
+        self.address = address
+        self.reply_queues = reply_queues
+        self.down_since = None
+        self.counters = {'connects': 0, 'reconnects': 0, 'failures': 0}
+
+    def send(self, data):
+        connection_queue = self.reply_queues.get(self.address)
+        if connection_queue is None or connection_queue.closed:
+            if self.down_since is None:
+                self.down_since = time.time()
+                self.counters['failures'] += 1
+            raise ConnectionError
+        connection_queue.put(data)
+        self.down_since = None
+
+    def in_grace_time(self):
+        """
+        :return: Whether the peer socket is gone for less than reconnect_grace_time seconds.
+        :rtype: bool
+        """
+        return self.down_since is not None and time.time() - self.down_since < reconnect_grace_time
+
+    def close(self):
+        # The Node of the peer left the Stream (e.g. the root removed the client); a new register frame of the peer
+        # brings its queue back.
+        self.reply_queues.pop(self.address, None)
+
+
+class ConnectionPool:
+    def __init__(self, on_connect=None, socket_options=None):
+        """
+        Keeps at most one Connection per peer address and mode, shared by every Node that sends to that address
+        (e.g. the register_connection and the tree connection of a client whose parent is the root).
+
+        :param on_connect: Passed to the duplex connections, see Connection.
+        :param socket_options: Passed to every Connection.
+        """
+        self.connections = {}
+        self.on_connect = on_connect
+        self.socket_options = socket_options
+        # Counters of the connections that have already been closed.
+        self._closed_counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def get(self, address, duplex=False):
+        """
+        :param address: (ip, port) of the peer TCPServer.
+        :param duplex: Whether we want a duplex connection.
+        :type address: tuple
+        :type duplex: bool
+
+        :return: The shared connection to address.
+        :rtype: Connection
+        """
+        with self._lock:
+            connection = self.connections.get((address, duplex))
+            if connection is None:
+                connection = Connection(address, duplex, self.on_connect if duplex else None, self.socket_options)
+                self.connections[(address, duplex)] = connection
+            connection.users += 1
+            return connection
+
+    def release(self, connection):
+        """
+        Close the connection when its last user has released it.
+
+        :param connection: A connection we got from 'get'.
+        :type connection: Connection
+
+        :return:
+        """
+        with self._lock:
+            connection.users -= 1
+            if connection.users <= 0:
+                self.connections.pop((connection.address, connection.duplex), None)
+                self._closed_counters.update(connection.counters)
+                connection.close()
+
+    def get_counters(self):
+        """
+        Sum of the counters of all connections, including the closed ones.
+
+        :return: Counter name -> count
+        :rtype: dict
+        """
+        with self._lock:
+            counters = collections.Counter(self._closed_counters)
+            for connection in self.connections.values():
+                counters.update(connection.counters)
+        return dict(counters)
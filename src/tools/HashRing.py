@@ -0,0 +1,53 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        """
+        Consistent hashing of keys (client addresses) onto nodes (root addresses).
+        Every node is put on the ring 'replicas' times, so adding or removing a root only moves about 1/N of the keys.
+
+        :param nodes: Root addresses, like [('192.168.001.001', 5335), ...]
+        :param replicas: Virtual points per node.
+        :type nodes: list
+        :type replicas: int
+        """
+        self.nodes = list(nodes)
+        self._ring = sorted((HashRing._hash('{}#{}'.format(node, i)), node)
+                            for node in self.nodes for i in range(replicas))
+        self._keys = [point for point, node in self._ring]
+
+    def get(self, key):
+        """
+        :param key: A client address.
+        :type key: tuple
+
+        :return: The node that owns key.
+        """
+        return self.preference_list(key)[0]
+
+    def preference_list(self, key):
+        """
+        :param key: A client address.
+        :type key: tuple
+
+        :return: Every node once, in ring order starting from the owner of key; the next nodes take over the key
+                 when the owner is gone.
+        :rtype: list
+        """
+        if not self._ring:
+            return []
+        index = bisect.bisect(self._keys, HashRing._hash(str(key)))
+        nodes = []
+        for i in range(len(self._ring)):
+            node = self._ring[(index + i) % len(self._ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
@@ -0,0 +1,113 @@
+from config import log_levels, log_rate_limit, log_rate_interval, verbosity
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+"""
+    Logging for the peers.
+
+    Every category has its own logger under 'p2p' (get_logger('reunion') is 'p2p.reunion'), so config.log_levels
+    can set each category to its own level. The categories are:
+        root, client:   What the peers decide (placement, fail over, standby roots, ...).
+        reunion:        Reunion Hello timeouts and the nodes the root turns off or removes.
+        stream:         Nodes added to and removed from Streams.
+        packet:         Every handled packet (DEBUG).
+        message:        Every received Message packet (DEBUG).
+        socket:         simpletcp client sockets.
+
+    Records are put on a queue by a QueueHandler and written by a QueueListener thread, so a slow stdout never
+    blocks our main loops. Repeated records (the same logger and message format) are rate limited.
+"""
+
+ROOT_LOGGER = 'p2p'
+FORMAT = '%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s'
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit=log_rate_limit, interval=log_rate_interval):
+        """
+        Let at most 'limit' records with the same logger and message format through in every 'interval' seconds.
+        The first record after a suppression says how many similar records were dropped.
+
+        :param limit: Records per interval; 0 disables rate limiting.
+        :param interval: Seconds.
+        """
+        super(RateLimitFilter, self).__init__()
+        self.limit = limit
+        self.interval = interval
+        # (logger name, msg) -> [window start, records in the window, suppressed records]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.limit:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if len(self._windows) > 4096:
+                    self._forget_old(now)
+            elif window[1] < self.limit:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = '{} (suppressed {} similar messages)'.format(record.msg, suppressed)
+        return True
+
+    def _forget_old(self, now):
+        for key, window in list(self._windows.items()):
+            if now - window[0] >= self.interval and not window[2]:
+                del self._windows[key]
+
+
+def setup_logging(levels=None, stream=None):
+    """
+    Configure the 'p2p' loggers once per process; later calls do nothing.
+
+    :param levels: Category -> level name; config.log_levels by default. The '' category is every category.
+    :param stream: Where the QueueListener writes; sys.stdout by default.
+    :return:
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        levels = dict(log_levels if levels is None else levels)
+        if verbosity == 1:
+            levels.setdefault('packet', 'DEBUG')
+            levels.setdefault('socket', 'DEBUG')
+        handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(RateLimitFilter())
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        for category, level in levels.items():
+            get_logger(category).setLevel(level)
+        _listener = logging.handlers.QueueListener(log_queue, handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(category):
+    """
+    :param category: One of the categories above; '' is the 'p2p' logger itself.
+    :rtype: logging.Logger
+    """
+    return logging.getLogger(ROOT_LOGGER + '.' + category if category else ROOT_LOGGER)
@@ -0,0 +1,249 @@
+import math
+import threading
+
+"""
+    In-process metrics: counters, gauges and HDR-style histograms kept in a MetricsRegistry, with an optional
+    plain-text HTTP endpoint on localhost for scraping.
+
+    Every Stream owns a registry (Peer.metrics is the same object) and every metric is identified by its name and
+    labels:
+        metrics.counter('packets_in_total', type=4).inc()
+        metrics.histogram('main_loop_seconds').record(elapsed)
+        metrics.gauge('graph_nodes', function=lambda: len(graph.nodes))
+
+    Values that already live somewhere else (e.g. the out_buff counters of the nodes) are exposed with 'function'
+    and only read when somebody asks for them, so they cost nothing on the hot path.
+"""
+
+
+class Counter:
+    def __init__(self, function=None):
+        """
+        A value that only goes up.
+
+        :param function: If given, the counter value is function() instead of what was counted with inc.
+        """
+        self.value = 0
+        self.function = function
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge:
+    def __init__(self, function=None):
+        """
+        A value that goes up and down.
+
+        :param function: If given, the gauge value is function() instead of what was set.
+        """
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    def __init__(self, lowest=1e-6, sub_buckets=32):
+        """
+        Log-linear buckets like HdrHistogram: every power of two above 'lowest' is split into sub_buckets equal
+        buckets, so any recorded value is known within 1 / sub_buckets of itself (about 3% by default) while
+        the memory stays small for values spanning many orders of magnitude.
+
+        :param lowest: Smaller values are counted in the first bucket.
+        :param sub_buckets: Linear buckets per power of two.
+        :type lowest: float
+        :type sub_buckets: int
+        """
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        """
+        :param value: A non-negative sample, e.g. a duration in seconds.
+        :return:
+        """
+        if value <= self.lowest:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(value / self.lowest)
+            index = exponent * self.sub_buckets + int((mantissa * 2 - 1) * self.sub_buckets)
+        with self._lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def _bucket_value(self, index):
+        """
+        :return: Middle of the bucket.
+        """
+        if index == 0:
+            return min(self.min, self.lowest)
+        exponent, sub = divmod(index, self.sub_buckets)
+        return self.lowest * 2 ** (exponent - 1) * (1 + (sub + 0.5) / self.sub_buckets)
+
+    def percentile(self, point):
+        """
+        :param point: Between 0 and 100.
+        :return: The value below which point percent of the samples are; None without samples.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, math.ceil(point / 100 * self.count))
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    return min(max(self._bucket_value(index), self.min), self.max)
+            return self.max
+
+    def get(self):
+        """
+        :return: count, sum, min, max and the usual percentiles.
+        :rtype: dict
+        """
+        result = {'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max}
+        for point in (50, 90, 99, 99.9):
+            result['p{:g}'.format(point)] = self.percentile(point)
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = kind(**kwargs)
+                    self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, function=None, **labels):
+        """
+        :param name: Metric name, like 'packets_in_total'.
+        :param function: See Counter.
+        :param labels: Label name -> value.
+        :return: The counter, made on the first call.
+        :rtype: Counter
+        """
+        return self._get(Counter, name, labels, function=function)
+
+    def gauge(self, name, function=None, **labels):
+        """
+        :rtype: Gauge
+        """
+        return self._get(Gauge, name, labels, function=function)
+
+    def histogram(self, name, lowest=1e-6, sub_buckets=32, **labels):
+        """
+        :rtype: Histogram
+        """
+        return self._get(Histogram, name, labels, lowest=lowest, sub_buckets=sub_buckets)
+
+    def snapshot(self):
+        """
+        :return: 'name{label="value"}' -> value (a dict for histograms).
+        :rtype: dict
+        """
+        result = {}
+        for (name, labels), metric in sorted(self.metrics.copy().items(), key=lambda item: item[0]):
+            result[name + self._format_labels(labels)] = metric.get()
+        return result
+
+    def render_text(self):
+        """
+        Prometheus-like text format; histograms are written as summaries with quantiles.
+
+        :rtype: str
+        """
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(self.metrics.copy().items(), key=lambda item: item[0]):
+            kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'summary'}[type(metric)]
+            if name not in typed:
+                lines.append('# TYPE {} {}'.format(name, kind))
+                typed.add(name)
+            if isinstance(metric, Histogram):
+                value = metric.get()
+                for point in (50, 90, 99, 99.9):
+                    quantile_labels = labels + (('quantile', '{:g}'.format(point / 100)),)
+                    lines.append('{}{} {}'.format(name, self._format_labels(quantile_labels),
+                                                  self._format_value(value['p{:g}'.format(point)])))
+                lines.append('{}_count{} {}'.format(name, self._format_labels(labels), value['count']))
+                lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), self._format_value(value['sum'])))
+            else:
+                lines.append('{}{} {}'.format(name, self._format_labels(labels), self._format_value(metric.get())))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+    @staticmethod
+    def _format_value(value):
+        if value is None:
+            return 'NaN'
+        return '{:g}'.format(value) if isinstance(value, float) else str(value)
+
+
+class MetricsServer:
+    def __init__(self, registry, port, host='127.0.0.1'):
+        """
+        Serve registry.render_text() on http://host:port/ from a daemon thread.
+
+        :param registry:
+        :param port:
+        :param host: Keep it on localhost; there is no authentication.
+        :type registry: MetricsRegistry
+        """
+        # Only peers with a metrics endpoint pay for importing http.server.
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render_text().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), Handler)
+        self.http_server.daemon_threads = True
+        self.t_server = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.t_server.start()
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
@@ -3,6 +3,8 @@ import time
 
 
 class GraphNode:
+    __slots__ = ('address', 'parent', 'alive', 'children')
+
     def __init__(self, address):
         """
 
@@ -34,6 +36,11 @@ class NetworkGraph:
         self.root = root
         root.alive = True
         self.nodes = [root]
+        # Address -> GraphNode, so find_node does not walk the whole nodes list.
+        self._index = {root.address: root}
+
+    def __len__(self):
+        return len(self.nodes)
 
     def find_live_node(self, sender):
         """
@@ -54,7 +61,7 @@ class NetworkGraph:
         :rtype: GraphNode
         """
         sender_node = self.find_node(sender[0], sender[1])
-        if len(self.root.children) < 2:
+        if len([child for child in self.root.children if child is not sender_node]) < 2:
             return self.root
 
         visited, queue = set(), collections.deque([self.root])
@@ -71,11 +78,135 @@ class NetworkGraph:
                         queue.append(u)
         return None
 
+    def iter_nodes(self):
+        """
+        Walk the graph from the root with BFS, so every parent comes before its children.
+
+        :return: Generator of GraphNodes.
+        """
+        queue = collections.deque([self.root])
+        while queue:
+            v = queue.popleft()
+            yield v
+            queue.extend(v.children.copy())
+
+    def place_node(self, ip, port, father_address):
+        """
+        Add the node under father_address, or move it there with its sub-tree if it already exists.
+
+        :param ip: IP address of the node.
+        :param port: Port of the node.
+        :param father_address: Father address of the node
+
+        :return:
+        """
+        node = self.find_node(ip, port)
+        if node is None:
+            self.add_node(ip, port, father_address)
+            return
+        father_ip, father_port = father_address
+        parent = self.find_node(father_ip, father_port)
+        if parent is not None:
+            if node.parent is not None and node in node.parent.children:
+                node.parent.children.remove(node)
+            node.set_parent(parent)
+            parent.add_child(node)
+            node.alive = True
+
+    def find_live_nodes(self, senders):
+        """
+        find_live_node for a batch of senders with a single BFS: the free slots (nodes with less than two children)
+        are collected in BFS order once and handed out one by one, so the parents we choose never conflict and a
+        sender placed earlier in the batch can already be the parent of a later one.
+
+        Warnings:
+            1. The same rules as find_live_node: never choose the sender, its sub-tree (with the senders placed in it
+               earlier in the batch) or (except for the root) its current parent.
+            2. Nothing is changed here; add the senders with place_node in the same order.
+
+        :param senders: Addresses of the senders, without duplicates.
+        :type senders: list
+
+        :return: Sender address -> parent address; None if there is no place for the sender.
+        :rtype: dict
+        """
+        slots = []
+        slot_of = {}
+        visited, queue = {self.root}, collections.deque([self.root])
+        while queue:
+            v = queue.popleft()
+            slot = [v.address, 2 - len(v.children)]
+            slot_of[v.address] = slot
+            if slot[1] > 0:
+                slots.append(slot)
+            for u in v.children:
+                if u not in visited and u.alive:
+                    visited.add(u)
+                    queue.append(u)
+
+        parents = {}
+        # Senders moved by this batch -> their new parent, so the sub-trees are the ones after the earlier moves.
+        moved = {}
+        start = 0
+        for sender in senders:
+            sender_node = self.find_node(sender[0], sender[1])
+            # The parent of an orphan of a removed node is no longer in the graph, even if its address has been
+            # registered again; match it by identity, not by address.
+            old_parent = sender_node.parent if sender_node is not None else None
+            if old_parent is not None and self._index.get(old_parent.address) is not old_parent:
+                old_parent = None
+            stays = sender_node is not None and sender_node.parent is self.root
+            parent = self.root.address if stays else None
+            if not stays:
+                while start < len(slots) and slots[start][1] <= 0:
+                    start += 1
+                for i in range(start, len(slots)):
+                    slot = slots[i]
+                    if slot[1] <= 0 or (sender_node is not None and self._in_subtree(slot[0], sender, moved)):
+                        continue
+                    if old_parent is not None and slot[0] == old_parent.address:
+                        continue
+                    parent = slot[0]
+                    slot[1] -= 1
+                    break
+            parents[sender] = parent
+            if parent is None or stays:
+                continue
+            moved[sender] = parent
+            if sender not in slot_of:
+                # A new (or turned off) sender becomes a live node with free slots of its own.
+                slot = [sender, 2 - len(sender_node.children) if sender_node is not None else 2]
+                slot_of[sender] = slot
+                if slot[1] > 0:
+                    slots.append(slot)
+            if old_parent is not None and old_parent.address in slot_of:
+                # The old parent of a moving sender has one more free slot.
+                old_slot = slot_of[old_parent.address]
+                old_slot[1] += 1
+                if old_slot[1] == 1:
+                    slots.append(old_slot)
+        return parents
+
+    def _in_subtree(self, address, top, moved):
+        """
+        :param moved: Address -> new parent address of the nodes that will move.
+        :return: Whether address is in the sub-tree of top, once the nodes in moved have moved.
+        """
+        node = self._index.get(address)
+        while True:
+            if address == top:
+                return True
+            if address in moved:
+                address = moved[address]
+                node = self._index.get(address)
+            elif node is None or node.parent is None:
+                return False
+            else:
+                node = node.parent
+                address = node.address
+
     def find_node(self, ip, port):
-        for node in self.nodes:
-            if node.address == (ip, port):
-                return node
-        return None
+        return self._index.get((ip, port))
 
     def turn_on_node(self, node_address):
         ip, port = node_address
@@ -102,6 +233,35 @@ class NetworkGraph:
         parent = node.parent
         parent.children.remove(node)
         self.nodes.remove(node)
+        del self._index[node.address]
+
+    def turn_off_subtree(self, node_address):
+        """
+        Turn off the node and every node of its sub-tree.
+
+        :param node_address: (ip, port)
+        :return: Number of nodes in the sub-tree.
+        :rtype: int
+        """
+        ip, port = node_address
+        queue = [self.find_node(ip, port)]
+        for v in queue:
+            v.alive = False
+            queue.extend(v.children)
+        return len(queue)
+
+    def depth_histogram(self, live_only=False):
+        """
+        :param live_only: Count only the nodes that are not turned off.
+        :return: Number of nodes at every depth of the tree (orphaned sub-trees are not in it); [1] for a lone root.
+        :rtype: list
+        """
+        counts = []
+        level = [self.root]
+        while level:
+            counts.append(sum(1 for v in level if v.alive or not live_only))
+            level = [u for v in level for u in v.children]
+        return counts
 
     def add_node(self, ip, port, father_address):
         """
@@ -129,3 +289,4 @@ class NetworkGraph:
             node.set_parent(parent)
             parent.add_child(node)
             self.nodes.append(node)
+            self._index[node.address] = node
@@ -1,57 +1,238 @@
-from tools.simpletcp.clientsocket import ClientSocket
+from tools.ConnectionPool import Connection
+from config import out_buff_max_messages, out_buff_max_bytes, out_buff_policy, out_buff_block_timeout
+import collections
+import functools
+import threading
+import time
+
+
+_EMPTY = ()
+# The counters of a node that has not blocked or dropped anything yet.
+_NO_COUNTERS = {'blocked': 0, 'block_timeouts': 0, 'dropped_oldest': 0, 'dropped_newest': 0, 'disconnected': 0,
+                'dropped_control': 0}
 
 
 class Node:
-    def __init__(self, server_address, set_root=False, set_register=False):
+    # A root keeps a Node per registered client, so they are slotted and make their Condition and counters only
+    # when they are first needed.
+    __slots__ = ('server_ip', 'server_port', 'connection_pool', 'connection', 'is_root', 'is_register', 'out_buff',
+                 'control_buff', 'out_buff_bytes', 'max_messages', 'max_bytes', 'policy', 'block_timeout', 'is_slow', '_counters',
+                 'before_send', '_out_buff_lock', '_out_buff_cond', '_send_lock')
+
+    def __init__(self, server_address, set_root=False, set_register=False, connection_pool=None, duplex=False,
+                 connection=None):
         """
         The Node object constructor.
 
         This object is our low-level abstraction for other peers in the network.
-        Every node has a ClientSocket that should bind to the Node TCPServer address.
+        Every node has a Connection (a lazily reconnecting ClientSocket) to the Node TCPServer address.
 
         Warnings:
-            1. Insert an exception handler when initializing the ClientSocket; when a socket closed here we will face to
-               an exception and we should detach this Node and clear its output buffer.
+            1. Short connection outages are hidden by the Connection; only when an outage outlives
+               reconnect_grace_time 'send_message' raises and we should detach this Node.
 
         :param server_address: tuple
         :param set_root:
         :param set_register:
+        :param connection_pool: Share the connection with other Nodes to the same address.
+        :param duplex: Ask for a duplex connection; the peer answers through it instead of dialing us.
+        :param connection: Use this connection (e.g. a ReplyConnection) instead of making one.
+        :type connection_pool: ConnectionPool
+        :type duplex: bool
         """
         self.server_ip = Node.parse_ip(server_address[0])
         self.server_port = server_address[1]
-        self.client_socket = ClientSocket(mode='localhost', port=self.server_port, single_use=False)
+        self.connection_pool = None
+        if connection is not None:
+            self.connection = connection
+        elif connection_pool is not None:
+            self.connection_pool = connection_pool
+            self.connection = connection_pool.get(self.get_server_address(), duplex)
+        else:
+            self.connection = Connection(self.get_server_address())
         self.is_root = set_root
         self.is_register = set_register
-        self.out_buff = []
+        # An idle node keeps no deque: out_buff is _EMPTY until a message comes and again once it is flushed.
+        self.out_buff = _EMPTY
+        # Control packets (see Stream.is_control_frame) wait here and are sent before anything in out_buff.
+        self.control_buff = _EMPTY
+        self.out_buff_bytes = 0
+        self.max_messages = out_buff_max_messages
+        self.max_bytes = out_buff_max_bytes
+        self.policy = out_buff_policy
+        self.block_timeout = out_buff_block_timeout
+        # Set when the 'disconnect' policy decides this node is a slow consumer; Stream will remove it.
+        self.is_slow = False
+        self._counters = None
+        # Called with every frame right before it is sent, returns the frame to send; see Stream._stamp_frame.
+        self.before_send = None
+        # Guards out_buff; _out_buff_cond is made on it by the first 'block' wait.
+        self._out_buff_lock = threading.Lock()
+        self._out_buff_cond = None
+        # Only one thread at a time may flush this out_buff.
+        self._send_lock = threading.Lock()
 
     def send_message(self):
         """
         Final function to send buffer to the client's socket.
 
+        Warnings:
+            1. A message is taken out of its buffer while it is sent, so the drop policies (and the maxlen of
+               control_buff) can not evict it meanwhile; if the send fails it goes back in front, so the unsent
+               messages stay buffered. out_buff_bytes counts it until it was sent.
+            2. While the connection is in its grace time we return quietly and retry on the next call.
+            3. control_buff goes first, also when control packets come while out_buff is being sent.
+            4. before_send may change a frame on its way out (the trace forward time); the buffer keeps the original.
+
         :return:
         """
-        for data in self.out_buff:
-            try:
-                self.client_socket.send(data)
-            except Exception:
-                raise Exception
-        self.out_buff.clear()
+        with self._send_lock:
+            while True:
+                with self._out_buff_lock:
+                    lane = self.control_buff or self.out_buff
+                    if not lane:
+                        return
+                    data = lane.popleft()
+                try:
+                    self.connection.send(data if self.before_send is None else self.before_send(data))
+                except Exception:
+                    with self._out_buff_lock:
+                        if len(lane) == lane.maxlen:
+                            # A full control_buff drops its newest packet to take this one back.
+                            self._count('dropped_control')
+                        lane.appendleft(data)
+                    if self.connection.in_grace_time():
+                        return
+                    raise Exception
+                with self._out_buff_lock:
+                    if lane is self.control_buff:
+                        if not lane:
+                            self.control_buff = _EMPTY
+                        continue
+                    self.out_buff_bytes -= len(data)
+                    if not self.out_buff:
+                        self.out_buff = _EMPTY
+                    if self._out_buff_cond is not None:
+                        self._out_buff_cond.notify_all()
 
-    def add_message_to_out_buff(self, message):
+    def add_message_to_out_buff(self, message, control=False):
         """
         Here we will add a new message to the server out_buff, then in 'send_message' will send them.
 
+        Control packets go to control_buff instead, which is outside the policy below: they never wait for, or are
+        dropped because of, the data in out_buff. It keeps at most max_messages of them, dropping the oldest.
+
+        When out_buff is full (max_messages or max_bytes) the node policy decides what happens:
+            block:       Send the buffered messages from this thread, for up to block_timeout seconds, until there
+                         is room. Producers run on the main loop, which is also the one that flushes out_buff, so
+                         waiting for somebody else to flush would never end.
+            drop_oldest: Discard the oldest buffered messages to make room.
+            drop_newest: Discard this message.
+            disconnect:  Discard this message and mark the node as slow, so Stream removes it.
+
         :param message: The message we want to add to out_buff
+        :param control: Whether the message is a control packet.
+        :return: Whether the message was buffered or not.
+        :rtype: bool
+        """
+        size = len(message)
+        if not control and self.policy == 'block' and not self._make_room(size):
+            return False
+        with self._out_buff_lock:
+            if self.is_slow:
+                return False
+            if control:
+                if self.control_buff is _EMPTY:
+                    self.control_buff = collections.deque(maxlen=self.max_messages)
+                elif len(self.control_buff) == self.max_messages:
+                    self._count('dropped_control')
+                self.control_buff.append(message)
+                return True
+            # Under 'block' _make_room has made room; another producer may have taken some of it since.
+            if not self._has_room(size) and self.policy != 'block':
+                if self.policy == 'drop_oldest':
+                    while self.out_buff and not self._has_room(size):
+                        self.out_buff_bytes -= len(self.out_buff.popleft())
+                        self._count('dropped_oldest')
+                elif self.policy == 'disconnect':
+                    self.is_slow = True
+                    self._count('disconnected')
+                    return False
+                else:
+                    self._count('dropped_newest')
+                    return False
+            if self.out_buff is _EMPTY:
+                self.out_buff = collections.deque()
+            self.out_buff.append(message)
+            self.out_buff_bytes += size
+        return True
+
+    def _make_room(self, size):
+        """
+        The 'block' policy: flush out_buff from the producer thread until a message of size bytes fits.
+
+        :param size: Size of the new message in bytes.
+        :return: Whether there is room; False after block_timeout seconds or if the connection is broken (Stream
+                 removes the node on its next flush then).
+        :rtype: bool
+        """
+        with self._out_buff_lock:
+            if self._has_room(size):
+                return True
+            self._count('blocked')
+        deadline = time.monotonic() + self.block_timeout
+        while True:
+            try:
+                self.send_message()
+            except Exception:
+                with self._out_buff_lock:
+                    self._count('block_timeouts')
+                return False
+            with self._out_buff_lock:
+                remaining = deadline - time.monotonic()
+                if self._has_room(size):
+                    return True
+                if remaining <= 0:
+                    self._count('block_timeouts')
+                    return False
+                # The connection is in its grace time; try again shortly.
+                if self._out_buff_cond is None:
+                    self._out_buff_cond = threading.Condition(self._out_buff_lock)
+                self._out_buff_cond.wait(min(remaining, 0.05))
+
+    @property
+    def counters(self):
+        """
+        :return: How often the out_buff policy blocked or dropped, by name.
+        :rtype: dict
+        """
+        return self._counters if self._counters is not None else _NO_COUNTERS.copy()
+
+    def _count(self, name):
+        if self._counters is None:
+            self._counters = _NO_COUNTERS.copy()
+        self._counters[name] += 1
+
+    def _has_room(self, size):
+        """
+        An empty out_buff always has room, otherwise one huge message could never be sent.
+
+        :param size: Size of the new message in bytes.
         :return:
         """
-        self.out_buff.append(message)
+        if not self.out_buff:
+            return True
+        return len(self.out_buff) < self.max_messages and self.out_buff_bytes + size <= self.max_bytes
 
     def close(self):
         """
         Closing client's object.
         :return:
         """
-        self.client_socket.close()
+        if self.connection_pool is not None:
+            self.connection_pool.release(self.connection)
+        else:
+            self.connection.close()
 
     def get_server_address(self):
         """
@@ -62,6 +243,7 @@ class Node:
         return self.server_ip, self.server_port
 
     @staticmethod
+    @functools.lru_cache(maxsize=65536)
     def parse_ip(ip):
         """
         Automatically change the input IP format like '192.168.001.001'.
@@ -0,0 +1,211 @@
+from config import profile_interval, profile_mode, profile_path
+from tools.Log import get_logger
+import collections
+import io
+import os
+import signal
+import sys
+import threading
+import time
+
+log = get_logger('root')
+
+"""
+    A profiler that can be switched on and off while the peers run.
+
+    The loops we care about (the Peer main loop, the reunion daemon and the ServerSocket loop of the Stream) call
+    profiler.checkpoint(name) once per iteration; that registers their thread and, in 'cprofile' mode, turns a
+    cProfile.Profile of that thread on or off. In 'sample' mode a daemon thread takes the stacks of the registered
+    threads every 'interval' seconds instead, which costs the profiled threads nothing.
+
+    Switch it with the 'profile start [sample|cprofile]' and 'profile stop [path]' UI commands, with
+    Peer.start_profiler / Peer.stop_profiler, or with SIGUSR1 (start with config.profile_mode, stop again and dump).
+    stop writes the stats of every thread to one text file: pstats tables in 'cprofile' mode, and folded stacks
+    ('thread;frame;frame count', the input of flamegraph.pl) in 'sample' mode.
+
+    There is one profiler per process (threads are per process); peers sharing a process share it.
+"""
+
+MODES = ('sample', 'cprofile')
+
+
+class _ProfileSnapshot:
+    """
+    What pstats.Stats needs from a cProfile.Profile without disabling it: only its own thread can do that.
+    """
+
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    def __init__(self):
+        self.mode = None
+        self.interval = profile_interval
+        self.started = None
+        # Thread ident -> name, of the threads that called checkpoint.
+        self.threads = {}
+        # Thread ident -> cProfile.Profile, in 'cprofile' mode.
+        self._profiles = {}
+        # Thread ident -> Counter of stacks (tuples of frames, outermost first), in 'sample' mode.
+        self._samples = {}
+        self._sampler = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def checkpoint(self, name):
+        """
+        Called by a profiled loop on every iteration, from its own thread.
+
+        :param name: What the thread does, like 'run', 'reunion' or 'server'.
+        :return:
+        """
+        ident = threading.get_ident()
+        if ident not in self.threads:
+            self.threads[ident] = '{}-{}'.format(name, ident)
+        profile = getattr(self._local, 'profile', None)
+        if self.mode == 'cprofile':
+            # A profile left over from an earlier run is not in _profiles any more.
+            if profile is None or self._profiles.get(ident) is not profile:
+                if profile:
+                    profile.disable()
+                # cProfile and pstats are imported when they are used, not at every peer startup.
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Only one cProfile can run at a time since Python 3.12.
+                    log.warning('can not profile thread %s: %s', self.threads[ident], sys.exc_info()[1])
+                    profile = False
+                self._local.profile = profile
+                with self._lock:
+                    self._profiles[ident] = profile
+        elif profile is not None:
+            if profile:
+                profile.disable()
+            self._local.profile = None
+
+    def start(self, mode=None, interval=None):
+        """
+        :param mode: 'sample' or 'cprofile'; config.profile_mode by default.
+        :param interval: Seconds between samples in 'sample' mode.
+        :return: Whether the profiler was started; it may already be running.
+        :rtype: bool
+        """
+        mode = mode if mode is not None else profile_mode
+        if mode not in MODES:
+            raise ValueError('unknown profiler mode {!r}'.format(mode))
+        with self._lock:
+            if self.mode is not None:
+                return False
+            self._profiles = {}
+            self._samples = {}
+            self.interval = interval if interval is not None else profile_interval
+            self.started = time.time()
+            self.mode = mode
+        if mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+            self._sampler.start()
+        log.info('profiler started in %s mode', mode)
+        return True
+
+    def stop(self, path=None):
+        """
+        Stop profiling and write the stats of every thread.
+
+        :param path: File to write; config.profile_path (formatted with pid and time) by default.
+        :return: The path written, or None if the profiler was not running.
+        """
+        with self._lock:
+            mode = self.mode
+            if mode is None:
+                return None
+            self.mode = None
+            profiles, samples = self._profiles, self._samples
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        if path is None:
+            path = profile_path.format(pid=os.getpid(), time=time.strftime('%Y%m%d-%H%M%S'))
+        with open(path, 'w') as f:
+            f.write('# {} profile of pid {}, {:.1f} seconds\n'.format(mode, os.getpid(), time.time() - self.started))
+            if mode == 'cprofile':
+                self._write_cprofile(f, profiles)
+            else:
+                self._write_samples(f, samples)
+        log.info('profiler stopped, stats written to %s', path)
+        return path
+
+    def toggle(self):
+        """
+        Start with the defaults, or stop and write to the default path.
+
+        :return:
+        """
+        if self.mode is None:
+            self.start()
+        else:
+            self.stop()
+
+    def install_signal_handler(self, signal_number=getattr(signal, 'SIGUSR1', None)):
+        """
+        Toggle the profiler on signal_number, unless somebody else handles that signal already.
+        Only the main thread can install signal handlers; elsewhere this does nothing.
+
+        :return: Whether the handler was installed.
+        :rtype: bool
+        """
+        if signal_number is None or threading.current_thread() is not threading.main_thread():
+            return False
+        if signal.getsignal(signal_number) not in (signal.SIG_DFL, self._on_signal):
+            return False
+        signal.signal(signal_number, self._on_signal)
+        return True
+
+    def _on_signal(self, signal_number, frame):
+        # stop writes a file and joins the sampler; keep that out of the interrupted main thread.
+        threading.Thread(target=self.toggle, name='profiler-toggle', daemon=True).start()
+
+    def _sample(self):
+        while self.mode == 'sample':
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                counter = self._samples.setdefault(ident, collections.Counter())
+                counter[tuple(reversed(stack))] += 1
+            del frames
+            time.sleep(self.interval)
+
+    def _write_cprofile(self, f, profiles):
+        import pstats
+        for ident, profile in sorted(profiles.items(), key=lambda item: self.threads[item[0]]):
+            if not profile:
+                continue
+            out = io.StringIO()
+            stats = pstats.Stats(_ProfileSnapshot(profile), stream=out)
+            stats.sort_stats('cumulative').print_stats(40)
+            f.write('\n# thread {}\n'.format(self.threads[ident]))
+            f.write(out.getvalue())
+
+    def _write_samples(self, f, samples):
+        for ident, counter in sorted(samples.items(), key=lambda item: self.threads[item[0]]):
+            name = self.threads[ident]
+            f.write('\n# thread {}: {} samples every {} seconds\n'.format(name, sum(counter.values()),
+                                                                          self.interval))
+            for stack, count in counter.most_common():
+                f.write('{};{} {}\n'.format(name, ';'.join(stack), count))
+
+
+profiler = Profiler()
@@ -0,0 +1,167 @@
+import collections
+
+"""
+    Token buckets for the Messages a relay forwards, so one peer that broadcasts too fast can not saturate the tree.
+
+    Every Message takes a token from the bucket of its origin (the peer that broadcast it, see the Origin flag in
+    Packet) and from the bucket of its link (the neighbour it came from). A Message that finds an empty bucket is
+    dropped, or held until both buckets have tokens again. Peer makes one RateLimiter from config.rate_limit_*.
+
+    Metrics:
+        rate_limited_total{scope="origin"|"link", action="dropped"|"delayed"}: Messages over the limit.
+        rate_limit_delayed_messages: Messages held right now.
+"""
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'time')
+
+    def __init__(self, rate, burst, now):
+        """
+        'rate' tokens per second on average and at most 'burst' of them at once; it starts full.
+
+        :type rate: float
+        :type burst: float
+        :param now: The current time.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = now
+
+    def has_token(self, now):
+        if now > self.time:
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class TokenBuckets:
+    def __init__(self, rate, burst, max_keys=10000):
+        """
+        A TokenBucket per key, made on its first use. Beyond max_keys buckets the least recently used one is
+        forgotten; it starts full again if its key comes back.
+
+        :type rate: float
+        :type burst: float
+        :type max_keys: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def get(self, key, now):
+        """
+        :param key: Like an address.
+        :param now: The current time.
+        :rtype: TokenBucket
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+
+class RateLimiter:
+    def __init__(self, origin_limit=None, link_limit=None, action='drop', max_delayed=1000, metrics=None):
+        """
+        :param origin_limit: (rate, burst) of the bucket of every origin; None for no limit per origin.
+        :param link_limit: (rate, burst) of the bucket of every link; None for no limit per link.
+        :param action: 'drop' or 'delay' the items over the limit.
+        :param max_delayed: With 'delay', at most this many items are held; more are dropped.
+        :param metrics: Registry for our metrics, see the module documentation.
+
+        :type origin_limit: tuple
+        :type link_limit: tuple
+        :type action: str
+        :type max_delayed: int
+        :type metrics: MetricsRegistry
+        """
+        self.scopes = []
+        if origin_limit is not None:
+            self.scopes.append(('origin', TokenBuckets(*origin_limit)))
+        if link_limit is not None:
+            self.scopes.append(('link', TokenBuckets(*link_limit)))
+        self.action = action
+        self.max_delayed = max_delayed
+        # (item, origin, link) in arrival order.
+        self._delayed = collections.deque()
+        self._limited = {}
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.gauge('rate_limit_delayed_messages', function=lambda: len(self._delayed))
+
+    def _count(self, scope, action):
+        if self.metrics is None:
+            return
+        counter = self._limited.get((scope, action))
+        if counter is None:
+            counter = self._limited[(scope, action)] = self.metrics.counter('rate_limited_total', scope=scope,
+                                                                            action=action)
+        counter.inc()
+
+    def _try_take(self, origin, link, now):
+        """
+        :return: None if every bucket had a token (and one is taken from each), else the scope of an empty one.
+        """
+        buckets = []
+        for scope, scope_buckets in self.scopes:
+            bucket = scope_buckets.get(origin if scope == 'origin' else link, now)
+            if not bucket.has_token(now):
+                return scope
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.take()
+        return None
+
+    def admit(self, origin, link, item, now):
+        """
+        :param origin: Origin of the item.
+        :param link: Link the item came from.
+        :param item: Kept for release if it is delayed.
+        :param now: The current time.
+
+        :return: Whether the item may go now; if not it was dropped, or it is held for release.
+        :rtype: bool
+        """
+        if not self.scopes:
+            return True
+        scope = self._try_take(origin, link, now)
+        if scope is None:
+            return True
+        if self.action == 'delay' and len(self._delayed) < self.max_delayed:
+            self._delayed.append((item, origin, link))
+            self._count(scope, 'delayed')
+        else:
+            self._count(scope, 'dropped')
+        return False
+
+    def release(self, now):
+        """
+        :param now: The current time.
+        :return: The held items that have got their tokens now, in arrival order.
+        :rtype: list
+        """
+        released = []
+        if not self._delayed:
+            return released
+        delayed = collections.deque()
+        for entry in self._delayed:
+            item, origin, link = entry
+            if self._try_take(origin, link, now) is None:
+                released.append(item)
+            else:
+                delayed.append(entry)
+        self._delayed = delayed
+        return released
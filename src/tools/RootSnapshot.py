@@ -0,0 +1,179 @@
+import collections
+import json
+import os
+import threading
+import time
+
+
+class RootSnapshot:
+    def __init__(self, path):
+        """
+        Persistent state of the root: a compact snapshot of the NetworkGraph and the registered clients, plus an
+        append-only log of the changes made after the snapshot was taken.
+
+        Snapshot format (JSON):
+            {"time": ..., "root": [ip, port], "registered": [[ip, port], ...],
+             "nodes": [[ip, port, parent_ip, parent_port], ...]}    Every parent comes before its children.
+        Log format (one JSON array per line):
+            ["register", ip, port]
+            ["place", ip, port, parent_ip, parent_port]
+            ["remove", ip, port]
+
+        :param path: Snapshot file; the log is kept in path + '.log'.
+        :type path: str
+        """
+        self.path = path
+        self.log_path = path + '.log'
+        self._lock = threading.Lock()
+        # Log entries not written yet, see flush.
+        self._pending = []
+
+    def take(self, graph, registered):
+        """
+        make_state, and forget the log entries buffered so far; they are in the state. Call it while nobody changes
+        graph and registered (see Root.state_lock), then write the state with save.
+
+        :param graph: Root NetworkGraph.
+        :param registered: Addresses of the registered clients.
+        :type graph: NetworkGraph
+        :type registered: set
+
+        :return: The snapshot, see the snapshot format.
+        :rtype: dict
+        """
+        state = RootSnapshot.make_state(graph, registered)
+        with self._lock:
+            self._pending = []
+        return state
+
+    def save(self, state):
+        """
+        Write a new snapshot, made by take, and truncate the log.
+
+        :param state: See the snapshot format.
+        :type state: dict
+
+        :return:
+        """
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            open(self.log_path, 'w').close()
+
+    def log(self, *entry):
+        """
+        Buffer a change for the log, see the log format; flush writes it.
+
+        :return:
+        """
+        with self._lock:
+            self._pending.append(entry)
+
+    def flush(self):
+        """
+        Append the buffered changes to the log.
+
+        :return:
+        """
+        with self._lock:
+            entries, self._pending = self._pending, []
+            if entries:
+                with open(self.log_path, 'a') as f:
+                    f.write(''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries))
+
+    def load(self, root_address, max_age):
+        """
+        Read the snapshot and replay the log on it.
+
+        :param root_address: Our current address; a snapshot of another root is not ours to load.
+        :param max_age: Snapshots older than this (seconds) are useless because every client has given up on us.
+        :type root_address: tuple
+
+        :return: [(address, parent_address), ...] with parents first, and the set of registered addresses;
+                 None if there is no usable snapshot.
+        :rtype: tuple
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - state['time'] > max_age or tuple(state['root']) != tuple(root_address):
+            return None
+        entries = []
+        try:
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # The last line may be cut by a crash.
+                        continue
+        except OSError:
+            pass
+        return RootSnapshot.replay(state, entries, root_address)
+
+    @staticmethod
+    def make_state(graph, registered):
+        """
+        :param graph: Root NetworkGraph.
+        :param registered: Addresses of the registered clients.
+        :type graph: NetworkGraph
+        :type registered: set
+
+        :return: The snapshot of graph and registered, see the snapshot format.
+        :rtype: dict
+        """
+        nodes = []
+        for node in graph.iter_nodes():
+            if node is not graph.root:
+                nodes.append([node.address[0], node.address[1], node.parent.address[0], node.parent.address[1]])
+        return {'time': time.time(), 'root': list(graph.root.address),
+                'registered': [list(address) for address in registered.copy()], 'nodes': nodes}
+
+    @staticmethod
+    def replay(state, entries, root_address):
+        """
+        Apply log entries to a snapshot.
+
+        :param state: A snapshot, see the snapshot format.
+        :param entries: Log entries made after the snapshot.
+        :param root_address: The old root address in the snapshot is replaced with this one.
+        :type state: dict
+        :type entries: list
+        :type root_address: tuple
+
+        :return: [(address, parent_address), ...] with parents first, and the set of registered addresses.
+        :rtype: tuple
+        """
+        old_root = tuple(state['root'])
+        parents = {}
+        for ip, port, parent_ip, parent_port in state['nodes']:
+            parents[(ip, port)] = (parent_ip, parent_port)
+        registered = set(tuple(address) for address in state['registered'])
+        for entry in entries:
+            address = (entry[1], entry[2])
+            if entry[0] == 'register':
+                registered.add(address)
+            elif entry[0] == 'place':
+                parents[address] = (entry[3], entry[4])
+            elif entry[0] == 'remove':
+                parents.pop(address, None)
+                registered.discard(address)
+
+        children = collections.defaultdict(list)
+        for address, parent in parents.items():
+            children[parent].append(address)
+        edges = []
+        queue = collections.deque([old_root])
+        visited = {old_root}
+        while queue:
+            v = queue.popleft()
+            for u in children[v]:
+                if u not in visited:
+                    visited.add(u)
+                    edges.append((u, root_address if v == old_root else v))
+                    queue.append(u)
+        return edges, registered
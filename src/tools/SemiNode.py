@@ -1,4 +1,6 @@
 class SemiNode:
+    __slots__ = ('ip', 'port')
+
     def __init__(self, ip, port):
         self.ip = ip
         self.port = port
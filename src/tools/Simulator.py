@@ -0,0 +1,462 @@
+from Stream import Stream
+from Root import Root
+from Client import Client
+from tools.Node import Node
+from config import reconnect_grace_time
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+
+"""
+    A discrete-event simulator for the network.
+
+    Root and Client peers run unchanged, but without threads or sockets: their main loops and reunion daemons are
+    events on a VirtualClock and their Streams talk through a VirtualNetwork that delivers frames after a latency,
+    may lose them and may crash peers. Nothing sleeps, so a few thousand peers run minutes of virtual time in seconds.
+
+    Usage:
+        sim = Simulator(latency=0.01)
+        sim.add_root()
+        for _ in range(100):
+            sim.add_client()
+        sim.run(60)
+        sim.broadcast(client_address, 'hello')
+        sim.run(30)
+        assert len(sim.deliveries('hello')) == 100
+
+    With pytest installed, the 'simulator' fixture of this module gives every test a fresh Simulator.
+"""
+
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        """
+        A clock that only moves when the next event runs.
+
+        It looks like the time module for Peers, except that sleep is not allowed: simulated peers never block.
+
+        :param start: Virtual time of the first event.
+        :type start: float
+        """
+        self.now = start
+        self._events = []
+        self._sequence = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        raise RuntimeError('Simulated peers must not sleep; schedule an event with call_later instead.')
+
+    def call_at(self, when, callback, *args):
+        """
+        Run callback(*args) at virtual time 'when'. Events of the same time run in the order they were scheduled.
+
+        :param when: Virtual time.
+        :param callback:
+        :return:
+        """
+        heapq.heappush(self._events, (max(when, self.now), next(self._sequence), callback, args))
+
+    def call_later(self, delay, callback, *args):
+        self.call_at(self.now + delay, callback, *args)
+
+    def run_until(self, when):
+        """
+        Run every event scheduled up to 'when' and move the clock there.
+
+        :param when: Virtual time.
+        :return: Number of the events that ran.
+        :rtype: int
+        """
+        count = 0
+        while self._events and self._events[0][0] <= when:
+            self.now, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+            count += 1
+        self.now = max(self.now, when)
+        return count
+
+    def clear(self):
+        """
+        Forget every event that has not run.
+
+        :return:
+        """
+        self._events.clear()
+
+
+class VirtualNetwork:
+    def __init__(self, clock, latency=0.01, jitter=0.0, loss=0.0, seed=None):
+        """
+        Carries frames between VirtualStreams.
+
+        Like TCP, every link (source, destination) is FIFO: jitter never reorders the frames of one link.
+
+        :param clock: The simulation clock.
+        :param latency: One way delay of every frame in seconds.
+        :param jitter: Up to this many seconds are added to latency at random.
+        :param loss: Probability of losing a frame silently.
+        :param seed: Seed of the random generator for reproducible runs.
+
+        :type clock: VirtualClock
+        :type latency: float
+        :type jitter: float
+        :type loss: float
+        """
+        self.clock = clock
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.streams = {}
+        self.crashed = set()
+        self._link_arrival = {}
+        self.counters = {'frames': 0, 'bytes': 0, 'lost': 0, 'refused': 0}
+
+    def attach(self, stream):
+        self.streams[stream.get_address()] = stream
+
+    def is_up(self, address):
+        return address in self.streams and address not in self.crashed
+
+    def crash(self, address):
+        """
+        The peer stops answering: frames to it are refused and the frames on their way are lost.
+
+        :param address: Peer server address.
+        :return:
+        """
+        self.crashed.add(address)
+
+    def recover(self, address):
+        self.crashed.discard(address)
+
+    def send(self, source, destination, data):
+        """
+        :param source: Sender server address.
+        :param destination: Receiver server address.
+        :param data: One frame.
+
+        :return: Whether the receiver accepted the connection; a lost frame still counts as sent.
+        :rtype: bool
+        """
+        if not self.is_up(destination) or source in self.crashed:
+            self.counters['refused'] += 1
+            return False
+        self.counters['frames'] += 1
+        self.counters['bytes'] += len(data)
+        if self.loss and self.random.random() < self.loss:
+            self.counters['lost'] += 1
+            return True
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        link = (source, destination)
+        arrival = max(self.clock.now + delay, self._link_arrival.get(link, 0))
+        self._link_arrival[link] = arrival
+        self.clock.call_at(arrival, self._arrive, destination, data)
+        return True
+
+    def _arrive(self, destination, data):
+        if self.is_up(destination):
+            self.streams[destination]._append_in_buf(data)
+
+
+class VirtualConnection:
+    def __init__(self, network, source, address):
+        """
+        Takes the place of tools.ConnectionPool.Connection in the Nodes of a VirtualStream.
+
+        :param network: The network to send through.
+        :param source: Our server address.
+        :param address: The peer server address.
+
+        :type network: VirtualNetwork
+        """
+        self.network = network
+        self.source = source
+        self.address = address
+        self.down_since = None
+        self.counters = {'connects': 0, 'reconnects': 0, 'failures': 0}
+
+    def send(self, data):
+        if not self.network.send(self.source, self.address, data):
+            if self.down_since is None:
+                self.down_since = self.network.clock.now
+            self.counters['failures'] += 1
+            raise ConnectionError
+        self.down_since = None
+        return b'ACK'
+
+    def in_grace_time(self):
+        return self.down_since is not None and self.network.clock.now - self.down_since < reconnect_grace_time
+
+    def close(self):
+        pass
+
+
+class VirtualStream(Stream):
+    def __init__(self, network, ip, port):
+        """
+        A Stream without TCPServer, flush workers or sockets; frames go through the VirtualNetwork.
+
+        :param network:
+        :param ip:
+        :param port:
+
+        :type network: VirtualNetwork
+        """
+        self.network = network
+        self.nodes = []
+        self._nodes_index = {}
+        self._init_in_buf()
+        self._reply_queues = {}
+        self._init_metrics(None)
+        self.ip = Node.parse_ip(ip)
+        self.port = Node.parse_port(port)
+        self._removed_nodes_counters = collections.Counter()
+        network.attach(self)
+
+    def get_address(self):
+        """
+        :return: Our server address in the same format as Node.get_server_address.
+        :rtype: tuple
+        """
+        return self.ip, int(self.port)
+
+    def add_node(self, server_address, set_register_connection=False):
+        server_ip, server_port = server_address
+        connection = VirtualConnection(self.network, self.get_address(), (Node.parse_ip(server_ip), server_port))
+        self._append_node(Node(server_address=(server_ip, server_port), set_register=set_register_connection,
+                               connection=connection))
+
+    def add_reply_node(self, server_address, set_register_connection=True):
+        self.add_node(server_address, set_register_connection)
+
+    def _now(self):
+        return self.network.clock.now
+
+    def _flush_all(self, nodes):
+        return [(node, self._flush_node(node)) for node in nodes]
+
+
+class SimUserInterface:
+    def __init__(self, clock):
+        """
+        Stands in for UserInterface; 'printer_times' keeps the virtual time of every 'printer' line.
+
+        :param clock:
+        :type clock: VirtualClock
+        """
+        self.clock = clock
+        self.buffer = []
+        self.printer = _TimedList(clock)
+
+
+class _TimedList(list):
+    def __init__(self, clock):
+        super(_TimedList, self).__init__()
+        self.clock = clock
+        self.times = []
+
+    def append(self, item):
+        super(_TimedList, self).append(item)
+        self.times.append(self.clock.now)
+
+    def clear(self):
+        super(_TimedList, self).clear()
+        self.times.clear()
+
+
+class Simulator:
+    def __init__(self, latency=0.01, jitter=0.0, loss=0.0, seed=0, quiet=True, ip='127.000.000.001', first_port=20000):
+        """
+        :param latency: See VirtualNetwork.
+        :param jitter: See VirtualNetwork.
+        :param loss: See VirtualNetwork.
+        :param seed: Seed of the network and of the peer loop phases.
+        :param quiet: Throw away what the peers log while the simulation runs.
+        :param ip: IP address of the simulated peers, in the 15 characters format of the packets.
+        :param first_port: Peers without an explicit address get ports from here on.
+        """
+        self.clock = VirtualClock()
+        self.network = VirtualNetwork(self.clock, latency, jitter, loss, seed)
+        self.random = random.Random(seed)
+        self.quiet = quiet
+        self.ip = ip
+        self._ports = itertools.count(first_port)
+        self.root = None
+        self.peers = {}
+
+    def _next_address(self):
+        return self.ip, next(self._ports)
+
+    def _make_stream(self, address):
+        return VirtualStream(self.network, address[0], address[1])
+
+    def add_root(self, address=None):
+        """
+        :param address: Root server address.
+        :return: The new Root.
+        :rtype: Root
+        """
+        address = address or self._next_address()
+        with self._output():
+            root = Root(address[0], address[1], user_interface=SimUserInterface(self.clock),
+                        stream=self._make_stream(address), clock=self.clock, start_threads=False, snapshot_path=None)
+        if self.root is None:
+            self.root = root
+        self.peers[self._key(address)] = root
+        phase = self.clock.now + self.random.uniform(0, 2)
+        self._every(phase, 2, root, root.run_once)
+        self._every(phase + 1, 2, root, root.reunion_tick)
+        return root
+
+    def add_client(self, address=None, root_address=None, join=True):
+        """
+        :param address: Client server address.
+        :param root_address: Passed to Client; our first root by default.
+        :param join: Register and Advertise like a user would press the buttons.
+        :return: The new Client.
+        :rtype: Client
+        """
+        address = address or self._next_address()
+        root_address = root_address or self.root.server_address
+        with self._output():
+            client = Client(address[0], address[1], user_interface=SimUserInterface(self.clock),
+                            root_address=root_address, stream=self._make_stream(address), clock=self.clock,
+                            start_threads=False)
+        self.peers[self._key(address)] = client
+        if join:
+            client.user_interface.buffer.append('Register')
+        self._every(self.clock.now + self.random.uniform(0, 2), 2, client, self._client_step, client, join)
+        return client
+
+    def _client_step(self, client, join):
+        if join and client.is_registered and not client.adv_sent and not getattr(client, '_sim_advertised', False):
+            client.user_interface.buffer.append('Advertise')
+            client._sim_advertised = True
+        client.run_once()
+        if client.adv_sent and not getattr(client, '_sim_reunion', False):
+            client._sim_reunion = True
+            self._every(self.clock.now + 4 + self.random.uniform(0, 2), 4, client, client.reunion_tick)
+
+    def _every(self, first, interval, peer, callback, *args):
+        """
+        Run callback(*args) at 'first' and then every 'interval' seconds while the peer is alive.
+
+        :return:
+        """
+        def event():
+            if not self._is_alive(peer):
+                return
+            callback(*args)
+            self.clock.call_later(interval, event)
+        self.clock.call_at(first, event)
+
+    def _is_alive(self, peer):
+        if peer.stream.get_address() in self.network.crashed:
+            return False
+        return not (isinstance(peer, Client) and peer.is_disconnected())
+
+    @staticmethod
+    def _key(address):
+        return Node.parse_ip(address[0]), address[1]
+
+    @contextlib.contextmanager
+    def _output(self):
+        if not self.quiet:
+            yield
+            return
+        previous = logging.root.manager.disable
+        logging.disable(logging.CRITICAL)
+        try:
+            yield
+        finally:
+            logging.disable(previous)
+
+    def get_peer(self, address):
+        return self.peers[self._key(address)]
+
+    def broadcast(self, address, message, trace=False):
+        """
+        The peer broadcasts message on its next main loop iteration, as if its user had sent it.
+
+        :param address: Sender server address.
+        :param message: One word, like in UserInterface.
+        :param trace: Send a traced message; every receiver keeps its trace in Peer.traces.
+        :return:
+        """
+        command = 'trace' if trace else 'send'
+        self.get_peer(address).user_interface.buffer.append('{} {}'.format(command, message))
+
+    def deliveries(self, message):
+        """
+        :param message:
+        :return: Server address -> virtual time, for every peer that has received message.
+        :rtype: dict
+        """
+        suffix = ': {}'.format(message)
+        result = {}
+        for key, peer in self.peers.items():
+            printer = peer.user_interface.printer
+            for line, when in zip(printer, printer.times):
+                if line.endswith(suffix):
+                    result[key] = when
+                    break
+        return result
+
+    def crash(self, address):
+        """
+        Kill the peer: it stops running and the network refuses its connections.
+
+        :param address:
+        :return:
+        """
+        self.network.crash(self._key(address))
+
+    def joined(self):
+        """
+        :return: Clients that have got their parent and are not disconnected.
+        :rtype: list
+        """
+        return [peer for peer in self.peers.values()
+                if isinstance(peer, Client) and peer.parent is not None and self._is_alive(peer)]
+
+    def run(self, seconds):
+        """
+        Run the simulation for 'seconds' of virtual time.
+
+        :return: Number of events that ran.
+        :rtype: int
+        """
+        with self._output():
+            return self.clock.run_until(self.clock.now + seconds)
+
+    def close(self):
+        """
+        Drop the events that have not run and forget the peers.
+
+        :return:
+        """
+        self.clock.clear()
+        self.peers.clear()
+        self.root = None
+
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+if pytest is not None:
+    @pytest.fixture
+    def simulator():
+        """
+        A fresh Simulator for a test; import it into a test module or conftest.py (like tests/conftest.py) to use it.
+        """
+        sim = Simulator()
+        yield sim
+        sim.close()
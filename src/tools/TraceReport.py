@@ -0,0 +1,164 @@
+import argparse
+import json
+import re
+import sys
+
+"""
+    Collect the traces of traced messages (the 'trace' UI command) and show where their time went.
+
+    Every peer that receives a traced message logs its trace in the 'trace' log category; give this tool the logs
+    of the peers:
+        python -m tools.TraceReport peer1.log peer2.log ... [--message hello] [--top 10]
+
+    For every hop, queueing time is how long the hop held the message (from its Stream receiving the frame to
+    sending the copy to the next hop, out buffer included) and network time is the time from the previous hop forwarding the message to
+    this hop receiving it. The relays are also ranked by the end-to-end latency of the receivers in their
+    sub-trees, which points at the slow sub-trees.
+"""
+
+TRACE_LINE = re.compile(r'\btrace (\{.*\})\s*$')
+
+
+def read_traces(lines):
+    """
+    :param lines: Log lines; the other lines are skipped.
+    :return: Traces as {'message': str, 'hops': [[ip, port, receive time, forward time], ...]}.
+    :rtype: list
+    """
+    traces = []
+    for line in lines:
+        match = TRACE_LINE.search(line)
+        if match:
+            try:
+                traces.append(json.loads(match.group(1)))
+            except ValueError:
+                continue
+    return traces
+
+
+def from_peer(peer):
+    """
+    :param peer: A Peer; its in-memory traces instead of the logs.
+    :return: Traces like read_traces.
+    """
+    return [{'message': message, 'hops': [[address[0], address[1], receive_time, forward_time]
+                                          for address, receive_time, forward_time in trace]}
+            for message, trace in peer.traces]
+
+
+def hop_times(traces):
+    """
+    Every relay hop appears in the traces of all the receivers below it; count it once.
+
+    :return: (message, origin, depth, relay address) -> (queue seconds, network seconds).
+    :rtype: dict
+    """
+    hops = {}
+    for trace in traces:
+        path = trace['hops']
+        origin = tuple(path[0][:2])
+        for depth in range(1, len(path)):
+            previous, hop = path[depth - 1], path[depth]
+            key = (trace['message'], origin, depth, (hop[0], hop[1]))
+            if depth == len(path) - 1 and key in hops:
+                continue
+            hops[key] = (max(0.0, hop[3] - hop[2]), max(0.0, hop[2] - previous[3]))
+    return hops
+
+
+def _percentile(values, point):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(point / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def _row(values):
+    return '{:>5} {:>9.3f} {:>9.3f}'.format(len(values), _percentile(values, 50), _percentile(values, 90))
+
+
+def report(traces, top=10):
+    """
+    :return: The text report.
+    :rtype: str
+    """
+    hops = hop_times(traces)
+    lines = ['{} traces, {} distinct hops'.format(len(traces), len(hops)), '']
+
+    by_depth = {}
+    for (_, _, depth, _), (queue, network) in hops.items():
+        by_depth.setdefault(depth, ([], []))
+        by_depth[depth][0].append(queue)
+        by_depth[depth][1].append(network)
+    lines.append('{:>5}  {:^25}  {:^25}'.format('depth', 'queue (count p50 p90)', 'network (count p50 p90)'))
+    for depth in sorted(by_depth):
+        queue, network = by_depth[depth]
+        lines.append('{:>5}  {}  {}'.format(depth, _row(queue), _row(network)))
+    lines.append('')
+
+    # Relay -> queue times, network times into it, end-to-end latencies of the receivers at and below it.
+    relays = {}
+    for (_, _, _, address), (queue, network) in hops.items():
+        relay = relays.setdefault(address, ([], [], []))
+        relay[0].append(queue)
+        relay[1].append(network)
+    for trace in traces:
+        path = trace['hops']
+        latency = path[-1][2] - path[0][3]
+        for hop in path[1:]:
+            relays[(hop[0], hop[1])][2].append(latency)
+    lines.append('{:<22}  {:^25}  {:^25}  {:^25}'.format('slowest sub-trees', 'queue (count p50 p90)',
+                                                         'network in (count p50 p90)', 'end-to-end below'))
+    ranked = sorted(relays.items(), key=lambda item: -_percentile(item[1][2], 50))
+    for address, (queue, network, latencies) in ranked[:top]:
+        lines.append('{:<22}  {}  {}  {}'.format('{}:{}'.format(*address), _row(queue), _row(network),
+                                                 _row(latencies)))
+    return '\n'.join(lines)
+
+
+def waterfall(traces, message, width=60):
+    """
+    One line per receiver of message: '=' is network time and '#' is queueing time, on a common time scale.
+
+    :rtype: str
+    """
+    traces = [trace for trace in traces if trace['message'] == message]
+    if not traces:
+        return 'no traces of {!r}'.format(message)
+    start = min(trace['hops'][0][3] for trace in traces)
+    end = max(trace['hops'][-1][2] for trace in traces)
+    scale = width / max(end - start, 1e-9)
+    lines = ['{} receivers of {!r}, {:.3f} seconds; = network, # queueing'.format(len(traces), message, end - start)]
+    for trace in sorted(traces, key=lambda trace: trace['hops'][-1][2]):
+        path = trace['hops']
+        bar = ''
+        for previous, hop in zip(path, path[1:]):
+            bar += '=' * int(round((hop[2] - previous[3]) * scale))
+            if hop is not path[-1]:
+                bar += '#' * int(round((hop[3] - hop[2]) * scale))
+        lines.append('{:<22} {:>2} hops {:>8.3f}s |{}'.format('{}:{}'.format(path[-1][0], path[-1][1]),
+                                                             len(path) - 1, path[-1][2] - path[0][3], bar))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-hop queueing and network time of traced messages.')
+    parser.add_argument('logs', nargs='*', help='Peer log files; stdin if there are none.')
+    parser.add_argument('--message', help='Also draw the waterfall of this message.')
+    parser.add_argument('--top', type=int, default=10, help='Number of sub-trees to show.')
+    args = parser.parse_args()
+    traces = []
+    if args.logs:
+        for path in args.logs:
+            with open(path, errors='replace') as f:
+                traces.extend(read_traces(f))
+    else:
+        traces = read_traces(sys.stdin)
+    print(report(traces, args.top))
+    if args.message:
+        print()
+        print(waterfall(traces, args.message))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 import sys
 import socket
-from config import verbosity
+from tools.Log import get_logger
+
+log = get_logger('socket')
 
 
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, connect_now=True, expect_response=True,
+                 socket_options=None):
         """
 
         Handle the socket's mode.
@@ -13,6 +16,8 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        socket_options (a SocketOptions) are set before connecting; their recv_size replaces received_bytes.
         """
 
         if mode == "localhost":
@@ -29,23 +34,43 @@ class ClientSocket:
         # Actually create an INET, STREAMing socket.socket.
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.settimeout(5)
-        print('socket time out: ', self._socket.gettimeout())
+        log.debug('socket time out: %s', self._socket.gettimeout())
+        if socket_options is not None:
+            socket_options.apply(self._socket)
+            received_bytes = socket_options.recv_size
         # Save the number of bytes to be read in response
         self.received_bytes = received_bytes
         # Save whether this socket is single-use or not.
         self.single_use = single_use
-        # If this isn't a single-use socket, connect right away.
+        # Without a response the server answers on this socket whenever it wants (duplex), so someone else
+        # reads it and send raises on errors instead of reporting them through the response.
+        self.expect_response = expect_response
+        # If this isn't a single-use socket, connect right away (unless the owner will call connect itself).
         if not self.single_use:
-            try:
-                self._socket.connect((self.connect_ip, self.connect_port))
-            except ConnectionRefusedError:
-                print('Connection refused. Please check out if the server exists.')
+            if connect_now:
+                try:
+                    self._socket.connect((self.connect_ip, self.connect_port))
+                except ConnectionRefusedError:
+                    log.warning('Connection refused. Please check out if the server exists.')
             # Keep track of whether this socket has been closed.
             self.closed = False
         # Keep track of whether this socket has been used, so we can
         # warn single-use sockets not to send data twice.
         self.used = False
 
+    def connect(self):
+        """
+
+        Connect a persistent socket that was made with connect_now=False.
+        Unlike the constructor, connection errors are raised to the caller.
+
+        """
+        self._socket.connect((self.connect_ip, self.connect_port))
+        self.closed = False
+
+    def get_socket(self):
+        return self._socket
+
     def get_port(self):
         return self.connect_port
 
@@ -91,13 +116,16 @@ class ClientSocket:
             raise ValueError
         # Everything is setup, now we must send the data.
         try:
-            self._socket.send(data)
-            if verbosity == 1:
-                print('sending ', data)
+            self._socket.sendall(data)
+            log.debug('sending %r', data)
         except OSError:
-            print('Time out!!')
+            log.warning('Time out!!')
+            if not self.expect_response:
+                raise
         # Keep track of the fact that we've sent data (or attempted to).
         self.used = True
+        if not self.expect_response:
+            return None
         # Now read the response:
         response = None
         try:
@@ -111,8 +139,7 @@ class ClientSocket:
             # Keep track of the fact that this is closed.
             self.closed = True
 
-        if verbosity == 1:
-            print('sent...')
+        log.debug('sent...')
         return response
 
     def close(self):
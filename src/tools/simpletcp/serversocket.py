@@ -4,10 +4,27 @@ import select
 import socket
 import sys
 
+from tools.Log import get_logger
+from tools.simpletcp.socketoptions import SocketOptions
+
+log = get_logger('socket')
+
+
+class ConnectionQueue(queue.Queue):
+    """
+    A queue.Queue of data to be sent to one accepted socket.
+    Writers can check closed to find out that the socket behind it is gone.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
 
 class ServerSocket:
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, frame_length=None,
+                 select_timeout=0.1, loop_hook=None, socket_options=None):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -15,6 +32,20 @@ class ServerSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        If frame_length is given, the callback is called once per complete frame instead of once per recv.
+        frame_length takes the buffered bytes of a connection and returns the length of the first frame,
+        or 0 if it can not tell yet.
+
+        Reads go with recv_into into one receive area that is reused for every read, and frames are handed to the
+        callback as memoryviews of it: they are only valid until the callback returns, so a callback that keeps a
+        frame must copy it (bytes(data)). Without frame_length the callback gets bytes, as before. The tail of an
+        incomplete frame waits in a per-connection bytearray taken from a pool of released ones.
+
+        If loop_hook is given, it is called without arguments at the start of every iteration of run.
+
+        socket_options (a SocketOptions) are set on the listening socket and on every accepted socket (adopted
+        sockets are set up by their owner); by default only SO_REUSEADDR is set.
         """
 
         if mode == "localhost":
@@ -33,6 +64,9 @@ class ServerSocket:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Make it non-blocking.
         self._socket.setblocking(0)
+        # A restarted server must be able to bind again while old connections are in TIME_WAIT.
+        self.socket_options = socket_options
+        (socket_options or SocketOptions(nodelay=False)).apply_listening(self._socket)
         # Bind the socket, so it can listen.
         self._socket.bind((self.ip, self.port))
         # Save the callback
@@ -45,24 +79,69 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
+        # recv_into target of every read, see _receive; it grows for frames longer than received_bytes.
+        self._receive_area = bytearray(received_bytes)
+        self._receive_view = memoryview(self._receive_area)
+        # Released per-connection buffers for incomplete frames.
+        self._free_partials = []
+        self.frame_length = frame_length
+        # We must wake up now and then to pick up adopted sockets and data queued by other threads.
+        self.select_timeout = select_timeout
+        # Connected sockets handed over by other threads, see adopt.
+        self._adopted = queue.Queue()
+        self.loop_hook = loop_hook
+
+    def adopt(self, sock):
+        """
+        Read from an already connected (outgoing) socket in our loop, so its responses reach the callback like
+        the data of accepted sockets. The callback gets None instead of a queue for adopted sockets; whoever
+        adopted the socket still owns it and writes to it directly.
+
+        This method is thread-safe.
+        """
+        self._adopted.put(sock)
 
     def run(self):
         # Start listening
         self._socket.listen(self._max_connections)
-        # Create a list of readers (sockets that will be read from) and a list
-        # of writers (sockets that will be written to).
+        # Create a list of readers (sockets that will be read from).
         readers = [self._socket]
-        writers = []
-        # Create a dictionary of queue.Queues for data to be sent.
-        # This dictionary maps sockets to queue.Queue objects
+        # Create a dictionary of ConnectionQueues for data to be sent.
+        # This dictionary maps sockets to ConnectionQueue objects (None for adopted sockets).
         queues = dict()
         # Create a similar dictionary that stores IP addresses.
         # This dictionary maps sockets to IP addresses
         IPs = dict()
+        # Data that did not fit into the last send, and the beginning of incomplete frames.
+        pending = dict()
+        partial = dict()
         # Now, the main loop.
         while readers:
+            if self.loop_hook is not None:
+                self.loop_hook()
+            while not self._adopted.empty():
+                sock = self._adopted.get_nowait()
+                try:
+                    IPs[sock] = sock.getpeername()
+                except OSError:
+                    continue
+                readers.append(sock)
+                queues[sock] = None
+                partial[sock] = self._take_partial()
+            # Adopted sockets may have been closed by their owner in the meantime.
+            for sock in [s for s in readers if s.fileno() == -1]:
+                self._forget(sock, readers, queues, IPs, pending, partial)
+            # Sockets with queued data are the ones that need to be written to.
+            writers = [s for s in readers if s in pending or (queues.get(s) is not None and not queues[s].empty())]
             # Block until a socket is ready for processing.
-            read, write, err = select.select(readers, writers, readers)
+            try:
+                read, write, err = self._wait(readers, writers)
+            except ValueError as e:
+                # Only select.select without poll: a file descriptor above FD_SETSIZE; drop the newest connection.
+                log.error('select failed with %d sockets: %s; closing the newest one', len(readers), e)
+                if len(readers) > 1:
+                    self._forget(readers[-1], readers, queues, IPs, pending, partial)
+                continue
             # Deal with sockets that need to be read from.
             for sock in read:
                 if sock is self._socket:
@@ -70,60 +149,137 @@ class ServerSocket:
                     client_socket, client_ip = self._socket.accept()
                     # Make it a non-blocking connection.
                     client_socket.setblocking(0)
+                    if self.socket_options is not None:
+                        self.socket_options.apply(client_socket)
                     # Add it to our readers.
                     readers.append(client_socket)
                     # Make a queue for it.
-                    queues[client_socket] = queue.Queue()
+                    queues[client_socket] = ConnectionQueue()
+                    partial[client_socket] = self._take_partial()
                     # Store its IP address.
                     IPs[client_socket] = client_ip
-                else:
+                elif sock in queues:
                     # Someone sent us something! Let's receive it.
                     try:
-                        data = sock.recv(self.received_bytes)
+                        received = self._receive(sock, partial[sock])
                     except socket.error as e:
-                        if e.errno is errno.ECONNRESET:
+                        if e.errno in (errno.ECONNRESET, errno.EBADF):
                             # Consider 'Connection reset by peer'
                             # the same as reading zero bytes
-                            data = None
+                            received = 0
                         else:
                             raise e
-                    if data:
-                        # Call the callback
-                        self.callback(IPs[sock], queues[sock], data)
-                        # Put the client socket in writers so we can write to it
-                        # later.
-                        if sock not in writers:
-                            writers.append(sock)
+                    if received:
+                        self._deliver(sock, received, queues, IPs, partial)
                     else:
                         # We received zero bytes, so we should close the stream
-                        # Stop writing to it.
-                        if sock in writers:
-                            writers.remove(sock)
-                        # Stop reading from it.
-                        readers.remove(sock)
-                        # Close the connection.
-                        sock.close()
-                        # Destroy is queue
-                        del queues[sock]
+                        self._forget(sock, readers, queues, IPs, pending, partial)
             # Deal with sockets that need to be written to.
             for sock in write:
+                if sock not in queues:
+                    continue
+                # Take everything that is queued, but don't wait.
+                data = pending.pop(sock, b'')
+                connection_queue = queues[sock]
+                while connection_queue is not None and not connection_queue.empty():
+                    data += connection_queue.get_nowait()
                 try:
-                    # Get the next chunk of data in the queue, but don't wait.
-                    data = queues[sock].get_nowait()
-                except queue.Empty:
-                    # The queue is empty -> nothing needs to be written.
-                    writers.remove(sock)
-                else:
-                    # The queue wasn't empty; we did, in fact, get something.
-                    # So send it.
-                    sock.send(data)
+                    sent = sock.send(data)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self._forget(sock, readers, queues, IPs, pending, partial)
+                    continue
+                if sent < len(data):
+                    pending[sock] = data[sent:]
             # Deal with errors in sockets.
             for sock in err:
-                # Remove the socket from every list.
-                readers.remove(sock)
-                if sock in writers:
-                    writers.remove(sock)
-                # Close the connection.
-                sock.close()
-                # Destroy its queue.
-                del queues[sock]
+                if sock in queues:
+                    self._forget(sock, readers, queues, IPs, pending, partial)
+
+    def _wait(self, readers, writers):
+        """
+        Wait up to select_timeout for sockets to be ready. We poll where the platform has it: select.select can not
+        take the file descriptors above FD_SETSIZE (1024), which a busy root reaches.
+
+        :return: The readable, writable and failed sockets, like select.select.
+        :rtype: tuple
+        """
+        if not hasattr(select, 'poll'):
+            return select.select(readers, writers, readers, self.select_timeout)
+        poller = select.poll()
+        by_fd = {}
+        writing = set(writers)
+        for sock in readers:
+            fd = sock.fileno()
+            if fd == -1:
+                continue
+            by_fd[fd] = sock
+            poller.register(fd, select.POLLIN | select.POLLOUT if sock in writing else select.POLLIN)
+        read, write, err = [], [], []
+        for fd, events in poller.poll(self.select_timeout * 1000):
+            sock = by_fd[fd]
+            # A socket closed by another thread while we were waiting is POLLNVAL; it is forgotten as failed.
+            if events & (select.POLLERR | select.POLLNVAL):
+                err.append(sock)
+                continue
+            # The peer has hung up: reading gets the rest of its data and then zero bytes.
+            if events & (select.POLLIN | select.POLLHUP):
+                read.append(sock)
+            if events & select.POLLOUT:
+                write.append(sock)
+        return read, write, err
+
+    def _take_partial(self):
+        return self._free_partials.pop() if self._free_partials else bytearray()
+
+    def _receive(self, sock, partial):
+        """
+        Put the incomplete frame of sock in front of the receive area and recv_into the rest of it.
+
+        :return: Number of bytes in the receive area now; 0 if the peer has closed the connection.
+        """
+        carried = len(partial)
+        if carried + self.received_bytes > len(self._receive_area):
+            # Callbacks do not keep views of the old area, so a new one does not change anything they see.
+            self._receive_area = bytearray(carried + self.received_bytes)
+            self._receive_view = memoryview(self._receive_area)
+        view = self._receive_view
+        received = sock.recv_into(view[carried:carried + self.received_bytes])
+        if not received:
+            return 0
+        if carried:
+            view[:carried] = partial
+            del partial[:]
+        return carried + received
+
+    def _deliver(self, sock, received, queues, IPs, partial):
+        view = self._receive_view
+        if self.frame_length is None:
+            self.callback(IPs[sock], queues[sock], bytes(view[:received]))
+            return
+        start = 0
+        while start < received:
+            length = self.frame_length(view[start:received])
+            if not length or start + length > received:
+                break
+            self.callback(IPs[sock], queues[sock], view[start:start + length])
+            start += length
+        if start < received:
+            partial[sock] += view[start:received]
+
+    def _forget(self, sock, readers, queues, IPs, pending, partial):
+        # Remove the socket from every list and close the connection.
+        if sock in readers:
+            readers.remove(sock)
+        sock.close()
+        # Destroy its queue.
+        connection_queue = queues.pop(sock, None)
+        if connection_queue is not None:
+            connection_queue.closed = True
+        IPs.pop(sock, None)
+        pending.pop(sock, None)
+        buffer = partial.pop(sock, None)
+        if buffer is not None and len(self._free_partials) < 64:
+            del buffer[:]
+            self._free_partials.append(buffer)
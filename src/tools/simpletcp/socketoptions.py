@@ -0,0 +1,67 @@
+import socket
+
+
+class SocketOptions:
+    """
+    The options of every socket of one server: the listening socket, the sockets it accepts and the outgoing
+    sockets of its owner, so both directions of a connection behave the same.
+
+    nodelay turns Nagle's algorithm off: small frames are sent right away instead of waiting for the ACK of the
+    previous one. send_buffer and receive_buffer set SO_SNDBUF and SO_RCVBUF (None keeps the OS default; set on the
+    listening socket they are inherited by the accepted ones, which also sizes the TCP window). keepalive makes the
+    kernel probe idle connections after keepalive_idle seconds, every keepalive_interval seconds, keepalive_count
+    times, where the platform has those options. recv_size is the number of bytes asked for in every recv.
+    """
+
+    def __init__(self, nodelay=True, send_buffer=None, receive_buffer=None, keepalive=False, keepalive_idle=None,
+                 keepalive_interval=None, keepalive_count=None, reuse_address=True, recv_size=2048):
+        self.nodelay = nodelay
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.reuse_address = reuse_address
+        self.recv_size = recv_size
+
+    @classmethod
+    def from_dict(cls, options):
+        """
+        :param options: Keyword arguments of the constructor, like the profiles in config.socket_profiles.
+        :rtype: SocketOptions
+        """
+        return cls(**(options or {}))
+
+    def apply(self, sock):
+        """
+        Set our options on a connected or connecting socket.
+
+        :type sock: socket.socket
+        :return:
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+        self._apply_buffers(sock)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 if self.keepalive else 0)
+        if self.keepalive:
+            for name, value in (('TCP_KEEPIDLE', self.keepalive_idle), ('TCP_KEEPINTVL', self.keepalive_interval),
+                                ('TCP_KEEPCNT', self.keepalive_count)):
+                if value is not None and hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+    def apply_listening(self, sock):
+        """
+        Set our options on a listening socket before bind.
+
+        :type sock: socket.socket
+        :return:
+        """
+        if self.reuse_address:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._apply_buffers(sock)
+
+    def _apply_buffers(self, sock):
+        if self.send_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
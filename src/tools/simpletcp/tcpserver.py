@@ -17,17 +17,27 @@ class TCPServer:
      is a tunnel of data to send to the socket that it received from.
      The third argument must be data, which is a string of bytes
      that the server received.
+     frame_length optionally splits the received bytes into frames, see ServerSocket.
+     loop_hook is called on every iteration of the server loop, see ServerSocket.
+     socket_options (a SocketOptions) are set on our sockets; their recv_size replaces receive_bytes.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=5, receive_bytes=2048, frame_length=None, loop_hook=None,
+                 socket_options=None):
+        if socket_options is not None:
+            receive_bytes = socket_options.recv_size
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes, frame_length, loop_hook=loop_hook,
+            socket_options=socket_options
         )
 
     def run(self):
         self.server_socket.run()
 
+    def adopt(self, sock):
+        self.server_socket.adopt(sock)
+
     @property
     def ip(self):
         return self.server_socket.ip
@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from tools.ArrayNetworkGraph import ArrayNetworkGraph
+from tools.NetworkGraph import NetworkGraph, GraphNode
+
+ROOT = ('127.000.000.001', 0)
+
+
+def _graphs():
+    return [NetworkGraph(GraphNode(ROOT)), ArrayNetworkGraph(ROOT)]
+
+
+def _place_batch(graph, senders):
+    parents = graph.find_live_nodes(senders)
+    for sender in senders:
+        if parents[sender] is not None:
+            graph.place_node(sender[0], sender[1], parents[sender])
+    return parents
+
+
+@pytest.mark.parametrize('graph', _graphs(), ids=['objects', 'arrays'])
+def test_batch_placement_keeps_a_binary_tree(graph):
+    rnd = random.Random(0)
+    for _ in range(30):
+        senders = list(dict.fromkeys(('x', rnd.randrange(200)) for _ in range(rnd.randrange(1, 20))))
+        _place_batch(graph, senders)
+    assert max(len(node.children) for node in graph.iter_nodes()) <= 2
+    for node in graph.iter_nodes():
+        if node is not graph.root:
+            assert node in node.parent.children
+
+
+def test_batch_placement_is_the_same_for_both_graphs():
+    rnd = random.Random(1)
+    objects, arrays = _graphs()
+    for _ in range(30):
+        senders = list(dict.fromkeys(('x', rnd.randrange(100)) for _ in range(rnd.randrange(1, 20))))
+        assert _place_batch(objects, senders) == _place_batch(arrays, senders)
+
+
+@pytest.mark.parametrize('graph', _graphs(), ids=['objects', 'arrays'])
+def test_removed_old_parent_registered_again_is_not_freed(graph):
+    graph.add_node('a', 1, ROOT)
+    graph.add_node('b', 1, ROOT)
+    graph.add_node('c', 1, ('a', 1))
+    graph.remove_node(('a', 1))
+    graph.add_node('a', 1, ('b', 1))
+    _place_batch(graph, [('c', 1)] + [('n', i) for i in range(20)])
+    assert max(len(node.children) for node in graph.iter_nodes()) <= 2
@@ -0,0 +1,19 @@
+import Root
+
+
+def test_unicast_to_another_shard_goes_toward_its_owner(simulator, monkeypatch):
+    # Started with unpadded IPs; the shard ring and the packets use the padded ones.
+    shards = [('127.0.0.1', 30000), ('127.0.0.1', 30001), ('127.0.0.1', 30002)]
+    monkeypatch.setattr(Root, 'root_shards', shards)
+    roots = [simulator.add_root(address) for address in shards]
+    middle = roots[1]
+    assert sorted(middle.shard_links) == [('127.000.000.001', 30000), ('127.000.000.001', 30002)]
+
+    for port in range(40000, 40050):
+        destination = ('127.000.000.001', port)
+        owner = middle.shard_ring.get(destination)
+        next_hop = middle._unicast_next_hop(destination, None)
+        if owner == ('127.000.000.001', 30001):
+            assert next_hop is None
+        else:
+            assert next_hop == owner
@@ -0,0 +1,59 @@
+def _parent_key(simulator, client):
+    return simulator._key(client.parent) if client.parent is not None else None
+
+
+def test_broadcast_reaches_every_peer(simulator):
+    simulator.add_root()
+    clients = [simulator.add_client() for _ in range(100)]
+    simulator.run(60)
+    assert len(simulator.joined()) == 100
+
+    sender = clients[50]
+    simulator.broadcast(sender.server_address, 'hello')
+    simulator.run(30)
+    deliveries = simulator.deliveries('hello')
+    # Every other client and the root; the sender does not print its own message.
+    assert len(deliveries) == 100
+    assert simulator._key(sender.server_address) not in deliveries
+
+
+def test_every_parent_has_at_most_two_children(simulator):
+    simulator.add_root()
+    clients = [simulator.add_client() for _ in range(50)]
+    simulator.run(60)
+    children = {}
+    for client in clients:
+        parent = _parent_key(simulator, client)
+        children[parent] = children.get(parent, 0) + 1
+    assert None not in children
+    assert max(children.values()) <= 2
+
+
+def test_unicast_reaches_only_its_destination(simulator):
+    simulator.add_root()
+    clients = [simulator.add_client() for _ in range(30)]
+    simulator.run(60)
+
+    source, destination = clients[3], clients[27]
+    source.user_interface.buffer.append('sendto {} {} direct'.format(*destination.server_address))
+    simulator.run(30)
+    assert list(simulator.deliveries('direct')) == [simulator._key(destination.server_address)]
+
+
+def test_orphans_rejoin_after_their_parent_crashes(simulator):
+    simulator.add_root()
+    clients = [simulator.add_client() for _ in range(20)]
+    simulator.run(60)
+
+    parents = set(_parent_key(simulator, client) for client in clients)
+    victim = next(client for client in clients if simulator._key(client.server_address) in parents)
+    orphans = [client for client in clients
+               if _parent_key(simulator, client) == simulator._key(victim.server_address)]
+    simulator.crash(victim.server_address)
+    simulator.run(120)
+
+    simulator.broadcast(orphans[0].server_address, 'again')
+    simulator.run(40)
+    # The 18 other surviving clients and the root.
+    assert len(simulator.deliveries('again')) == 19
+    assert simulator._key(victim.server_address) not in simulator.deliveries('again')
@@ -0,0 +1,62 @@
+from Packet import PacketFactory
+from Stream import Stream
+from tools.Node import Node
+
+SOURCE = ('127.000.000.001', 20000)
+RELAY = ('127.000.000.001', 20001)
+
+
+class _Recorder:
+    down_since = None
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def in_grace_time(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class _Stamper:
+    """
+    Stream._stamp_frame with a fixed clock, so no Stream (and no TCPServer) is made.
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def _now(self):
+        return self.now
+
+    stamp = Stream._stamp_frame
+
+
+def _sent_trace(packet, send_time):
+    connection = _Recorder()
+    node = Node(RELAY, connection=connection)
+    node.before_send = _Stamper(send_time).stamp
+    node.add_message_to_out_buff(packet.get_buf())
+    node.send_message()
+    return PacketFactory.parse_buffer(connection.sent)[0].get_trace()
+
+
+def test_forward_time_is_the_send_time():
+    trace = [(SOURCE, 100.0, 100.5), (RELAY, 101.0, 101.25)]
+    packet = PacketFactory.new_message_packet('hello', RELAY, trace=trace, origin=SOURCE, topic='news')
+    sent = _sent_trace(packet, 103.75)
+    assert sent[:-1] == trace[:-1]
+    assert sent[-1] == (RELAY, 101.0, 103.75)
+
+
+def test_untraced_frames_are_sent_as_they_are():
+    packet = PacketFactory.new_message_packet('hello', RELAY, origin=SOURCE)
+    connection = _Recorder()
+    node = Node(RELAY, connection=connection)
+    node.before_send = _Stamper(103.75).stamp
+    node.add_message_to_out_buff(packet.get_buf())
+    node.send_message()
+    assert connection.sent == [packet.get_buf()]